@@ -1,29 +1,36 @@
+import hashlib
 import logging
 import sys
 import json
 import random
 import string
 import os
+import time
 
 # Set framework path
 sys.path.append(os.path.dirname(sys.argv[0]) + "/../framework")
 
 USER_FILE_PATH = "/var/ossec/api/configuration/admin.json"
+SPEC_FILE_PATH = os.getenv("RBAC_SPEC_PATH", "/var/ossec/api/configuration/rbac.json")
+STATE_FILE_PATH = "/var/ossec/api/configuration/.rbac_state.json"
+RBAC_DB_PATH = "/var/ossec/api/configuration/security/rbac.db"
 SPECIAL_CHARS = "@$!%*?&-_"
+DEFAULT_USERS = ("wazuh", "wazuh-wui")
+# Users, roles and policies up to this id ship with Wazuh and are never pruned
+MAX_RESERVED_ID = 99
+# Bump when the way a spec is applied changes, so unchanged specs are applied again once
+STATE_VERSION = 1
 
 
-try:
-    from wazuh.rbac.orm import check_database_integrity
-    from wazuh.security import (
-        create_user,
-        get_users,
-        get_roles,
-        set_user_role,
-        update_user,
-    )
-except ModuleNotFoundError as e:
-    logging.error("No module 'wazuh' found.")
-    sys.exit(1)
+def load_framework():
+    """Import the Wazuh framework; only done when there is something to apply."""
+    try:
+        from wazuh.rbac.orm import check_database_integrity
+        from wazuh import security
+    except ModuleNotFoundError:
+        logging.error("No module 'wazuh' found.")
+        sys.exit(1)
+    return check_database_integrity, security
 
 
 def read_user_file(path=USER_FILE_PATH):
@@ -32,16 +39,49 @@ def read_user_file(path=USER_FILE_PATH):
         return data["username"], data["password"]
 
 
-def db_users():
-    users_result = get_users()
-    return {user["username"]: user["id"] for user in users_result.affected_items}
+def read_spec(path=SPEC_FILE_PATH):
+    """The declarative spec: {"policies": {name: policy}, "roles": {name: {"policies": [...]}}, "users": [...]}."""
+    if not os.path.exists(path):
+        return {"policies": {}, "roles": {}, "users": [], "disable_default_users": False}
+    with open(path) as spec_file:
+        spec = json.load(spec_file)
+    spec.setdefault("policies", {})
+    spec.setdefault("roles", {})
+    spec.setdefault("users", [])
+    spec.setdefault("disable_default_users", False)
+    names = [user["username"] for user in spec["users"]]
+    if len(names) != len(set(names)):
+        raise ValueError("A user is listed twice in the RBAC spec")
+    return spec
+
+
+def spec_hash(salt, spec):
+    # Salted, as the spec holds passwords
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{STATE_VERSION}\0{salt}\0{canonical}".encode()).hexdigest()
+
+
+def read_state(path=STATE_FILE_PATH):
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(state, path=STATE_FILE_PATH):
+    tmp = f"{path}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp, path)
+
 
+def password_digest(salt, username, password):
+    return hashlib.sha256(f"{salt}\0{username}\0{password}".encode()).hexdigest()
 
-def db_roles():
-    roles_result = get_roles()
-    return {role["name"]: role["id"] for role in roles_result.affected_items}
 
-def disable_user(uid):
+def random_password():
     random_pass = "".join(
                 random.choices(
                     string.ascii_uppercase
@@ -53,50 +93,214 @@ def disable_user(uid):
             )
     # assure there must be at least one character from each group
     random_pass = random_pass + ''.join([random.choice(chars) for chars in [string.ascii_lowercase, string.digits, string.ascii_uppercase, SPECIAL_CHARS]])
-    random_pass = ''.join(random.sample(random_pass,len(random_pass)))
-    update_user(
-        user_id=[
-            str(uid),
-        ],
-        password=random_pass,
-    )
+    return ''.join(random.sample(random_pass,len(random_pass)))
+
+
+def normalize_policy(policy):
+    return {
+        "actions": sorted(policy.get("actions", [])),
+        "resources": sorted(policy.get("resources", [])),
+        "effect": policy.get("effect", "allow"),
+    }
+
+
+class Provisioner:
+    """Apply a users/roles/policies spec with as few framework calls as possible.
+
+    The current RBAC state is fetched once, compared with the spec, and only
+    the differences are applied. Role and policy links are added or removed
+    with all ids of a user (or role) in one call, and pruned objects are
+    removed with all ids in one call.
+    """
+
+    def __init__(self, security, spec, state, salt):
+        self.security = security
+        self.spec = spec
+        self.salt = salt
+        self.applied_passwords = state.get("passwords", {})
+        self.passwords = {}
+        self.calls = 0
+        self.changes = []
+
+    def call(self, function, **kwargs):
+        self.calls += 1
+        result = function(**kwargs)
+        if result.total_failed_items:
+            failed = {str(error): sorted(ids) for error, ids in result.failed_items.items()}
+            raise RuntimeError(f"{function.__name__} failed: {failed}")
+        return result
+
+    def fetch_all(self, getter, limit=500):
+        """Every item of a paginated framework getter, a page per call."""
+        items = []
+        while True:
+            result = self.call(getter, offset=len(items), limit=limit)
+            items.extend(result.affected_items)
+            if not result.affected_items or len(items) >= result.total_affected_items:
+                return items
+
+    def fetch(self):
+        self.users = {u["username"]: u for u in self.fetch_all(self.security.get_users)}
+        self.roles = {r["name"]: r for r in self.fetch_all(self.security.get_roles)}
+        self.policies = {p["name"]: p for p in self.fetch_all(self.security.get_policies)}
+
+    def ids(self, kind, known, names, owner):
+        missing = [name for name in names if name not in known]
+        if missing:
+            raise ValueError(f"{owner} refers to unknown {kind}: {', '.join(missing)}")
+        return {known[name]["id"] for name in names}
+
+    def apply_policies(self):
+        for name, body in self.spec["policies"].items():
+            desired = normalize_policy(body)
+            current = self.policies.get(name)
+            if current is None:
+                result = self.call(self.security.create_policy, name=name, policy=desired)
+                self.policies[name] = result.affected_items[0]
+                self.changes.append(f"create policy {name}")
+            elif normalize_policy(current["policy"]) != desired:
+                self.call(self.security.update_policy, policy_id=[str(current["id"])], policy=desired)
+                self.changes.append(f"update policy {name}")
+
+    def apply_roles(self):
+        for name, body in self.spec["roles"].items():
+            role = self.roles.get(name)
+            if role is None:
+                result = self.call(self.security.create_role, name=name)
+                role = self.roles[name] = dict(result.affected_items[0], policies=[])
+                self.changes.append(f"create role {name}")
+            desired = self.ids("policies", self.policies, (body or {}).get("policies", []), f"Role {name}")
+            current = set(role.get("policies", []))
+            if desired - current:
+                self.call(self.security.set_role_policy, role_id=[str(role["id"])],
+                          policy_ids=[str(i) for i in sorted(desired - current)])
+                self.changes.append(f"link {len(desired - current)} policies to role {name}")
+            if current - desired:
+                self.call(self.security.remove_role_policy, role_id=[str(role["id"])],
+                          policy_ids=[str(i) for i in sorted(current - desired)])
+                self.changes.append(f"unlink {len(current - desired)} policies from role {name}")
+
+    def apply_users(self):
+        for entry in self.spec["users"]:
+            username = entry["username"]
+            password = entry.get("password")
+            digest = password_digest(self.salt, username, password) if password else None
+            user = self.users.get(username)
+            if user is None:
+                if not password:
+                    raise ValueError(f"User {username} does not exist and has no password in the spec")
+                result = self.call(self.security.create_user, username=username, password=password)
+                user = self.users[username] = dict(result.affected_items[0], roles=[], allow_run_as=False)
+                self.changes.append(f"create user {username}")
+            elif password and self.applied_passwords.get(username) != digest:
+                self.call(self.security.update_user, user_id=[str(user["id"])], password=password)
+                self.changes.append(f"set password of {username}")
+            if digest:
+                self.passwords[username] = digest
+
+            if "allow_run_as" in entry and bool(entry["allow_run_as"]) != bool(user.get("allow_run_as")):
+                self.call(self.security.edit_run_as, user_id=[str(user["id"])],
+                          allow_run_as=bool(entry["allow_run_as"]))
+                self.changes.append(f"set allow_run_as of {username}")
+            if entry.get("roles") is None:
+                # Roles of users listed without them are left as they are
+                continue
+            desired = self.ids("roles", self.roles, entry["roles"], f"User {username}")
+            current = set(user.get("roles", []))
+            if desired - current:
+                self.call(self.security.set_user_role, user_id=[str(user["id"])],
+                          role_ids=[str(i) for i in sorted(desired - current)])
+                self.changes.append(f"add {len(desired - current)} roles to {username}")
+            if current - desired:
+                self.call(self.security.remove_user_role, user_id=[str(user["id"])],
+                          role_ids=[str(i) for i in sorted(current - desired)])
+                self.changes.append(f"remove {len(current - desired)} roles from {username}")
+
+    def disable_default_users(self):
+        listed = {entry["username"] for entry in self.spec["users"]}
+        for username in DEFAULT_USERS:
+            if username not in listed and username in self.users:
+                self.call(self.security.update_user, user_id=[str(self.users[username]["id"])],
+                          password=random_password())
+                self.changes.append(f"disable user {username}")
+
+    def prune(self):
+        """Remove users, roles and policies that are not in the spec, except the reserved ones."""
+        listed = {entry["username"] for entry in self.spec["users"]}
+        extra_users = [u["id"] for name, u in self.users.items() if name not in listed and u["id"] > MAX_RESERVED_ID]
+        extra_roles = [r["id"] for name, r in self.roles.items()
+                       if name not in self.spec["roles"] and r["id"] > MAX_RESERVED_ID]
+        extra_policies = [p["id"] for name, p in self.policies.items()
+                          if name not in self.spec["policies"] and p["id"] > MAX_RESERVED_ID]
+        if extra_users:
+            self.call(self.security.remove_users, user_ids=[str(i) for i in extra_users])
+            self.changes.append(f"remove {len(extra_users)} users")
+        if extra_roles:
+            self.call(self.security.remove_roles, role_ids=[str(i) for i in extra_roles])
+            self.changes.append(f"remove {len(extra_roles)} roles")
+        if extra_policies:
+            self.call(self.security.remove_policies, policy_ids=[str(i) for i in extra_policies])
+            self.changes.append(f"remove {len(extra_policies)} policies")
+
+
+def add_admin_user(spec, username, password):
+    """Merge the admin.json user into the spec, keeping the behaviour of a single API user."""
+    spec["users"] = [u for u in spec["users"] if u["username"] != username]
+    # New users become administrators; an existing one ("wazuh" or "wazuh-wui") keeps its roles
+    spec["users"].append({"username": username, "password": password, "roles_if_new": ["administrator"]})
+    spec["disable_default_users"] = True
 
 
 if __name__ == "__main__":
-    if not os.path.exists(USER_FILE_PATH):
-        # abort if no user file detected
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    started = time.monotonic()
+    if not os.path.exists(USER_FILE_PATH) and not os.path.exists(SPEC_FILE_PATH):
+        # abort if no user file or spec detected
         sys.exit(0)
-    username, password = read_user_file()
+    spec = read_spec()
+    if os.path.exists(USER_FILE_PATH):
+        add_admin_user(spec, *read_user_file())
 
+    state = read_state()
+    salt = state.get("salt") or os.urandom(16).hex()
+    digest = spec_hash(salt, spec)
+    if state.get("spec_hash") == digest and os.path.exists(RBAC_DB_PATH):
+        logging.info(f"RBAC spec unchanged, nothing to apply ({time.monotonic() - started:.2f}s)")
+        sys.exit(0)
+
+    check_database_integrity, security = load_framework()
+    loaded = time.monotonic()
     # create RBAC database
     check_database_integrity()
 
-    initial_users = db_users()
-    if username not in initial_users:
-        # create a new user
-        create_user(username=username, password=password)
-        users = db_users()
-        uid = users[username]
-        roles = db_roles()
-        rid = roles["administrator"]
-        set_user_role(
-            user_id=[
-                str(uid),
-            ],
-            role_ids=[
-                str(rid),
-            ],
-        )
-    else:
-        # modify an existing user ("wazuh" or "wazuh-wui")
-        uid = initial_users[username]
-        update_user(
-            user_id=[
-                str(uid),
-            ],
-            password=password,
-        )
-    # disable unused default users
-    for def_user in ['wazuh', 'wazuh-wui']:
-        if def_user != username:
-            disable_user(initial_users[def_user])
+    provisioner = Provisioner(security, spec, state, salt)
+    try:
+        provisioner.fetch()
+        fetched = time.monotonic()
+        for entry in spec["users"]:
+            roles_if_new = entry.pop("roles_if_new", None)
+            if roles_if_new is not None and entry["username"] not in provisioner.users:
+                entry["roles"] = roles_if_new
+        provisioner.apply_policies()
+        provisioner.apply_roles()
+        provisioner.apply_users()
+        # disable unused default users
+        if spec["disable_default_users"]:
+            provisioner.disable_default_users()
+        if spec.get("prune"):
+            provisioner.prune()
+    except (ValueError, RuntimeError) as e:
+        # The state is not saved, so the whole spec is applied again on the next start
+        logging.error(f"RBAC provisioning failed after {len(provisioner.changes)} changes: {e}")
+        sys.exit(1)
+    applied = time.monotonic()
+
+    write_state({"spec_hash": digest, "salt": salt, "passwords": provisioner.passwords})
+    for change in provisioner.changes:
+        logging.info(f"RBAC: {change}")
+    logging.info(
+        f"RBAC provisioning: {len(spec['policies'])} policies, {len(spec['roles'])} roles, "
+        f"{len(spec['users'])} users; {len(provisioner.changes)} changes in {provisioner.calls} calls, "
+        f"{applied - started:.2f}s (framework {loaded - started:.2f}s, fetch {fetched - loaded:.2f}s, "
+        f"apply {applied - fetched:.2f}s)"
+    )
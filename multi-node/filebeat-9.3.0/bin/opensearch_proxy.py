@@ -1,17 +1,37 @@
+import http.client
 import http.server
-import socketserver
-import urllib.request
-import ssl
 import json
 import os
+import queue
+import select
+import ssl
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+# Standard library only: this file is dropped into the stock Filebeat image.
 
-PORT = 9201
-TARGET = "https://wazuh.vip:9200"
+PORT = int(os.getenv("PROXY_PORT", "9201"))
+TARGET = os.getenv("PROXY_TARGET", "https://wazuh.vip:9200")
+
+# Connections served at once; each keep-alive client holds a worker while it is connected
+WORKERS = int(os.getenv("PROXY_WORKERS", "32"))
+# Accepted connections allowed to wait for a worker before accept() stops
+BACKLOG = int(os.getenv("PROXY_BACKLOG", "64"))
+# Idle upstream connections kept open for reuse
+POOL_SIZE = int(os.getenv("PROXY_POOL_SIZE", "32"))
+# Close client connections idle for longer than this (seconds)
+IDLE_TIMEOUT = float(os.getenv("PROXY_IDLE_TIMEOUT", "60"))
+UPSTREAM_TIMEOUT = float(os.getenv("PROXY_UPSTREAM_TIMEOUT", "60"))
+CHUNK_SIZE = 64 * 1024
 
 # Paths to certificates inside the container
-CA_CERT = "/etc/ssl/root-ca.pem"
-CLIENT_CERT = "/etc/ssl/filebeat.pem"
-CLIENT_KEY = "/etc/ssl/filebeat.key"
+CA_CERT = os.getenv("PROXY_CA_CERT", "/etc/ssl/root-ca.pem")
+CLIENT_CERT = os.getenv("PROXY_CLIENT_CERT", "/etc/ssl/filebeat.pem")
+CLIENT_KEY = os.getenv("PROXY_CLIENT_KEY", "/etc/ssl/filebeat.key")
+
+HOP_BY_HOP = frozenset(("connection", "keep-alive", "proxy-connection", "proxy-authenticate",
+                        "proxy-authorization", "te", "trailer", "transfer-encoding", "upgrade"))
 
 # Create a custom SSL context
 ctx = ssl.create_default_context(cafile=CA_CERT)
@@ -20,34 +40,124 @@ if os.path.exists(CLIENT_CERT) and os.path.exists(CLIENT_KEY):
 ctx.check_hostname = False
 ctx.verify_mode = ssl.CERT_NONE
 
+
+def prebuilt_response(body):
+    """A complete HTTP/1.1 JSON response, serialised once at startup."""
+    payload = json.dumps(body, separators=(",", ":")).encode()
+    head = ("HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "\r\n").encode("latin-1")
+    return head + payload
+
+
+LICENSE_RESPONSE = prebuilt_response({
+    "license": {
+        "status": "active",
+        "type": "basic",
+        "uid": "wazuh-uid",
+        "issue_date": "2026-01-01T00:00:00.000Z",
+        "issue_date_in_millis": 1767225600000,
+        "expiry_date": "2099-01-01T00:00:00.000Z",
+        "expiry_date_in_millis": 4070908800000,
+        "max_nodes": 1000,
+        "issued_to": "wazuh",
+        "issuer": "elasticsearch",
+        "start_date_in_millis": -1
+    }
+})
+XPACK_RESPONSE = prebuilt_response({"features": {}})
+
+
+class UpstreamPool:
+    """Keep-alive HTTPS connections to the indexer, reused across requests and threads."""
+
+    def __init__(self, target, context, size):
+        parts = urlsplit(target)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.context = context
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT, context=self.context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=UPSTREAM_TIMEOUT)
+
+    def acquire(self):
+        """Return (connection, reused)."""
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return self.connect(), False
+            if self._usable(conn):
+                return conn, True
+            conn.close()
+
+    @staticmethod
+    def _usable(conn):
+        # An idle connection has nothing to read; if it is readable the indexer closed it
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def release(self, conn, response):
+        # Only a connection whose response was read to the end can carry the next request
+        if response is not None and not response.will_close and response.isclosed():
+            try:
+                self.idle.put_nowait(conn)
+                return
+            except queue.Full:
+                pass
+        conn.close()
+
+
+upstream = UpstreamPool(TARGET, ctx, POOL_SIZE)
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """Serve each connection on a fixed-size thread pool instead of a thread per connection.
+
+    When every worker is busy and `backlog` connections are already waiting,
+    the accept loop blocks and further clients queue in the kernel backlog.
+    """
+
+    def __init__(self, address, handler, workers, backlog):
+        super().__init__(address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="proxy")
+        self.slots = threading.BoundedSemaphore(workers + backlog)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self._serve, request, client_address)
+
+    def _serve(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
 class OpenSearchProxy(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps Filebeat's connections open between bulk requests
+    protocol_version = "HTTP/1.1"
+    timeout = IDLE_TIMEOUT
+
     def do_GET(self):
         if self.path.startswith("/_license"):
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            response = {
-                "license": {
-                    "status": "active",
-                    "type": "basic",
-                    "uid": "wazuh-uid",
-                    "issue_date": "2026-01-01T00:00:00.000Z",
-                    "issue_date_in_millis": 1767225600000,
-                    "expiry_date": "2099-01-01T00:00:00.000Z",
-                    "expiry_date_in_millis": 4070908800000,
-                    "max_nodes": 1000,
-                    "issued_to": "wazuh",
-                    "issuer": "elasticsearch",
-                    "start_date_in_millis": -1
-                }
-            }
-            self.wfile.write(json.dumps(response).encode())
+            self.wfile.write(LICENSE_RESPONSE)
             return
         if self.path.startswith("/_xpack"):
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(b'{"features":{}}')
+            self.wfile.write(XPACK_RESPONSE)
             return
         self.proxy_request("GET")
 
@@ -60,30 +170,120 @@ class OpenSearchProxy(http.server.BaseHTTPRequestHandler):
     def do_HEAD(self):
         self.proxy_request("HEAD")
 
+    def log_message(self, format, *args):
+        # Access logging per bulk request costs more than the relay itself
+        pass
+
+    def request_body(self):
+        """Stream the client body; returns (iterator or None, chunked)."""
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            return self._read_chunked(), True
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        if length <= 0:
+            return None, False
+        return self._read_exactly(length), False
+
+    def _read_exactly(self, length):
+        self.body_started = True
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ConnectionError("Client closed the connection mid-body")
+            remaining -= len(chunk)
+            yield chunk
+
+    def _read_chunked(self):
+        self.body_started = True
+        while True:
+            size = int(self.rfile.readline(1024).split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                # Trailers, up to the blank line
+                while self.rfile.readline(1024) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            yield from self._read_exactly(size)
+            self.rfile.readline(1024)
+
     def proxy_request(self, method):
-        url = TARGET + self.path
-        headers = {k: v for k, v in self.headers.items() if k.lower() not in ["host", "connection"]}
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length) if content_length > 0 else None
-        req = urllib.request.Request(url, data=body, headers=headers, method=method)
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP and k.lower() != "host"}
+        body, chunked = self.request_body()
+        if chunked:
+            headers["Transfer-Encoding"] = "chunked"
+        self.body_started = False
+
+        response = None
+        conn = None
+        for attempt in range(2):
+            conn, reused = upstream.acquire()
+            try:
+                conn.request(method, self.path, body=body, headers=headers, encode_chunked=chunked)
+                response = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                # A pooled connection closed under us: resend if the body was not consumed yet
+                if reused and attempt == 0 and not self.body_started:
+                    continue
+                self.fail(f"Upstream connection failed: {e}", body is not None)
+                return
+            except Exception as e:
+                conn.close()
+                self.fail(f"Upstream request failed: {e}", body is not None)
+                return
+
         try:
-            with urllib.request.urlopen(req, context=ctx) as r:
-                self.send_response(r.status)
-                for k, v in r.getheaders():
-                    if k.lower() not in ["transfer-encoding", "connection", "content-length"]:
-                        self.send_header(k, v)
-                self.end_headers()
-                self.wfile.write(r.read())
-        except urllib.error.HTTPError as e:
-            self.send_response(e.code)
-            for k, v in e.headers.items():
+            self.relay_response(method, response)
+        finally:
+            upstream.release(conn, response)
+
+    def relay_response(self, method, response):
+        # The indexer's own Date/Server headers are relayed below
+        self.send_response_only(response.status, response.reason)
+        length = response.getheader("Content-Length")
+        has_body = method != "HEAD" and response.status not in (204, 304) and response.status >= 200
+        for k, v in response.getheaders():
+            if k.lower() not in HOP_BY_HOP and k.lower() != "content-length":
                 self.send_header(k, v)
-            self.end_headers()
-            self.wfile.write(e.read())
-        except Exception as e:
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(str(e).encode())
-
-with socketserver.ThreadingTCPServer(("0.0.0.0", PORT), OpenSearchProxy) as httpd:
-    httpd.serve_forever()
+        if length is not None:
+            self.send_header("Content-Length", length)
+        elif has_body:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if not has_body:
+            response.read()
+            return
+
+        try:
+            while True:
+                chunk = response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if length is not None:
+                    self.wfile.write(chunk)
+                else:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            if length is None:
+                self.wfile.write(b"0\r\n\r\n")
+        except (OSError, http.client.HTTPException):
+            # Headers are already out; the only way to signal the failure is to drop the connection
+            self.close_connection = True
+            response.close()
+
+    def fail(self, message, unread_body):
+        if unread_body:
+            # Part of the client body may still be on the socket
+            self.close_connection = True
+        payload = json.dumps({"error": message}).encode()
+        self.send_response(502)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+if __name__ == "__main__":
+    PooledHTTPServer.allow_reuse_address = True
+    PooledHTTPServer.request_queue_size = max(128, BACKLOG)
+    with PooledHTTPServer(("0.0.0.0", PORT), OpenSearchProxy, WORKERS, BACKLOG) as httpd:
+        httpd.serve_forever()
@@ -0,0 +1,312 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Access records by response class, plus application log records below ERROR
+CATEGORIES = ("ok", "rejected", "error", "log")
+REJECTED_STATUSES = frozenset((403, 413, 429))
+WRITE_BATCH = 256
+
+# The record of the request being served. Code deeper in the call (the
+# upstream layer) adds fields to it without a reference being passed down.
+current_record: ContextVar[Optional[Dict]] = ContextVar("access_record", default=None)
+
+
+def annotate(**fields):
+    record = current_record.get()
+    if record is not None:
+        record.update(fields)
+
+
+def category_for(status: int) -> str:
+    if status < 400:
+        return "ok"
+    return "rejected" if status in REJECTED_STATUSES else "error"
+
+
+class Sampler:
+    """Token bucket capping the records kept per second; None keeps all."""
+
+    __slots__ = ("rate", "tokens", "updated")
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = float(rate) if rate is not None else None
+        self.tokens = self.rate or 0.0
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+def build_handler(settings: Dict) -> logging.Handler:
+    output = settings.get("output", "stdout")
+    if output == "file":
+        # Reopens the file when logrotate moves it away
+        handler = logging.handlers.WatchedFileHandler(settings.get("path", "/var/log/wazuh-proxy/access.log"))
+    elif output == "syslog":
+        address = settings.get("syslog_address", "/dev/log")
+        if ":" in address:
+            host, _, port = address.rpartition(":")
+            address = (host, int(port))
+        handler = logging.handlers.SysLogHandler(address=address, facility=logging.handlers.SysLogHandler.LOG_LOCAL0)
+        handler.ident = "wazuh-proxy: "
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    return handler
+
+
+class LogWriter(threading.Thread):
+    """Drains the bounded queue on its own thread, so the event loop never waits on I/O.
+
+    Queue entries are access records (dicts, serialised here), application
+    LogRecords (passed to the original handlers) or a replacement access
+    handler, swapped in order with the records around it.
+    """
+
+    def __init__(self, size: int, access_handler: logging.Handler):
+        super().__init__(name="wazuh-proxy-log", daemon=True)
+        self.queue: queue.Queue = queue.Queue(maxsize=size)
+        self.access_handler = access_handler
+        self.app_handlers: List[logging.Handler] = []
+        self.written = 0
+        self.write_errors = 0
+
+    def run(self):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < WRITE_BATCH:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for entry in batch:
+                if entry is None:
+                    running = False
+                    continue
+                try:
+                    self._write(entry)
+                except Exception:
+                    self.write_errors += 1
+        self.access_handler.close()
+
+    def _write(self, entry):
+        if isinstance(entry, dict):
+            entry["time"] = datetime.fromtimestamp(entry["time"], timezone.utc).isoformat(timespec="milliseconds")
+            line = json.dumps(entry, separators=(",", ":"), default=str)
+            self.access_handler.handle(logging.makeLogRecord({"msg": line, "levelno": logging.INFO}))
+            self.written += 1
+        elif isinstance(entry, logging.LogRecord):
+            for handler in self.app_handlers:
+                if entry.levelno >= handler.level:
+                    handler.handle(entry)
+            self.written += 1
+        else:
+            old, self.access_handler = self.access_handler, entry
+            old.close()
+
+    def stop(self, timeout: float = 5.0):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+class QueueLogHandler(logging.Handler):
+    """Root handler that passes application log records to the writer thread."""
+
+    def __init__(self, access_log: "AccessLog"):
+        super().__init__()
+        self.access_log = access_log
+
+    def emit(self, record: logging.LogRecord):
+        self.access_log.submit_log(record)
+
+
+class AccessLog:
+    """Structured, sampled access log written off the event loop.
+
+    One JSON record per request (client, client certificate, method, path,
+    upstream, status, bytes, duration) goes through a bounded queue to a
+    writer thread that appends to a file, stdout or syslog. Each category
+    can be capped to N records/s; records over the cap, or arriving while
+    the queue is full, are dropped and counted instead of blocking.
+    Application logging is routed through the same thread.
+    """
+
+    def __init__(self, config_manager, worker: Optional[str] = None):
+        self.config_manager = config_manager
+        self.worker = worker
+        self.samplers: Dict[str, Sampler] = {}
+        self.sampled_out = dict.fromkeys(CATEGORIES, 0)
+        self.dropped = dict.fromkeys(CATEGORIES, 0)
+        self.queued = 0
+        self.writer: Optional[LogWriter] = None
+        self.output_key = None
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.access_log
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        sample = settings.get("sample") or {}
+        self.samplers = {category: Sampler(sample.get(category)) for category in CATEGORIES}
+        key = (settings.get("output", "stdout"), settings.get("path"), settings.get("syslog_address"))
+        if self.writer is None:
+            self.writer = LogWriter(int(settings.get("queue_size", 10000)), self._handler(settings))
+            self.writer.start()
+        elif key != self.output_key:
+            handler = self._handler(settings)
+            try:
+                self.writer.queue.put(handler, timeout=1.0)
+            except queue.Full:
+                logger.error("Access log queue is full, keeping the previous output")
+                handler.close()
+                return
+        self.output_key = key
+
+    @staticmethod
+    def _handler(settings: Dict) -> logging.Handler:
+        try:
+            return build_handler(settings)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot open access log output {settings.get('output', 'stdout')}: {e}, using stdout")
+            return build_handler({})
+
+    def capture_logging(self):
+        """Move the root logger's handlers behind the writer thread."""
+        root = logging.getLogger()
+        self.writer.app_handlers = list(root.handlers)
+        for handler in self.writer.app_handlers:
+            root.removeHandler(handler)
+        root.addHandler(QueueLogHandler(self))
+
+    def _offer(self, category: str, entry) -> None:
+        if not self.samplers[category].allow():
+            self.sampled_out[category] += 1
+            return
+        try:
+            self.writer.queue.put_nowait(entry)
+            self.queued += 1
+        except queue.Full:
+            self.dropped[category] += 1
+
+    def submit_log(self, record: logging.LogRecord):
+        if record.levelno >= logging.ERROR:
+            # Errors skip sampling; only a full queue drops them
+            try:
+                self.writer.queue.put_nowait(record)
+                self.queued += 1
+            except queue.Full:
+                self.dropped["log"] += 1
+            return
+        self._offer("log", record)
+
+    def record_request(self, scope, record: Dict):
+        category = category_for(record["status"])
+        if not self.samplers[category].allow():
+            self.sampled_out[category] += 1
+            return
+        client = scope.get("client")
+        record["time"] = time.time()
+        record["client"] = client[0] if client else None
+        tls = scope.get("extensions", {}).get("tls")
+        if tls and tls.get("client_cert_name"):
+            record["client_cert"] = tls["client_cert_name"]
+        if self.worker is not None:
+            record["worker"] = self.worker
+        try:
+            self.writer.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped[category] += 1
+
+    def close(self):
+        if self.writer is not None:
+            root = logging.getLogger()
+            for handler in [h for h in root.handlers if isinstance(h, QueueLogHandler)]:
+                root.removeHandler(handler)
+            for handler in self.writer.app_handlers:
+                root.addHandler(handler)
+            self.writer.stop()
+
+    def metric_families(self):
+        yield ("wazuh_proxy_log_records_total", "counter", "Access and application log records by outcome.",
+               [({"category": c, "outcome": "sampled_out"}, self.sampled_out[c]) for c in CATEGORIES]
+               + [({"category": c, "outcome": "dropped"}, self.dropped[c]) for c in CATEGORIES])
+        yield ("wazuh_proxy_log_records_written_total", "counter", "Log records written by the writer thread.",
+               [({}, self.writer.written if self.writer else 0)])
+        yield ("wazuh_proxy_log_queue_depth", "gauge", "Log records waiting for the writer thread.",
+               [({}, self.writer.queue.qsize() if self.writer else 0)])
+
+    def stats(self) -> Dict:
+        writer = self.writer
+        return {
+            "enabled": self.enabled,
+            "output": self.output_key[0] if self.output_key else None,
+            "queued": self.queued,
+            "written": writer.written if writer else 0,
+            "queue_depth": writer.queue.qsize() if writer else 0,
+            "write_errors": writer.write_errors if writer else 0,
+            "sampled_out": self.sampled_out,
+            "dropped": self.dropped,
+        }
+
+
+class AccessLogMiddleware:
+    """Raw ASGI middleware: builds the access record of each request."""
+
+    def __init__(self, app, access_log: AccessLog):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        access_log = self.access_log
+        if scope["type"] != "http" or not access_log.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        record = {"method": scope["method"], "path": scope["path"], "status": 500, "bytes_in": 0, "bytes_out": 0}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                record["bytes_in"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                record["bytes_out"] += len(message.get("body", b""))
+            await send(message)
+
+        token = current_record.set(record)
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            current_record.reset(token)
+            record["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            access_log.record_request(scope, record)
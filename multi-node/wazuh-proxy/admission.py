@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+# How fast the no-load latency estimate follows latencies above it
+BASELINE_DRIFT = 0.01
+
+
+class Overloaded(Exception):
+    """The request was shed instead of queued; answer 429 with `retry_after`."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+def streamed_body_reservation(declared: str, encoded: bool, limit: Optional[int]) -> int:
+    """Body budget to reserve for a body that is streamed instead of read up front.
+
+    The declared content-length only bounds a body that is forwarded as sent.
+    A chunked or compressed body can grow up to the size limit that the
+    stream enforces, so that much is reserved; without a limit only the
+    declared bytes can be charged.
+    """
+    size = int(declared) if declared.isdigit() else 0
+    if limit is not None and (encoded or not declared.isdigit()):
+        return max(size, limit)
+    return size
+
+
+class _Gate(ABC):
+    """Capacity with a FIFO of waiting callers, bounded in length and waiting time."""
+
+    def __init__(self):
+        self.waiters: deque = deque()
+        self.max_queue = 0
+        self.queue_timeout = 0.0
+        self.retry_after = 1
+        self.queued = 0
+        self.shed = 0
+        self.timeouts = 0
+
+    @abstractmethod
+    def fits(self, need: int) -> bool:
+        """Whether `need` units can be taken now."""
+
+    @abstractmethod
+    def take(self, need: int):
+        """Take `need` units of capacity."""
+
+    @abstractmethod
+    def give(self, need: int):
+        """Return `need` units of capacity."""
+
+    async def acquire(self, need: int, reason: str):
+        if not self.waiters and self.fits(need):
+            self.take(need)
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.shed += 1
+            raise Overloaded(reason, self.retry_after)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (need, future)
+        self.waiters.append(entry)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._forget(entry)
+            self.timeouts += 1
+            raise Overloaded(reason, self.retry_after) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller went away
+                self.release(need)
+            else:
+                self._forget(entry)
+            raise
+
+    def release(self, need: int):
+        self.give(need)
+        self.wake()
+
+    def wake(self):
+        while self.waiters:
+            need, future = self.waiters[0]
+            if future.done():
+                self.waiters.popleft()
+                continue
+            if not self.fits(need):
+                return
+            self.waiters.popleft()
+            self.take(need)
+            future.set_result(None)
+
+    def _forget(self, entry):
+        try:
+            self.waiters.remove(entry)
+        except ValueError:
+            pass
+        # The caller may have been holding up smaller requests behind it
+        self.wake()
+
+    @property
+    def saturated(self) -> bool:
+        return bool(self.waiters) or not self.fits(1)
+
+
+class TargetLimit(_Gate):
+    """AIMD concurrency limit for one upstream target.
+
+    Each completed request is a sample. A 429, a 5xx, a transport error or a
+    latency above `latency_tolerance` times the no-load baseline multiplies
+    the limit by `backoff_ratio`, at most once per round trip. Otherwise the
+    limit grows by about one per `limit` successful requests.
+    """
+
+    def __init__(self, url: str, initial: int):
+        super().__init__()
+        self.url = url
+        self.limit = float(initial)
+        self.inflight = 0
+        self.baseline: Optional[float] = None
+        self.last_decrease = 0.0
+        self.decreases = 0
+
+    def configure(self, settings: Dict):
+        self.min_limit = max(1, int(settings.get("min_limit", 2)))
+        self.max_limit = max(self.min_limit, int(settings.get("max_limit", 200)))
+        self.tolerance = float(settings.get("latency_tolerance", 2.0))
+        self.latency_floor = settings.get("latency_floor_ms", 50) / 1000
+        self.backoff_ratio = float(settings.get("backoff_ratio", 0.9))
+        self.limit = min(self.max_limit, max(self.min_limit, self.limit))
+        self.wake()
+
+    def fits(self, need: int) -> bool:
+        return self.inflight + need <= int(self.limit)
+
+    def take(self, need: int):
+        self.inflight += need
+
+    def give(self, need: int):
+        self.inflight -= need
+
+    def complete(self, started: float, latency: Optional[float], status: Optional[int]):
+        """Return the slot of a request sent at `started`; None status means it failed in transport."""
+        congested = status is None or status == 429 or status >= 500
+        if latency is not None:
+            if self.baseline is None or latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * BASELINE_DRIFT
+            congested = congested or latency > max(self.baseline * self.tolerance, self.latency_floor)
+        if congested:
+            # Requests sent before the last decrease saw the old limit; count the event once
+            if started >= self.last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+                self.last_decrease = time.monotonic()
+                self.decreases += 1
+        elif self.inflight * 2 >= self.limit:
+            # Only grow while the limit is actually in use
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.release(1)
+
+    def abandon(self):
+        """Return the slot of a request that was cancelled before an answer."""
+        self.release(1)
+
+    def stats(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "inflight": self.inflight,
+            "queued": len(self.waiters),
+            "baseline_ms": round(self.baseline * 1000, 2) if self.baseline is not None else None,
+            "decreases": self.decreases,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+        }
+
+
+class BodyBudget(_Gate):
+    """Bytes of request bodies the proxy holds at once, across all targets."""
+
+    def __init__(self):
+        super().__init__()
+        self.capacity = 0
+        self.used = 0
+
+    def fits(self, need: int) -> bool:
+        # A body larger than the whole budget still gets through on its own
+        return self.used == 0 or self.used + need <= self.capacity
+
+    def take(self, need: int):
+        self.used += need
+
+    def give(self, need: int):
+        self.used -= need
+
+
+class AdmissionController:
+    """Adaptive per-target concurrency limits plus a global request body budget.
+
+    Requests over a target's limit, or whose body does not fit in the
+    budget, wait in a bounded FIFO for at most `queue_timeout_ms`. When the
+    queue is full or the wait runs out they are shed with a 429 and
+    `Retry-After`, so indexer latency and proxy memory stay bounded during
+    ingestion storms instead of everything piling up in flight.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.limits: Dict[str, TargetLimit] = {}
+        self.body_budget = BodyBudget()
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.admission
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.concurrency = settings.get("concurrency") or {}
+        self.initial_limit = int(self.concurrency.get("initial_limit", 20))
+        max_queue = int(settings.get("max_queue", 500))
+        queue_timeout = settings.get("queue_timeout_ms", 5000) / 1000
+        retry_after = int(settings.get("retry_after_s", 1))
+        for gate in [self.body_budget, *self.limits.values()]:
+            gate.max_queue, gate.queue_timeout, gate.retry_after = max_queue, queue_timeout, retry_after
+        for limit in self.limits.values():
+            limit.configure(self.concurrency)
+        self.body_budget.capacity = int(settings.get("body_budget_mb", 256) * MB)
+        self.body_budget.wake()
+
+    def _limit(self, url: str) -> TargetLimit:
+        limit = self.limits.get(url)
+        if limit is None:
+            limit = TargetLimit(url, self.initial_limit)
+            budget = self.body_budget
+            limit.max_queue, limit.queue_timeout, limit.retry_after = (
+                budget.max_queue, budget.queue_timeout, budget.retry_after)
+            limit.configure(self.concurrency)
+            self.limits[url] = limit
+        return limit
+
+    async def acquire_target(self, url: str) -> Optional[TargetLimit]:
+        """Wait for a slot on `url`; the returned limit must get `complete` or `abandon`."""
+        if not self.enabled:
+            return None
+        limit = self._limit(url)
+        await limit.acquire(1, f"Upstream {url} is at its concurrency limit")
+        return limit
+
+    def saturated(self) -> Set[str]:
+        """Targets that would make a new request wait."""
+        if not self.enabled:
+            return set()
+        return {url for url, limit in self.limits.items() if limit.saturated}
+
+    async def admit_body(self, size: int) -> int:
+        """Reserve `size` bytes of the body budget; returns what to pass to `release_body`."""
+        if not self.enabled or size <= 0:
+            return 0
+        await self.body_budget.acquire(size, "Proxy request body budget is exhausted")
+        return size
+
+    def release_body(self, reserved: int):
+        if reserved:
+            self.body_budget.release(reserved)
+
+    def metric_families(self):
+        limits = list(self.limits.values())
+        yield ("wazuh_proxy_concurrency_limit", "gauge", "Adaptive concurrency limit per upstream target.",
+               [({"target": l.url}, int(l.limit)) for l in limits])
+        yield ("wazuh_proxy_admission_queued", "gauge", "Requests waiting for admission.",
+               [({"gate": l.url}, len(l.waiters)) for l in limits]
+               + [({"gate": "body_budget"}, len(self.body_budget.waiters))])
+        yield ("wazuh_proxy_admission_shed_total", "counter", "Requests answered 429 by admission control.",
+               [({"gate": l.url}, l.shed + l.timeouts) for l in limits]
+               + [({"gate": "body_budget"}, self.body_budget.shed + self.body_budget.timeouts)])
+        yield ("wazuh_proxy_body_budget_bytes", "gauge", "Request body bytes currently admitted.",
+               [({}, self.body_budget.used)])
+
+    def stats(self) -> Dict:
+        budget = self.body_budget
+        return {
+            "enabled": self.enabled,
+            "targets": {url: limit.stats() for url, limit in self.limits.items()},
+            "body_budget": {
+                "capacity_bytes": budget.capacity,
+                "used_bytes": budget.used,
+                "queued": len(budget.waiters),
+                "shed": budget.shed,
+                "timeouts": budget.timeouts,
+            },
+        }
@@ -0,0 +1,110 @@
+import random
+import time
+from typing import Callable, Dict, List
+
+
+class TargetState:
+    """Live per-upstream counters fed by proxied traffic."""
+
+    __slots__ = ("url", "weight", "current_weight", "inflight", "ewma_ms", "requests", "last_observed")
+
+    def __init__(self, url: str, weight: int = 1):
+        self.url = url
+        self.weight = max(1, int(weight))
+        self.current_weight = 0
+        self.inflight = 0
+        self.ewma_ms = 0.0
+        self.requests = 0
+        self.last_observed = 0.0
+
+    def observe(self, latency_ms: float, alpha: float):
+        if self.requests == 0:
+            self.ewma_ms = latency_ms
+        else:
+            self.ewma_ms += alpha * (latency_ms - self.ewma_ms)
+        self.requests += 1
+        self.last_observed = time.monotonic()
+
+    def stats(self) -> Dict:
+        return {
+            "weight": self.weight,
+            "inflight": self.inflight,
+            "ewma_ms": round(self.ewma_ms, 2),
+            "requests": self.requests,
+        }
+
+
+class RoundRobin:
+    def __init__(self, settings: Dict):
+        self.index = 0
+
+    def pick(self, healthy: List[TargetState]) -> TargetState:
+        target = healthy[self.index % len(healthy)]
+        self.index += 1
+        return target
+
+
+class SmoothWeightedRoundRobin:
+    """nginx-style smooth weighted round robin: spreads picks evenly in proportion to weight."""
+
+    def __init__(self, settings: Dict):
+        pass
+
+    def pick(self, healthy: List[TargetState]) -> TargetState:
+        total = 0
+        best = None
+        for target in healthy:
+            target.current_weight += target.weight
+            total += target.weight
+            if best is None or target.current_weight > best.current_weight:
+                best = target
+        best.current_weight -= total
+        return best
+
+
+class LeastOutstanding:
+    """Fewest in-flight requests per unit of weight."""
+
+    def __init__(self, settings: Dict):
+        pass
+
+    def pick(self, healthy: List[TargetState]) -> TargetState:
+        best = healthy[0]
+        best_load = best.inflight / best.weight
+        for target in healthy[1:]:
+            load = target.inflight / target.weight
+            if load < best_load:
+                best, best_load = target, load
+        return best
+
+
+class PowerOfTwoEWMA:
+    """Pick two random targets and keep the one with the lower expected latency.
+
+    The latency estimate decays while a target is not picked, so a node that
+    was slow once gets probed again instead of being starved forever.
+    """
+
+    def __init__(self, settings: Dict):
+        self.random = random.Random()
+        self.half_life = float(settings.get("ewma_half_life_s", 10.0))
+
+    def score(self, target: TargetState, now: float) -> float:
+        idle = now - target.last_observed
+        decay = 0.5 ** (idle / self.half_life) if self.half_life > 0 else 1.0
+        return target.ewma_ms * decay * (target.inflight + 1) / target.weight
+
+    def pick(self, healthy: List[TargetState]) -> TargetState:
+        if len(healthy) == 1:
+            return healthy[0]
+        a, b = self.random.sample(healthy, 2)
+        now = time.monotonic()
+        return a if self.score(a, now) <= self.score(b, now) else b
+
+
+STRATEGIES: Dict[str, Callable] = {
+    "round_robin": RoundRobin,
+    "weighted_round_robin": SmoothWeightedRoundRobin,
+    "least_outstanding": LeastOutstanding,
+    "p2c_ewma": PowerOfTwoEWMA,
+}
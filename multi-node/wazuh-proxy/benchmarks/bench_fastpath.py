@@ -0,0 +1,79 @@
+"""The raw ASGI `_bulk` fast path vs. the generic FastAPI route.
+
+Runs bench_proxy.py's wazuh-proxy setup with `bulk.fast_path` on and off,
+alternating for several rounds so both see the same host noise, and reports
+throughput, latency and the proxy's CPU time per request, the figure that
+does not depend on how much of the machine the load generator takes.
+
+    python benchmarks/bench_fastpath.py [--rounds 3] [--duration 10] [--connections 16 --batch 50]
+    python benchmarks/bench_fastpath.py --set streaming.requests=false --gzip 1
+
+All bench_proxy.py options apply (fake node latency, worker count, --set).
+"""
+import json
+import os
+import statistics
+import sys
+import time
+
+import bench_proxy
+
+MODES = (("fast path", "true"), ("FastAPI route", "false"))
+
+
+def summarise(runs):
+    def median(values):
+        values = [v for v in values if v is not None]
+        return round(statistics.median(values), 2) if values else None
+
+    cpu_us = [r["proxy_resources"]["cpu_seconds"] / r["result"]["requests"] * 1e6
+              for r in runs if r["proxy_resources"] and r["result"]["requests"]]
+    return {
+        "rps": median([r["result"]["rps"] for r in runs]),
+        "p50_ms": median([r["result"]["latency_ms"]["p50"] for r in runs]),
+        "p99_ms": median([r["result"]["latency_ms"]["p99"] for r in runs]),
+        "cpu_us_per_request": median(cpu_us),
+        "errors": sum(r["result"]["requests"] - r["result"]["ok"] for r in runs),
+    }
+
+
+def main():
+    parser = bench_proxy.build_parser(__doc__)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.set_defaults(duration=10.0, connections=16)
+    args = parser.parse_args()
+    args.proxy = "wazuh-proxy"
+    overrides = list(args.set)
+
+    runs = {name: [] for name, _ in MODES}
+    for round_ in range(args.rounds):
+        for name, value in MODES:
+            args.set = overrides + [f"bulk.fast_path={value}"]
+            result = bench_proxy.run(args)
+            runs[name].append(result)
+            print(f"round {round_ + 1} {name:<14} {result['result']['rps']:>9} req/s "
+                  f"p99 {result['result']['latency_ms']['p99']}ms", file=sys.stderr)
+
+    rows = {name: summarise(results) for name, results in runs.items()}
+    print(f"{'':<14} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'CPU us/req':>11} {'errors':>7}")
+    for name, row in rows.items():
+        print(f"{name:<14} {row['rps']!s:>9} {row['p50_ms']!s:>8} {row['p99_ms']!s:>8} "
+              f"{row['cpu_us_per_request']!s:>11} {row['errors']:>7}")
+    fast, generic = rows["fast path"], rows["FastAPI route"]
+    if fast["cpu_us_per_request"] and generic["cpu_us_per_request"]:
+        saved = 1 - fast["cpu_us_per_request"] / generic["cpu_us_per_request"]
+        print(f"fast path uses {saved:.0%} less proxy CPU per request")
+
+    output = args.output
+    if not output:
+        os.makedirs(bench_proxy.RESULTS_DIR, exist_ok=True)
+        commit = bench_proxy.git_revision()["commit"] or "nogit"
+        output = os.path.join(bench_proxy.RESULTS_DIR, f"fastpath-{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w") as f:
+        json.dump({"benchmark": "bench_fastpath", "git": bench_proxy.git_revision(), "host": {"cpus": os.cpu_count()},
+                   "summary": rows, "runs": runs}, f, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
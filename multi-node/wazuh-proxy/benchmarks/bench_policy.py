@@ -0,0 +1,104 @@
+"""Micro-benchmark: policy evaluation cost vs. number of path policies.
+
+Compares the compiled radix index used by PolicyEngine with the previous
+linear scan over config["security"]["policies"].
+
+    python benchmarks/bench_policy.py [--iterations 20000]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from configuration import RuntimeConfig  # noqa: E402
+from policy import PolicyEngine  # noqa: E402
+
+
+class StaticConfig:
+    """Stands in for ConfigManager: one snapshot built from the policies alone."""
+
+    def __init__(self, policies):
+        self.snapshot = RuntimeConfig({"security": {"policies": policies}}, 1)
+
+
+def linear_evaluate(policies, method, path, body_size=0):
+    """The pre-index implementation, kept here as the baseline."""
+    if method == "DELETE":
+        return "DELETE method is explicitly forbidden."
+    for policy in policies:
+        target_path = policy.get("path")
+        if target_path == "*" or path.startswith(target_path):
+            if method in policy.get("blocked_methods", []):
+                return f"Method {method} is blocked for path {path}"
+            allowed = policy.get("allowed_methods")
+            if allowed and method not in allowed:
+                return f"Method {method} is not in allowed list for path {path}"
+            max_size_mb = policy.get("max_size_mb")
+            if max_size_mb and body_size > (max_size_mb * 1024 * 1024):
+                return f"Payload size exceeds limit of {max_size_mb}MB"
+    return None
+
+
+def make_policies(count, rng):
+    policies = [
+        {"path": "/_cluster", "allowed_methods": ["GET", "HEAD"]},
+        {"path": "/_bulk", "max_size_mb": 100},
+    ]
+    for i in range(count - 3):
+        kind = i % 3
+        if kind == 0:
+            policies.append({"path": f"/wazuh-tenant-{i:04d}/_bulk", "max_size_mb": 50})
+        elif kind == 1:
+            policies.append({"path": f"/wazuh-tenant-{i:04d}/_doc", "allowed_methods": ["POST", "PUT"]})
+        else:
+            policies.append({"path": f"/_plugins/_api{i:04d}", "allowed_methods": ["GET"]})
+    policies.append({"path": "*", "blocked_methods": ["DELETE"]})
+    rng.shuffle(policies)
+    return policies
+
+
+def make_requests(policies, rng, count=256):
+    paths = [p["path"] for p in policies if p["path"] != "*"]
+    requests = []
+    for _ in range(count):
+        base = rng.choice(paths + ["/wazuh-alerts-4.x-2026.10.18/_bulk", "/"])
+        requests.append((rng.choice(["GET", "POST", "PUT"]), base + "/x", rng.randint(0, 1024)))
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--sizes", default="10,100,500,1000,5000")
+    args = parser.parse_args()
+
+    # Building a snapshot logs the TLS defaults it falls back to
+    logging.getLogger("wazuh-proxy").setLevel(logging.ERROR)
+    rng = random.Random(42)
+    print(f"{'rules':>6} {'linear ns/op':>14} {'compiled ns/op':>15} {'speedup':>8}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        policies = make_policies(size, rng)
+        engine = PolicyEngine(StaticConfig(policies))
+        requests = make_requests(policies, rng)
+        n = len(requests)
+
+        def run_linear():
+            for method, path, body_size in requests:
+                linear_evaluate(policies, method, path, body_size)
+
+        def run_compiled():
+            for method, path, body_size in requests:
+                engine.evaluate(method, path, body_size)
+
+        loops = max(1, args.iterations // n)
+        linear = min(timeit.repeat(run_linear, number=loops, repeat=3)) / (loops * n) * 1e9
+        compiled = min(timeit.repeat(run_compiled, number=loops, repeat=3)) / (loops * n) * 1e9
+        print(f"{size:>6} {linear:>14.0f} {compiled:>15.0f} {linear / compiled:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""End-to-end benchmark of a proxy between the load generator and a fake OpenSearch.
+
+Starts benchmarks/fake_opensearch.py, the chosen proxy and
+benchmarks/loadgen.py on this machine, samples the proxy's CPU and RSS
+(all of its processes) from /proc during the run, and writes the result,
+the parameters and the git commit to a JSON file in benchmarks/results/.
+
+    python benchmarks/bench_proxy.py --proxy wazuh-proxy [--workers 2] [--connections 16 --batch 50]
+    python benchmarks/bench_proxy.py --proxy sidecar --latency-ms 5 --reject-rate 0.01
+    python benchmarks/bench_proxy.py --proxy direct          # load generator -> fake node, baseline
+    python benchmarks/bench_proxy.py --compare results/a.json results/b.json
+
+`--proxy wazuh-proxy` runs serve.py with config.yaml, pointed at the fake
+node, with health probing, hedging, rate limiting, caching and the spool
+turned off; `--set section.key=value` overrides any other setting.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import yaml
+
+import fake_opensearch
+import loadgen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROXY_DIR = os.path.join(BENCH_DIR, "..")
+SIDECAR = os.path.join(PROXY_DIR, "..", "filebeat-9.3.0", "bin", "opensearch_proxy.py")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+def git_revision() -> Dict:
+    def git(*argv):
+        return subprocess.run(["git", *argv], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    return {"commit": git("rev-parse", "--short", "HEAD") or None, "dirty": bool(git("status", "--porcelain", "--", PROXY_DIR))}
+
+
+class ResourceSampler(threading.Thread):
+    """Sample CPU time and RSS of a process tree from /proc."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples: List[tuple] = []
+        self.stopped = threading.Event()
+
+    def tree(self) -> List[int]:
+        parents: Dict[int, int] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+                except (OSError, IndexError, ValueError):
+                    continue
+        pids, frontier = [self.pid], [self.pid]
+        while frontier:
+            frontier = [pid for pid, ppid in parents.items() if ppid in frontier]
+            pids.extend(frontier)
+        return pids
+
+    def sample(self):
+        cpu_ticks = 0
+        rss_pages = 0
+        for pid in self.tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/statm") as f:
+                    rss_pages += int(f.read().split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            cpu_ticks += int(fields[11]) + int(fields[12])
+        self.samples.append((time.monotonic(), cpu_ticks / CLOCK_TICKS, rss_pages * PAGE_SIZE))
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self) -> Dict:
+        self.stopped.set()
+        self.join()
+        self.sample()
+        if len(self.samples) < 2:
+            return {}
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [s[2] for s in self.samples]
+        return {
+            "cpu_seconds": round(cpu1 - cpu0, 3),
+            "cpu_percent": round((cpu1 - cpu0) / (t1 - t0) * 100, 1),
+            "rss_mb_max": round(max(rss) / 1e6, 1),
+            "rss_mb_mean": round(sum(rss) / len(rss) / 1e6, 1),
+        }
+
+
+def proxy_config(upstream_port: int, overrides: List[str]) -> Dict:
+    with open(os.path.join(PROXY_DIR, "config.yaml")) as f:
+        config = yaml.safe_load(f)
+    upstream = config.setdefault("upstream", {})
+    upstream["targets"] = [{"url": f"http://127.0.0.1:{upstream_port}", "weight": 1}]
+    upstream["health_check_interval"] = 3600
+    upstream.setdefault("health_check", {})["cluster_stats"] = False
+    upstream.setdefault("hedging", {})["enabled"] = False
+    config.setdefault("security", {})["mtls"] = {}
+    for section in ("rate_limit", "cache", "spool"):
+        config.setdefault(section, {})["enabled"] = False
+    for override in overrides:
+        key, _, value = override.partition("=")
+        node = config
+        *parents, leaf = key.split(".")
+        for name in parents:
+            node = node.setdefault(name, {})
+        node[leaf] = yaml.safe_load(value)
+    return config
+
+
+def start_proxy(args, upstream_port: int, port: int, workdir: str) -> Optional[subprocess.Popen]:
+    log = open(os.path.join(workdir, "proxy.log"), "w")
+    if args.proxy == "wazuh-proxy":
+        config_path = os.path.join(workdir, "config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(proxy_config(upstream_port, args.set), f)
+        command = [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port),
+                   "--workers", str(args.workers), "--profile", args.profile,
+                   "--state-dir", os.path.join(workdir, "state"), "--log-level", "warning"]
+        env = dict(os.environ, CONFIG_PATH=config_path)
+        cwd = PROXY_DIR
+    else:
+        command = [sys.executable, SIDECAR]
+        # The sidecar insists on a CA file even for a plain-HTTP target
+        env = dict(os.environ, PROXY_PORT=str(port), PROXY_TARGET=f"http://127.0.0.1:{upstream_port}",
+                   PROXY_CA_CERT=args.cacert or "/etc/ssl/certs/ca-certificates.crt")
+        cwd = os.path.dirname(SIDECAR)
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_port(port)
+    return process
+
+
+def run(args) -> Dict:
+    upstream_port = free_port()
+    fake_args = fake_opensearch.parse_args([
+        "--port", str(upstream_port), "--processes", str(args.upstream_processes),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate), "--reject-rate", str(args.reject_rate),
+        "--item-reject-rate", str(args.item_reject_rate),
+    ])
+    fakes = fake_opensearch.start(fake_args)
+    wait_port(upstream_port)
+    with tempfile.TemporaryDirectory() as workdir:
+        proxy = None
+        try:
+            if args.proxy == "direct":
+                port = upstream_port
+            else:
+                port = free_port()
+                proxy = start_proxy(args, upstream_port, port, workdir)
+                # Let workers finish importing before the clock starts
+                time.sleep(args.warmup)
+            args.url = f"http://127.0.0.1:{port}"
+            sampler = ResourceSampler(proxy.pid) if proxy else None
+            if sampler:
+                sampler.start()
+            summary = loadgen.generate(args)
+            resources = sampler.stop() if sampler else {}
+        finally:
+            if proxy is not None:
+                proxy.terminate()
+                proxy.wait(timeout=60)
+            for fake in fakes:
+                fake.terminate()
+    params = {k: v for k, v in vars(args).items() if k not in ("compare", "output", "url", "rounds")}
+    return {
+        "benchmark": "bench_proxy",
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git": git_revision(),
+        "host": {"cpus": os.cpu_count(), "python": platform.python_version(), "platform": platform.platform()},
+        "params": params,
+        "result": summary,
+        "proxy_resources": resources,
+    }
+
+
+COMPARED = [
+    ("req/s", ("result", "rps"), True),
+    ("docs/s", ("result", "docs_per_s"), True),
+    ("MB/s", ("result", "mb_s"), True),
+    ("p50 ms", ("result", "latency_ms", "p50"), False),
+    ("p99 ms", ("result", "latency_ms", "p99"), False),
+    ("p99.9 ms", ("result", "latency_ms", "p999"), False),
+    ("CPU %", ("proxy_resources", "cpu_percent"), False),
+    ("RSS MB", ("proxy_resources", "rss_mb_max"), False),
+]
+
+
+def lookup(result: Dict, path) -> Optional[float]:
+    for key in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+
+def compare(paths: List[str]):
+    runs = []
+    for path in paths:
+        with open(path) as f:
+            runs.append(json.load(f))
+    names = [f"{r['git'].get('commit') or '?'}{'+' if r['git'].get('dirty') else ''} {r['params'].get('proxy')}"
+             for r in runs]
+    print(f"{'':<10}" + "".join(f"{n:>22}" for n in names))
+    for label, path, higher_is_better in COMPARED:
+        values = [lookup(r, path) for r in runs]
+        cells = []
+        for value in values:
+            cell = "-" if value is None else f"{value}"
+            base = values[0]
+            if value is not None and base and value is not values[0]:
+                change = (value - base) / base * 100
+                better = change > 0 if higher_is_better else change < 0
+                cell += f" ({change:+.1f}%{' ok' if better else ''})"
+            cells.append(cell)
+        print(f"{label:<10}" + "".join(f"{c:>22}" for c in cells))
+
+
+def build_parser(description: str = __doc__) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--proxy", choices=("wazuh-proxy", "sidecar", "direct"), default="wazuh-proxy")
+    parser.add_argument("--workers", type=int, default=1, help="wazuh-proxy worker processes")
+    parser.add_argument("--profile", default="performance", help="wazuh-proxy server profile")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="override a wazuh-proxy setting, e.g. bulk.fanout.enabled=false")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds between proxy start and load")
+    parser.add_argument("--upstream-processes", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--reject-rate", type=float, default=0.0)
+    parser.add_argument("--item-reject-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="result file (default: results/<proxy>-<commit>-<time>.json)")
+    loadgen.add_arguments(parser)
+    return parser
+
+
+def main():
+    parser = build_parser()
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="compare result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare)
+        return
+    result = run(args)
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        output = os.path.join(RESULTS_DIR, f"{args.proxy}-{result['git']['commit'] or 'nogit'}-{stamp}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    summary = result["result"]
+    latency = summary["latency_ms"]
+    resources = result["proxy_resources"]
+    print(f"{args.proxy}: {summary['rps']} req/s, {summary['docs_per_s']} docs/s, {summary['mb_s']} MB/s, "
+          f"p50 {latency['p50']}ms p99 {latency['p99']}ms p99.9 {latency['p999']}ms, "
+          f"statuses {summary['statuses']}, proxy CPU {resources.get('cpu_percent')}% "
+          f"RSS {resources.get('rss_mb_max')}MB")
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
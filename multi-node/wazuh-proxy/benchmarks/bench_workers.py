@@ -0,0 +1,227 @@
+"""Throughput of the proxy vs. number of worker processes.
+
+Starts a stub indexer, runs serve.py with --workers N (performance profile)
+for each N, drives small _bulk requests over keep-alive connections from
+several load processes and reports requests/s and latency per setting.
+
+    python benchmarks/bench_workers.py [--workers 1,2,4] [--duration 10] [--connections 64]
+
+The load generator and the stub share the machine with the proxy, so run
+it on a host with spare cores for them (or pin them with taskset).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BULK_BODY = (b'{"index":{"_index":"wazuh-alerts-bench"}}\n'
+             b'{"rule":{"level":3},"agent":{"id":"001"},"full_log":"benchmark event"}\n') * 4
+STUB_RESPONSE = b'{"took":1,"errors":false,"items":[]}'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    """Read one HTTP/1.1 response (content-length or chunked); returns the status."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    return status
+
+
+async def stub_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    head_response = (b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\n"
+                     b"content-length: %d\r\n\r\n" % len(STUB_RESPONSE))
+    response = head_response + STUB_RESPONSE
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            if length:
+                await reader.readexactly(length)
+            writer.write(head_response if head.startswith(b"HEAD ") else response)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_stub(port: int):
+    async def serve():
+        server = await asyncio.start_server(stub_handler, "127.0.0.1", port, reuse_port=True)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+
+def run_load(port: int, connections: int, duration: float, results):
+    request = (b"POST /_bulk HTTP/1.1\r\nhost: bench\r\ncontent-type: application/x-ndjson\r\n"
+               b"content-length: %d\r\n\r\n%s" % (len(BULK_BODY), BULK_BODY))
+
+    async def connection(deadline: float, latencies: list, errors: list):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                writer.write(request)
+                status = await read_response(reader)
+                if status == 200:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors.append(status)
+        except (asyncio.IncompleteReadError, ConnectionError) as exc:
+            errors.append(type(exc).__name__)
+        finally:
+            writer.close()
+
+    async def main():
+        latencies, errors = [], []
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(connection(deadline, latencies, errors) for _ in range(connections)))
+        results.put((latencies, len(errors)))
+
+    asyncio.run(main())
+
+
+def bench_config(upstream_port: int) -> dict:
+    with open(os.path.join(ROOT, "config.yaml")) as f:
+        config = yaml.safe_load(f)
+    upstream = config.setdefault("upstream", {})
+    upstream["targets"] = [{"url": f"http://127.0.0.1:{upstream_port}", "weight": 1}]
+    upstream["health_check_interval"] = 3600
+    upstream.setdefault("health_check", {})["cluster_stats"] = False
+    upstream.setdefault("hedging", {})["enabled"] = False
+    config.setdefault("security", {})["mtls"] = {}
+    config["bulk"] = {"fanout": {"enabled": False}, "coalesce": {"enabled": False}}
+    config["compression"] = dict(config.get("compression", {}), upstream_encoding="identity")
+    for section in ("rate_limit", "cache", "spool"):
+        config[section] = {"enabled": False}
+    return config
+
+
+def wait_ready(port: int, workers: int, timeout: float = 60.0):
+    """Wait until /stats has been answered by every worker."""
+    seen = set()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=2) as sock:
+                sock.sendall(b"GET /stats HTTP/1.1\r\nhost: bench\r\nconnection: close\r\n\r\n")
+                data = b""
+                while chunk := sock.recv(65536):
+                    data += chunk
+            stats = json.loads(data.split(b"\r\n\r\n", 1)[1])
+            seen.add((stats.get("worker") or {}).get("id"))
+            if len(seen) >= workers:
+                return
+        except (OSError, ValueError, IndexError):
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Proxy did not come up with {workers} workers")
+
+
+def run_setting(workers: int, args, config_path: str) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory() as state_dir:
+        proxy = subprocess.Popen(
+            [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+             "--profile", "performance", "--state-dir", state_dir, "--log-level", "warning"],
+            cwd=ROOT, env=dict(os.environ, CONFIG_PATH=config_path),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_ready(port, workers)
+            results = multiprocessing.Queue()
+            per_process = max(1, args.connections // args.load_processes)
+            loaders = [multiprocessing.Process(target=run_load, args=(port, per_process, args.duration, results))
+                       for _ in range(args.load_processes)]
+            for loader in loaders:
+                loader.start()
+            latencies, errors = [], 0
+            for _ in loaders:
+                chunk, failed = results.get()
+                latencies.extend(chunk)
+                errors += failed
+            for loader in loaders:
+                loader.join()
+        finally:
+            proxy.terminate()
+            proxy.wait(timeout=60)
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / args.duration, 1),
+        "p50_ms": pct(0.50),
+        "p99_ms": pct(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--load-processes", type=int, default=2)
+    parser.add_argument("--stub-processes", type=int, default=2)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    upstream_port = free_port()
+    stubs = [multiprocessing.Process(target=run_stub, args=(upstream_port,), daemon=True)
+             for _ in range(args.stub_processes)]
+    for stub in stubs:
+        stub.start()
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        yaml.safe_dump(bench_config(upstream_port), f)
+        config_path = f.name
+
+    print(f"{'workers':>8} {'req/s':>10} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = []
+    try:
+        for workers in (int(w) for w in args.workers.split(",")):
+            row = run_setting(workers, args, config_path)
+            row["speedup"] = round(row["rps"] / rows[0]["rps"], 2) if rows and rows[0]["rps"] else 1.0
+            rows.append(row)
+            print(f"{row['workers']:>8} {row['rps']:>10} {row['speedup']:>8} {row['p50_ms']!s:>8} "
+                  f"{row['p99_ms']!s:>8} {row['errors']:>7}")
+    finally:
+        os.unlink(config_path)
+        for stub in stubs:
+            stub.terminate()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"cpus": os.cpu_count(), "connections": args.connections, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
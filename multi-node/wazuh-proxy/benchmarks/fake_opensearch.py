@@ -0,0 +1,216 @@
+"""Fake OpenSearch node for benchmarks: answers what Filebeat and the proxies call.
+
+Speaks HTTP/1.1 keep-alive on plain TCP and implements `/`, `_license`,
+`_xpack`, `_cluster/health`, `_nodes/stats`, index/component templates,
+ingest pipelines and `_bulk` (with per-item results). Latency, 5xx errors,
+whole-request 429s and per-item `es_rejected_execution_exception`s can be
+injected. `/_fake/stats` returns this process's counters.
+
+    python benchmarks/fake_opensearch.py --port 9200 [--latency-ms 5 --jitter-ms 2] \
+        [--error-rate 0.01] [--reject-rate 0.05] [--item-reject-rate 0.01] [--processes 2]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NODE_NAME = "fake-opensearch"
+JSON = b"application/json"
+REASONS = {200: b"OK", 201: b"Created", 404: b"Not Found", 429: b"Too Many Requests",
+           500: b"Internal Server Error", 503: b"Service Unavailable"}
+
+
+class FakeNode:
+    def __init__(self, args):
+        self.args = args
+        self.templates = {}
+        self.stats = {"requests": 0, "bulk_requests": 0, "docs": 0, "bulk_bytes": 0,
+                      "rejected_requests": 0, "rejected_items": 0, "errors": 0}
+
+    def route(self, method: str, path: str, body: bytes):
+        """Return (status, JSON-serialisable body)."""
+        path, _, _ = path.partition("?")
+        segments = [s for s in path.split("/") if s]
+        if not segments:
+            return 200, {
+                "name": NODE_NAME,
+                "cluster_name": "fake-cluster",
+                "version": {"distribution": "opensearch", "number": "2.19.0", "minimum_wire_compatibility_version": "7.10.0"},
+                "tagline": "The OpenSearch Project: https://opensearch.org/",
+            }
+        if segments[0] == "_fake" and segments[1:] == ["stats"]:
+            return 200, self.stats
+        if segments[0] == "_license":
+            return 200, {"license": {"status": "active", "type": "basic", "uid": "fake"}}
+        if segments[0] == "_xpack":
+            return 200, {"features": {}}
+        if segments[0] == "_cluster" and segments[1:2] == ["health"]:
+            return 200, {"cluster_name": "fake-cluster", "status": "green", "number_of_nodes": 1,
+                         "unassigned_shards": 0}
+        if segments[0] == "_nodes":
+            write = {"queue": 0, "active": 0, "rejected": self.stats["rejected_items"]}
+            return 200, {"nodes": {"fake": {"name": NODE_NAME, "host": "127.0.0.1", "ip": "127.0.0.1",
+                                            "thread_pool": {"write": write}}}}
+        if segments[-1] == "_bulk":
+            return self.bulk(segments[0] if len(segments) > 1 else None, body)
+        if segments[0] in ("_template", "_index_template", "_component_template") or segments[:2] == ["_ingest", "pipeline"]:
+            return self.template(method, path, body)
+        return 200, {}
+
+    def template(self, method: str, path: str, body: bytes):
+        if method in ("PUT", "POST"):
+            self.templates[path] = body
+            return 200, {"acknowledged": True}
+        if path in self.templates:
+            return 200, {path.rsplit("/", 1)[-1]: json.loads(self.templates[path] or b"{}")}
+        return 404, {"error": {"type": "resource_not_found_exception", "reason": f"{path} not found"}, "status": 404}
+
+    def bulk(self, default_index, body: bytes):
+        self.stats["bulk_requests"] += 1
+        self.stats["bulk_bytes"] += len(body)
+        items = []
+        errors = False
+        lines = iter(body.splitlines())
+        for line in lines:
+            if not line.strip():
+                continue
+            action = json.loads(line)
+            op, meta = next(iter(action.items()))
+            if op != "delete":
+                next(lines, None)
+            item = {"_index": meta.get("_index", default_index), "_id": meta.get("_id") or f"{random.getrandbits(64):x}"}
+            if random.random() < self.args.item_reject_rate:
+                errors = True
+                self.stats["rejected_items"] += 1
+                item.update(status=429, error={
+                    "type": "es_rejected_execution_exception",
+                    "reason": "rejected execution of coordinating operation",
+                })
+            else:
+                self.stats["docs"] += 1
+                item.update(status=201 if op in ("index", "create") else 200, result="created", _version=1)
+            items.append({op: item})
+        return 200, {"took": 1, "errors": errors, "items": items}
+
+    def inject(self, path: str):
+        """A fault to answer with instead of the real response, or None."""
+        if random.random() < self.args.error_rate:
+            self.stats["errors"] += 1
+            return 503, {"error": {"type": "unavailable_shards_exception", "reason": "injected"}, "status": 503}
+        if "_bulk" in path and random.random() < self.args.reject_rate:
+            self.stats["rejected_requests"] += 1
+            return 429, {"error": {"type": "es_rejected_execution_exception", "reason": "injected"}, "status": 429}
+        return None
+
+
+def decode(body: bytes, encoding: bytes) -> bytes:
+    if encoding == b"gzip":
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == b"deflate":
+        return zlib.decompress(body)
+    if encoding == b"zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """Return (method, path, headers, body) of the next request on the connection."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    method, path, _ = lines[0].split(b" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+    if headers.get(b"transfer-encoding", b"").lower() == b"chunked":
+        parts = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            parts.append(await reader.readexactly(size + 2))
+            if size == 0:
+                # Trailers are not supported; the last chunk is followed by CRLF
+                break
+        body = b"".join(p[:-2] for p in parts)
+    else:
+        body = await reader.readexactly(int(headers.get(b"content-length", 0)))
+    return method.decode(), path.decode(), headers, body
+
+
+def serialise(status: int, payload, head_only: bool) -> bytes:
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    head = (b"HTTP/1.1 %d %s\r\ncontent-type: %s\r\ncontent-length: %d\r\n\r\n"
+            % (status, REASONS.get(status, b"OK"), JSON, len(body)))
+    return head if head_only else head + body
+
+
+async def handle(node: FakeNode, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    args = node.args
+    try:
+        while True:
+            method, path, headers, body = await read_request(reader)
+            node.stats["requests"] += 1
+            if args.latency_ms or args.jitter_ms:
+                await asyncio.sleep(max(0.0, random.gauss(args.latency_ms, args.jitter_ms)) / 1000)
+            response = None if path.startswith("/_fake") else node.inject(path)
+            if response is None:
+                response = node.route(method, path, decode(body, headers.get(b"content-encoding", b"")))
+            writer.write(serialise(*response, head_only=method == "HEAD"))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+
+def serve(args):
+    node = FakeNode(args)
+
+    async def main():
+        server = await asyncio.start_server(lambda r, w: handle(node, r, w), args.host, args.port,
+                                            reuse_port=True, limit=1024 * 1024, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="mean added latency per request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="standard deviation of the added latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="fraction of _bulk requests answered 429")
+    parser.add_argument("--item-reject-rate", type=float, default=0.0,
+                        help="fraction of _bulk items rejected with es_rejected_execution_exception")
+    parser.add_argument("--processes", type=int, default=1, help="server processes sharing the port")
+    return parser.parse_args(argv)
+
+
+def start(args) -> list:
+    """Run the fake node in background processes; returns them."""
+    processes = [multiprocessing.Process(target=serve, args=(args,), daemon=True) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    return processes
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    if options.processes > 1:
+        for p in start(options):
+            p.join()
+    else:
+        serve(options)
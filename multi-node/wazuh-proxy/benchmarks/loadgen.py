@@ -0,0 +1,278 @@
+"""Filebeat-like load generator: bulk-indexes synthetic Wazuh alerts.
+
+Each connection behaves like a Filebeat output worker: it keeps one
+keep-alive connection, sends a `_bulk` of `--batch` alerts, waits for the
+answer and sends the next one, optionally gzip-compressed and paced to a
+total `--rate` of requests/s. Before the run it performs Filebeat's
+startup handshake (`GET /`, `GET /_license`).
+
+    python benchmarks/loadgen.py --url http://127.0.0.1:9201 --connections 8 --batch 50 --duration 30 \
+        [--gzip 1] [--rate 0] [--cacert ca.pem --cert client.pem --key client.key] [--json out.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import ssl
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+# Distinct pre-built bodies per process; enough variety for compression to be realistic
+BODY_VARIANTS = 32
+
+RULES = [
+    (5710, 5, "sshd: Attempt to login using a non-existent user", ["syslog", "sshd", "authentication_failed"], "T1110.001"),
+    (5715, 3, "sshd: authentication success.", ["syslog", "sshd", "authentication_success"], "T1078"),
+    (5502, 3, "PAM: Login session closed.", ["pam", "syslog"], None),
+    (550, 7, "Integrity checksum changed.", ["ossec", "syscheck", "syscheck_entry_modified"], "T1565.001"),
+    (31101, 5, "Web server 400 error code.", ["web", "accesslog", "attack"], None),
+    (60106, 3, "Windows Logon Success", ["windows", "windows_security", "authentication_success"], "T1078"),
+    (92213, 12, "Executable file dropped in folder commonly used by malware", ["sysmon", "windows"], "T1105"),
+    (87105, 10, "CVE-2024-6387 affects openssh-server", ["vulnerability-detector"], None),
+]
+USERS = ["root", "admin", "oracle", "postgres", "ubuntu", "test", "deploy", "backup"]
+
+
+def make_alert(rng: random.Random, when: datetime) -> Dict:
+    rule_id, level, description, groups, mitre = rng.choice(RULES)
+    agent = rng.randrange(1, 500)
+    srcip = f"{rng.randrange(1, 223)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}"
+    user = rng.choice(USERS)
+    timestamp = when.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "+0000"
+    alert = {
+        "timestamp": timestamp,
+        "rule": {"level": level, "description": description, "id": str(rule_id), "firedtimes": rng.randrange(1, 5000),
+                 "mail": level >= 12, "groups": groups},
+        "agent": {"id": f"{agent:03d}", "name": f"agent-{agent:03d}", "ip": f"10.0.{agent // 256}.{agent % 256}"},
+        "manager": {"name": "wazuh.master"},
+        "id": f"{int(when.timestamp())}.{rng.randrange(10 ** 9)}",
+        "cluster": {"name": "wazuh", "node": rng.choice(["master", "worker01", "worker02"])},
+        "full_log": (f"{when.strftime('%b %d %H:%M:%S')} agent-{agent:03d} sshd[{rng.randrange(1000, 65000)}]: "
+                     f"Invalid user {user} from {srcip} port {rng.randrange(1024, 65535)}"),
+        "predecoder": {"program_name": "sshd", "timestamp": when.strftime("%b %d %H:%M:%S"),
+                       "hostname": f"agent-{agent:03d}"},
+        "decoder": {"parent": "sshd", "name": "sshd"},
+        "data": {"srcip": srcip, "srcport": str(rng.randrange(1024, 65535)), "srcuser": user},
+        "location": "/var/log/auth.log",
+    }
+    if mitre:
+        alert["rule"]["mitre"] = {"id": [mitre], "tactic": ["Credential Access"], "technique": ["Brute Force"]}
+    return alert
+
+
+def make_bodies(batch: int, seed: int, gzip_level: int = 0) -> List[Tuple[bytes, bytes]]:
+    """(payload, bytes on the wire) pairs, compressed up front so the generator stays cheap."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    index = f"wazuh-alerts-4.x-{now:%Y.%m.%d}"
+    action = json.dumps({"index": {"_index": index}}).encode()
+    bodies = []
+    for _ in range(BODY_VARIANTS):
+        lines = []
+        for _ in range(batch):
+            lines.append(action)
+            lines.append(json.dumps(make_alert(rng, now - timedelta(milliseconds=rng.randrange(60000)))).encode())
+        body = b"\n".join(lines) + b"\n"
+        bodies.append((body, zlib.compress(body, gzip_level, 16 + zlib.MAX_WBITS) if gzip_level else body))
+    return bodies
+
+
+async def read_response(reader: asyncio.StreamReader):
+    """Read one HTTP/1.1 response (content-length or chunked); returns (status, headers, body)."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(":") for line in lines[1:] if line)}
+    if headers.get("transfer-encoding") == "chunked":
+        parts = []
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            parts.append((await reader.readexactly(size + 2))[:-2])
+            if size == 0:
+                break
+        body = b"".join(parts)
+    else:
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+    if headers.get("content-encoding") == "gzip":
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    return status, headers, body
+
+
+def client_ssl(args) -> Optional[ssl.SSLContext]:
+    if urlsplit(args.url).scheme != "https":
+        return None
+    context = ssl.create_default_context(cafile=args.cacert)
+    context.check_hostname = False
+    if not args.cacert:
+        context.verify_mode = ssl.CERT_NONE
+    if args.cert:
+        context.load_cert_chain(args.cert, args.key)
+    return context
+
+
+class Run:
+    """Counters and latency samples of one load process."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.docs = 0
+        self.item_errors = 0
+        self.payload_bytes = 0
+        self.wire_bytes = 0
+        self.connection_errors = 0
+
+
+def address(url: str) -> Tuple[str, int]:
+    parts = urlsplit(url)
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+async def connection(args, bodies: List[Tuple[bytes, bytes]], run: Run, deadline: float, interval: float,
+                     offset: float):
+    host, port = address(args.url)
+    reader, writer = await asyncio.open_connection(host, port, ssl=client_ssl(args))
+    extra = "content-encoding: gzip\r\naccept-encoding: gzip\r\n" if args.gzip else ""
+    rng = random.Random()
+    next_send = time.perf_counter() + offset
+    try:
+        while True:
+            if interval:
+                await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+                next_send += interval
+            if time.perf_counter() >= deadline:
+                break
+            body, wire = rng.choice(bodies)
+            head = (f"POST /_bulk HTTP/1.1\r\nhost: {host}\r\ncontent-type: application/x-ndjson\r\n"
+                    f"{extra}content-length: {len(wire)}\r\n\r\n").encode()
+            started = time.perf_counter()
+            writer.write(head + wire)
+            status, _, response = await read_response(reader)
+            elapsed = time.perf_counter() - started
+            run.latencies.append(elapsed)
+            run.statuses[str(status)] = run.statuses.get(str(status), 0) + 1
+            if status == 200:
+                run.payload_bytes += len(body)
+                run.wire_bytes += len(wire)
+                result = json.loads(response)
+                items = result.get("items", [])
+                failed = sum(1 for item in items if next(iter(item.values())).get("status", 200) >= 300)
+                run.item_errors += failed
+                run.docs += len(items) - failed
+    except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError, ValueError):
+        run.connection_errors += 1
+    finally:
+        writer.close()
+
+
+async def handshake(args):
+    """Filebeat's startup calls, so the mocks and version probe are exercised too."""
+    host, port = address(args.url)
+    reader, writer = await asyncio.open_connection(host, port, ssl=client_ssl(args))
+    try:
+        for path in ("/", "/_license"):
+            writer.write(f"GET {path} HTTP/1.1\r\nhost: {host}\r\n\r\n".encode())
+            status, _, _ = await read_response(reader)
+            if status != 200:
+                raise RuntimeError(f"Handshake GET {path} returned HTTP {status}")
+    finally:
+        writer.close()
+
+
+def run_process(args, connections: int, seed: int, results):
+    bodies = make_bodies(args.batch, seed, args.gzip)
+    run = Run()
+
+    async def main():
+        deadline = time.perf_counter() + args.duration
+        interval = connections * args.processes / args.rate if args.rate else 0.0
+        await asyncio.gather(*(connection(args, bodies, run, deadline, interval, interval * i / max(1, connections))
+                               for i in range(connections)))
+
+    asyncio.run(main())
+    results.put(run.__dict__)
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))] * 1000, 3)
+
+
+def generate(args) -> Dict:
+    """Run the load and return the summary."""
+    asyncio.run(handshake(args))
+    results = multiprocessing.Queue()
+    per_process = max(1, args.connections // args.processes)
+    processes = [multiprocessing.Process(target=run_process, args=(args, per_process, args.seed + i, results))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    runs = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    # Every process sends for exactly `duration` seconds after it started
+    elapsed = args.duration
+
+    latencies = sorted(l for run in runs for l in run["latencies"])
+    statuses: Dict[str, int] = {}
+    for run in runs:
+        for status, count in run["statuses"].items():
+            statuses[status] = statuses.get(status, 0) + count
+    payload = sum(run["payload_bytes"] for run in runs)
+    ok = statuses.get("200", 0)
+    return {
+        "requests": len(latencies),
+        "ok": ok,
+        "statuses": statuses,
+        "docs": sum(run["docs"] for run in runs),
+        "item_errors": sum(run["item_errors"] for run in runs),
+        "connection_errors": sum(run["connection_errors"] for run in runs),
+        "duration_s": round(elapsed, 3),
+        "rps": round(ok / elapsed, 1),
+        "docs_per_s": round(sum(run["docs"] for run in runs) / elapsed, 1),
+        "mb_s": round(payload / elapsed / 1e6, 3),
+        "wire_mb_s": round(sum(run["wire_bytes"] for run in runs) / elapsed / 1e6, 3),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+    }
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--connections", type=int, default=8, help="concurrent Filebeat-like workers")
+    parser.add_argument("--batch", type=int, default=50, help="alerts per _bulk request")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--rate", type=float, default=0.0, help="total requests/s (0 = as fast as possible)")
+    parser.add_argument("--gzip", type=int, default=0, choices=range(0, 10), metavar="LEVEL",
+                        help="gzip request bodies at this level (0 = off)")
+    parser.add_argument("--processes", type=int, default=1, help="load generator processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cacert")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:9201")
+    parser.add_argument("--json", help="write the summary to this file")
+    add_arguments(parser)
+    args = parser.parse_args()
+    summary = generate(args)
+    print(json.dumps(summary, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,578 @@
+import asyncio
+import fnmatch
+import json
+import logging
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import httpx
+
+from admission import Overloaded
+from resilience import NoHealthyUpstream
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+
+# Bulk actions that are followed by a source line
+SOURCE_ACTIONS = ("index", "create", "update")
+BULK_ACTIONS = frozenset(SOURCE_ACTIONS + ("delete",))
+# Item errors meaning the node's write queue was full, not that the document is bad
+REJECTED_TYPES = frozenset(("es_rejected_execution_exception", "rejected_execution_exception"))
+
+
+def is_bulk_path(path: str) -> bool:
+    return path.rstrip("/").endswith("_bulk")
+
+
+def action_has_source(action: bytes) -> bool:
+    # Only pay for a JSON parse when the line could be a delete action
+    if b'"delete"' not in action:
+        return True
+    try:
+        return next(iter(json.loads(action))) in SOURCE_ACTIONS
+    except (ValueError, StopIteration):
+        return True
+
+
+async def iter_bulk_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yield the non-empty NDJSON lines of a body as its chunks arrive."""
+    pending = b""
+    async for chunk in stream:
+        pending += chunk
+        if b"\n" not in chunk:
+            continue
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if pending.strip():
+        yield pending
+
+
+async def iter_bulk_items(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yield one NDJSON block (action line plus optional source line) per bulk item."""
+    action = None
+    async for line in iter_bulk_lines(stream):
+        if action is None:
+            if action_has_source(line):
+                action = line
+            else:
+                yield line + b"\n"
+        else:
+            yield action + b"\n" + line + b"\n"
+            action = None
+    if action is not None:
+        # Let the indexer report the malformed trailing action
+        yield action + b"\n"
+
+
+def split_bulk_items(body: bytes) -> List[bytes]:
+    """The NDJSON block (action line plus optional source line) of each bulk item."""
+    items = []
+    action = None
+    for line in body.split(b"\n"):
+        if not line.strip():
+            continue
+        if action is None:
+            if action_has_source(line):
+                action = line
+            else:
+                items.append(line + b"\n")
+        else:
+            items.append(action + b"\n" + line + b"\n")
+            action = None
+    if action is not None:
+        items.append(action + b"\n")
+    return items
+
+
+def validate_bulk_items(body: bytes) -> Optional[int]:
+    """The item count of a bulk whose action lines are well formed, else None.
+
+    Only action lines are parsed: a bad source line fails its own item,
+    while a bad action line makes the indexer refuse the whole request.
+    """
+    count = 0
+    expect_source = False
+    for line in body.split(b"\n"):
+        if not line.strip():
+            continue
+        if expect_source:
+            expect_source = False
+            continue
+        try:
+            action = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(action, dict) or len(action) != 1:
+            return None
+        name, meta = next(iter(action.items()))
+        if name not in BULK_ACTIONS or not isinstance(meta, dict):
+            return None
+        count += 1
+        expect_source = name in SOURCE_ACTIONS
+    return None if expect_source else count
+
+
+def accepted_items(body: bytes) -> List[Dict]:
+    """Per-item success entries for a bulk the proxy accepted on the indexer's behalf."""
+    items = []
+    expect_source = False
+    for line in body.split(b"\n"):
+        if not line.strip():
+            continue
+        if expect_source:
+            expect_source = False
+            continue
+        try:
+            action, meta = next(iter(json.loads(line).items()))
+        except (ValueError, StopIteration, AttributeError):
+            action, meta = "index", {}
+        expect_source = action in SOURCE_ACTIONS
+        entry = {"status": 201 if action in ("index", "create") else 200, "result": "accepted"}
+        if isinstance(meta, dict) and "_index" in meta:
+            entry["_index"] = meta["_index"]
+        items.append({action: entry})
+    return items
+
+
+def failed_items(count: int, status: int, reason: str) -> List[Dict]:
+    """Per-item error entries for a sub-batch that never got a bulk response."""
+    error = {"type": "proxy_upstream_exception", "reason": reason}
+    return [{"index": {"status": status, "error": error}} for _ in range(count)]
+
+
+async def post_bulk(resilience, path: str, query: str, headers: Dict, body: bytes, count: int,
+                    item_retry: Optional["BulkItemRetry"] = None, prefer: Optional[str] = None) -> Tuple[int, Dict]:
+    """Send one bulk body upstream; transport failures become per-item errors."""
+    status, data, target = await _post_bulk_once(resilience, path, query, headers, body, count, prefer=prefer)
+    if item_retry is not None and item_retry.enabled and status == 200 and data.get("errors"):
+        data = await item_retry.retry(path, query, headers, body, data, target)
+    return status, data
+
+
+async def _post_bulk_once(resilience, path: str, query: str, headers: Dict, body: bytes, count: int,
+                          avoid: Optional[Set[str]] = None,
+                          prefer: Optional[str] = None) -> Tuple[int, Dict, Optional[str]]:
+    if query:
+        path = f"{path}?{query}"
+    try:
+        call = await resilience.send("POST", path, headers, body, avoid, prefer)
+    except NoHealthyUpstream:
+        return 503, {"errors": True, "items": failed_items(count, 503, "All upstreams are unavailable")}, None
+    except Overloaded as exc:
+        return 429, {"errors": True, "items": failed_items(count, 429, str(exc))}, None
+    except httpx.RequestError:
+        return 502, {"errors": True, "items": failed_items(count, 502, "Failed to connect to upstream indexer")}, None
+
+    resp = call.response
+    try:
+        await resp.aread()
+    except httpx.RequestError as exc:
+        logger.error(f"Upstream Error ({call.target_url}/{path}): {exc}")
+        await call.finish(ok=False)
+        return 502, {"errors": True, "items": failed_items(count, 502, "Failed to connect to upstream indexer")}, None
+    await call.finish()
+
+    try:
+        data = resp.json()
+    except ValueError:
+        data = None
+    if resp.status_code != 200 or not isinstance(data, dict):
+        reason = f"Upstream returned HTTP {resp.status_code}"
+        return (resp.status_code, {"errors": True, "items": failed_items(count, resp.status_code, reason)},
+                call.target_url)
+    return resp.status_code, data, call.target_url
+
+
+class BulkItemRetry:
+    """Re-submit only the `_bulk` items an indexer rejected because it was overloaded.
+
+    Items answered 429 or `(es_)rejected_execution_exception` inside a 200
+    response are sent again as a smaller bulk after a jittered exponential
+    backoff, preferring a different target each round. Their entries are
+    replaced in place, so the client gets one response with the final
+    outcome of every item instead of resending the whole batch.
+    """
+
+    def __init__(self, config_manager, resilience):
+        self.config_manager = config_manager
+        self.resilience = resilience
+        self.responses = 0
+        self.retried = 0
+        self.recovered = 0
+        self.dropped = 0
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.bulk_item_retry
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.max_attempts = int(settings.get("max_attempts", 3))
+        self.backoff = settings.get("backoff_ms", 200) / 1000
+        self.max_backoff = settings.get("max_backoff_ms", 5000) / 1000
+        self.budget = settings.get("budget_s", 15.0)
+
+    @staticmethod
+    def rejected(entry) -> bool:
+        result = next(iter(entry.values()), None) if isinstance(entry, dict) else None
+        if not isinstance(result, dict):
+            return False
+        if result.get("status") == 429:
+            return True
+        error = result.get("error")
+        return isinstance(error, dict) and error.get("type") in REJECTED_TYPES
+
+    async def retry(self, path: str, query: str, headers: Dict, body: bytes, response: Dict,
+                    target: Optional[str]) -> Dict:
+        """Return `response` with its rejected items retried until they succeed or the budget runs out."""
+        items = response.get("items")
+        if not isinstance(items, list):
+            return response
+        pending = [i for i, entry in enumerate(items) if self.rejected(entry)]
+        if not pending:
+            return response
+        blocks = split_bulk_items(body)
+        if len(blocks) != len(items):
+            logger.warning(f"Bulk response has {len(items)} items for {len(blocks)} sent, not retrying rejections")
+            return response
+
+        self.responses += 1
+        items = list(items)
+        started = time.monotonic()
+        deadline = started + self.budget
+        attempt = 0
+        while pending and attempt < self.max_attempts:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if time.monotonic() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+            self.retried += len(pending)
+            status, data, served_by = await _post_bulk_once(
+                self.resilience, path, query, headers, b"".join(blocks[i] for i in pending), len(pending),
+                {target} if target else None)
+            retried = data.get("items")
+            if status != 200 or not isinstance(retried, list) or len(retried) != len(pending):
+                # The whole retry was refused; the items keep their rejection and wait another round
+                continue
+            target = served_by
+            still = []
+            for index, entry in zip(pending, retried):
+                items[index] = entry
+                if self.rejected(entry):
+                    still.append(index)
+            self.recovered += len(pending) - len(still)
+            pending = still
+
+        if pending:
+            self.dropped += len(pending)
+            logger.warning(f"{len(pending)} bulk items still rejected after {attempt} retries, returning them to the client")
+        merged = dict(response, items=items)
+        merged["errors"] = any(isinstance(next(iter(e.values()), None), dict) and "error" in next(iter(e.values()))
+                               for e in items)
+        merged["took"] = response.get("took", 0) + int((time.monotonic() - started) * 1000)
+        return merged
+
+    async def complete(self, path: str, query: str, headers: Dict, body: bytes, status: int, content: bytes,
+                       target: Optional[str]) -> Optional[bytes]:
+        """The merged body for a `_bulk` response relayed as is, or None if nothing was retried."""
+        if status != 200 or (b'"errors":true' not in content and b'"errors": true' not in content):
+            return None
+        try:
+            response = json.loads(content)
+        except ValueError:
+            return None
+        if not isinstance(response, dict):
+            return None
+        merged = await self.retry(path, query, headers, body, response, target)
+        if merged is response:
+            return None
+        return json.dumps(merged, separators=(",", ":")).encode()
+
+    def metric_families(self):
+        yield ("wazuh_proxy_bulk_items_retried_total", "counter", "Rejected bulk items re-submitted by the proxy.",
+               [({}, self.retried)])
+        yield ("wazuh_proxy_bulk_items_recovered_total", "counter", "Rejected bulk items that succeeded on retry.",
+               [({}, self.recovered)])
+        yield ("wazuh_proxy_bulk_items_dropped_total", "counter",
+               "Rejected bulk items returned to the client after the retry budget ran out.", [({}, self.dropped)])
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "responses_with_rejections": self.responses,
+            "items_retried": self.retried,
+            "items_recovered": self.recovered,
+            "items_dropped": self.dropped,
+        }
+
+
+def merge_bulk_responses(results: List[Tuple[int, Dict]], took_ms: int) -> Dict:
+    """Concatenate sub-batch results (already in item order) into one bulk response."""
+    merged = {"took": took_ms, "errors": False}
+    items = []
+    has_items = False
+    for _, body in results:
+        if body.get("errors"):
+            merged["errors"] = True
+        if "items" in body:
+            has_items = True
+            items.extend(body["items"])
+    if has_items:
+        merged["items"] = items
+    return merged
+
+
+class BulkFanout:
+    """Split large `_bulk` payloads into sub-batches spread over all healthy targets."""
+
+    def __init__(self, config_manager, resilience, item_retry: Optional[BulkItemRetry] = None):
+        self.config_manager = config_manager
+        self.resilience = resilience
+        self.item_retry = item_retry
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.bulk_fanout
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.chunk_bytes = int(settings.get("chunk_size_mb", 10) * MB)
+        self.concurrency = settings.get("concurrency", 4)
+
+    def applies(self, method: str, path: str, headers) -> bool:
+        if not self.enabled or method not in ("POST", "PUT") or not is_bulk_path(path):
+            return False
+        if headers.get("content-encoding"):
+            return False
+        # Bulks that fit in one sub-batch take the plain proxy path
+        declared = headers.get("content-length", "")
+        return not (declared.isdigit() and int(declared) <= self.chunk_bytes)
+
+    async def handle(self, stream: AsyncIterator[bytes], path: str, query: str, headers: Dict,
+                     buffer_first: bool = False) -> Dict:
+        """Send the bulk as sub-batches and merge their responses.
+
+        Sub-batches normally go out while the body is still being read. With
+        `buffer_first` (a size limit applies but the body declared no length)
+        the whole body is read first, so one cut off by the limit is refused
+        before any of its items have been indexed.
+        """
+        chunk_size = self.chunk_bytes
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.monotonic()
+
+        tasks = []
+        batch: List[bytes] = []
+        batch_size = 0
+
+        async def dispatch(body: bytes, count: int):
+            try:
+                return await self._send_batch(body, count, path, query, headers)
+            finally:
+                semaphore.release()
+
+        async def flush():
+            nonlocal batch, batch_size
+            # Wait for a free slot before reading further, so memory stays bounded
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(dispatch(b"".join(batch), len(batch))))
+            batch, batch_size = [], 0
+
+        items = iter_bulk_items(stream)
+        if buffer_first:
+            read = [item async for item in items]
+
+            async def replay():
+                for item in read:
+                    yield item
+            items = replay()
+
+        try:
+            async for item in items:
+                batch.append(item)
+                batch_size += len(item)
+                if batch_size >= chunk_size:
+                    await flush()
+            if batch:
+                await flush()
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        took_ms = int((time.monotonic() - started) * 1000)
+        logger.debug(f"Bulk fan-out: {len(tasks)} sub-batches in {took_ms}ms")
+        return merge_bulk_responses(results, took_ms)
+
+    async def _send_batch(self, body: bytes, count: int, path: str, query: str, headers: Dict) -> Tuple[int, Dict]:
+        return await post_bulk(self.resilience, path, query, headers, body, count, self.item_retry)
+
+
+class _CoalesceBuffer:
+    def __init__(self):
+        self.bodies: List[bytes] = []
+        self.callers: List[Tuple[asyncio.Future, int]] = []
+        self.size = 0
+        self.opened = time.monotonic()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class BulkCoalescer:
+    """Merge many small `_bulk` requests into one upstream call.
+
+    Bodies are buffered per (path, query, credentials) and flushed once the
+    buffer reaches `max_batch_mb` or its oldest caller has waited `max_delay_ms`.
+    The upstream response is split back into one response per caller, by the
+    item counts taken when each body was validated; a body with a malformed
+    action line is not merged and goes upstream on its own.
+    """
+
+    def __init__(self, config_manager, resilience, item_retry: Optional[BulkItemRetry] = None):
+        self.config_manager = config_manager
+        self.resilience = resilience
+        self.item_retry = item_retry
+        self.buffers: Dict[Tuple, _CoalesceBuffer] = {}
+        self.requests = 0
+        self.flushes = 0
+        self.flushed_bytes = 0
+        self.flush_latency_ms = 0.0
+        self.max_flush_latency_ms = 0.0
+        self.timeouts = 0
+        self.malformed = 0
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.bulk_coalesce
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.max_request_bytes = settings.get("max_request_mb", 1) * MB
+        self.patterns = tuple(settings.get("paths", ["/_bulk"]))
+
+    def applies(self, method: str, path: str, headers) -> bool:
+        if not self.enabled or method not in ("POST", "PUT") or not is_bulk_path(path):
+            return False
+        if headers.get("content-encoding"):
+            return False
+        declared = headers.get("content-length", "")
+        if not declared.isdigit() or int(declared) > self.max_request_bytes:
+            return False
+        return any(fnmatch.fnmatchcase("/" + path, pattern) for pattern in self.patterns)
+
+    async def submit(self, body: bytes, path: str, query: str, headers: Dict) -> Optional[Dict]:
+        """This caller's share of a merged bulk; None if the body must be proxied on its own."""
+        settings = self._settings()
+        count = validate_bulk_items(body)
+        if count is None:
+            self.malformed += 1
+            return None
+        if count == 0:
+            return {"took": 0, "errors": False, "items": []}
+        if not body.endswith(b"\n"):
+            body += b"\n"
+
+        key = (path, query, headers.get("authorization"))
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = _CoalesceBuffer()
+            loop = asyncio.get_running_loop()
+            buf.timer = loop.call_later(settings.get("max_delay_ms", 200) / 1000, self._flush, key, buf)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, count)
+        buf.bodies.append(body)
+        buf.callers.append(entry)
+        buf.size += len(body)
+        self.requests += 1
+        if buf.size >= settings.get("max_batch_mb", 5) * MB:
+            self._flush(key, buf)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=settings.get("max_wait_ms", 10000) / 1000)
+        except asyncio.TimeoutError:
+            if self.buffers.get(key) is not buf:
+                # Already sent upstream: only its outcome tells the client whether a retry would duplicate items
+                return await future
+            # Withdrawn before it was sent, so the 504 is accurate and a retry indexes nothing twice
+            self._withdraw(key, buf, entry, body)
+            self.timeouts += 1
+            return {"took": 0, "errors": True, "items": failed_items(count, 504, "Coalesced bulk timed out in proxy")}
+
+    def _withdraw(self, key: Tuple, buf: _CoalesceBuffer, entry: Tuple[asyncio.Future, int], body: bytes):
+        index = next(i for i, caller in enumerate(buf.callers) if caller is entry)
+        del buf.callers[index]
+        del buf.bodies[index]
+        buf.size -= len(body)
+        if not buf.callers:
+            if buf.timer is not None:
+                buf.timer.cancel()
+            del self.buffers[key]
+
+    def _flush(self, key: Tuple, buf: _CoalesceBuffer):
+        if self.buffers.get(key) is not buf:
+            return
+        del self.buffers[key]
+        if buf.timer is not None:
+            buf.timer.cancel()
+        path, query, _ = key
+        headers = {"content-type": "application/x-ndjson"}
+        if key[2]:
+            headers["authorization"] = key[2]
+        asyncio.get_running_loop().create_task(self._send(buf, path, query, headers))
+
+    async def _send(self, buf: _CoalesceBuffer, path: str, query: str, headers: Dict):
+        body = b"".join(buf.bodies)
+        total = sum(count for _, count in buf.callers)
+        started = time.monotonic()
+        try:
+            _, result = await post_bulk(self.resilience, path, query, headers, body, total, self.item_retry)
+        except Exception as exc:
+            # Callers past max_wait_ms wait for this outcome, so there must always be one
+            logger.error(f"Coalesced bulk failed: {exc}")
+            result = {"errors": True, "items": failed_items(total, 500, "Internal proxy error")}
+        elapsed = (time.monotonic() - started) * 1000
+
+        self.flushes += 1
+        self.flushed_bytes += len(body)
+        self.flush_latency_ms += elapsed
+        self.max_flush_latency_ms = max(self.max_flush_latency_ms, elapsed)
+
+        items = result.get("items")
+        if items is not None and len(items) != total:
+            items = failed_items(total, 502, "Could not split coalesced bulk response")
+        took = result.get("took", int(elapsed))
+        offset = 0
+        for future, count in buf.callers:
+            if future.done():
+                offset += count
+                continue
+            if items is None:
+                # filter_path stripped the items, only the overall flag is left
+                future.set_result({"took": took, "errors": bool(result.get("errors"))})
+            else:
+                part = items[offset:offset + count]
+                errors = any(next(iter(item.values()), {}).get("error") for item in part)
+                future.set_result({"took": took, "errors": errors, "items": part})
+            offset += count
+
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "flushes": self.flushes,
+            "coalescing_ratio": round(self.requests / self.flushes, 2) if self.flushes else 0.0,
+            "avg_batch_bytes": self.flushed_bytes // self.flushes if self.flushes else 0,
+            "avg_flush_latency_ms": round(self.flush_latency_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_latency_ms": round(self.max_flush_latency_ms, 2),
+            "caller_timeouts": self.timeouts,
+            "malformed_sent_alone": self.malformed,
+            "pending_buffers": len(self.buffers),
+        }
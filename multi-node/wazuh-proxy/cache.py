@@ -0,0 +1,163 @@
+import asyncio
+import fnmatch
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+CACHEABLE_STATUSES = frozenset((200, 404))
+
+
+class CachedResponse:
+    __slots__ = ("status", "headers", "body", "etag", "expires", "size")
+
+    def __init__(self, status: int, headers: List[Tuple[str, str]], body: bytes, ttl: float):
+        self.status = status
+        self.body = body
+        self.etag = next((v for k, v in headers if k.lower() == "etag"), None)
+        if self.etag is None:
+            self.etag = 'W/"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+            headers = headers + [("etag", self.etag)]
+        self.headers = headers
+        self.expires = time.monotonic() + ttl
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers) + 128
+
+
+class CacheRule:
+    def __init__(self, pattern: str, ttl: float):
+        self.pattern = pattern
+        self.regex = re.compile(fnmatch.translate(pattern))
+        self.ttl = ttl
+
+
+class ResponseCache:
+    """TTL + LRU cache for idempotent metadata reads, with in-flight coalescing.
+
+    Concurrent misses for the same key wait on a single upstream call. Writes
+    to a cached resource (or a sub-resource of it) invalidate its entries.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.entries: "OrderedDict[Tuple, CachedResponse]" = OrderedDict()
+        self.inflight: Dict[Tuple, asyncio.Future] = {}
+        self.rules: List[CacheRule] = []
+        self.enabled = False
+        self.max_bytes = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rebuild()
+
+    def rebuild(self):
+        settings = self.config_manager.snapshot.cache
+        self.enabled = bool(settings.get("enabled", False))
+        self.max_bytes = int(settings.get("max_memory_mb", 64) * MB)
+        default_ttl = settings.get("default_ttl", 30)
+        self.rules = [CacheRule(r["pattern"], r.get("ttl", default_ttl)) for r in settings.get("rules", [])]
+        self.clear()
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def rule_for(self, path: str) -> Optional[CacheRule]:
+        if not self.enabled:
+            return None
+        for rule in self.rules:
+            if rule.regex.match(path):
+                return rule
+        return None
+
+    @staticmethod
+    def make_key(method: str, path: str, query: str, headers) -> Tuple:
+        # Responses may depend on the caller's credentials
+        return (method, path, query, headers.get("authorization"))
+
+    async def get_or_load(self, key: Tuple, rule: CacheRule,
+                          loader: Callable[[], Awaitable[Tuple[int, List[Tuple[str, str]], bytes]]]) -> CachedResponse:
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._remove(key)
+
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            status, headers, body = await loader()
+            entry = CachedResponse(status, headers, body, rule.ttl)
+            if status in CACHEABLE_STATUSES:
+                self._store(key, entry)
+            future.set_result(entry)
+            return entry
+        except BaseException as exc:
+            # Followers must not see the leader's cancellation as their own
+            error = exc if isinstance(exc, Exception) else RuntimeError("Cache load was cancelled")
+            future.set_exception(error)
+            # Mark the exception retrieved so the loop does not warn when nobody waits
+            future.exception()
+            raise
+        finally:
+            del self.inflight[key]
+
+    def _store(self, key: Tuple, entry: CachedResponse):
+        if entry.size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def invalidate(self, path: str):
+        """Drop cached reads of `path`, its sub-resources and its parent collections."""
+        if not self.entries or self.rule_for(path) is None:
+            return
+        prefix = path.rstrip("/") + "/"
+        stale = [key for key in self.entries
+                 if key[1] == path or key[1].startswith(prefix)
+                 or (key[1] != "/" and path.startswith(key[1].rstrip("/") + "/"))]
+        for key in stale:
+            self._remove(key)
+        self.invalidations += len(stale)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "not_modified": self.not_modified,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
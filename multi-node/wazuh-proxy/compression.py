@@ -0,0 +1,356 @@
+import logging
+import time
+import zlib
+from typing import AsyncIterator, Dict, Optional
+
+logger = logging.getLogger("wazuh-proxy")
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Upper bound on the output of one decompress call, so a small chunk that
+# inflates enormously is still split up and checked against the size limit.
+DECODE_STEP = 1024 * 1024
+ZLIB_DECOMPRESSOR = type(zlib.decompressobj())
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/yaml")
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _decoder(encoding: str):
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "zstd" and ZSTD_AVAILABLE:
+        return zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+def _encoder(encoding: str, level: int):
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "zstd" and ZSTD_AVAILABLE:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return None
+
+
+def supported(encoding: str) -> bool:
+    return encoding in ("gzip", "deflate") or (encoding == "zstd" and ZSTD_AVAILABLE)
+
+
+class StageStats:
+    """Byte and CPU accounting for one place where the proxy (de)compresses."""
+
+    __slots__ = ("operations", "bytes_in", "bytes_out", "cpu_seconds")
+
+    def __init__(self):
+        self.operations = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "operations": self.operations,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            # Compressed / uncompressed, whichever way the stage goes
+            "ratio": round(min(self.bytes_in, self.bytes_out) / max(self.bytes_in, self.bytes_out), 3)
+            if self.bytes_in and self.bytes_out else None,
+            "cpu_seconds": round(self.cpu_seconds, 3),
+        }
+
+
+class EncodingStream:
+    """Compress a streamed body chunk by chunk on its way upstream.
+
+    Exposes `started` like `limited_stream` so the retry logic can tell
+    whether the body was consumed.
+    """
+
+    def __init__(self, stream, encoder, stage: StageStats):
+        self.stream = stream
+        self.encoder = encoder
+        self.stage = stage
+        self.started = False
+        self.done = False
+
+    def __aiter__(self):
+        self.iterator = self.stream.__aiter__()
+        return self
+
+    async def __anext__(self) -> bytes:
+        self.started = True
+        while not self.done:
+            try:
+                chunk = await self.iterator.__anext__()
+            except StopAsyncIteration:
+                self.done = True
+                cpu = time.thread_time()
+                out = self.encoder.flush()
+                self.stage.cpu_seconds += time.thread_time() - cpu
+                self.stage.bytes_out += len(out)
+                self.stage.operations += 1
+                return out
+            cpu = time.thread_time()
+            out = self.encoder.compress(chunk)
+            self.stage.cpu_seconds += time.thread_time() - cpu
+            self.stage.bytes_in += len(chunk)
+            self.stage.bytes_out += len(out)
+            if out:
+                return out
+        raise StopAsyncIteration
+
+
+class CompressionLayer:
+    """Decode compressed request bodies, recompress towards upstreams and
+    compress responses for clients that accept it."""
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.request_decode = StageStats()
+        self.upstream_encode = StageStats()
+        self.response_encode = StageStats()
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.compression
+
+    def rebuild(self):
+        """Precompute the settings consulted on every request."""
+        settings = self._settings()
+        self.decode_requests = bool(settings.get("decode_requests", True))
+        self.upstream_accept = settings.get("upstream_accept_encoding", "gzip") or None
+        if settings.get("compress_responses", True):
+            self.response_encodings = tuple(e for e in settings.get("response_encodings", ["zstd", "gzip"])
+                                            if _encoder(e, 1) is not None)
+        else:
+            self.response_encodings = ()
+
+    def decodable(self, headers) -> Optional[str]:
+        """The request's content-encoding if the proxy should decode it."""
+        encoding = headers.get("content-encoding", "").strip().lower()
+        if not encoding or encoding == "identity" or not self.decode_requests:
+            return None
+        return encoding if supported(encoding) else None
+
+    async def decode_stream(self, stream, encoding: str) -> AsyncIterator[bytes]:
+        decoder = _decoder(encoding)
+        stage = self.request_decode
+        stage.operations += 1
+        try:
+            async for chunk in stream:
+                stage.bytes_in += len(chunk)
+                for out in self._inflate(decoder, chunk):
+                    stage.bytes_out += len(out)
+                    yield out
+            tail = decoder.flush() if hasattr(decoder, "flush") else b""
+            if tail:
+                stage.bytes_out += len(tail)
+                yield tail
+        except (zlib.error, ValueError) as exc:
+            raise DecodeError(f"Malformed {encoding} request body: {exc}")
+        except Exception as exc:
+            if ZSTD_AVAILABLE and isinstance(exc, zstandard.ZstdError):
+                raise DecodeError(f"Malformed {encoding} request body: {exc}")
+            raise
+
+    def _inflate(self, decoder, chunk: bytes):
+        cpu = time.thread_time()
+        if isinstance(decoder, ZLIB_DECOMPRESSOR):
+            data = chunk
+            while data:
+                out = decoder.decompress(data, DECODE_STEP)
+                data = decoder.unconsumed_tail
+                self.request_decode.cpu_seconds += time.thread_time() - cpu
+                if out:
+                    yield out
+                cpu = time.thread_time()
+        else:
+            out = decoder.decompress(chunk)
+            self.request_decode.cpu_seconds += time.thread_time() - cpu
+            if out:
+                yield out
+
+    def decode_body(self, body: bytes, encoding: str, limit: Optional[int]) -> bytes:
+        """Decode a buffered body, stopping once it exceeds `limit` bytes."""
+        decoder = _decoder(encoding)
+        stage = self.request_decode
+        stage.operations += 1
+        stage.bytes_in += len(body)
+        parts = []
+        size = 0
+        try:
+            for out in self._inflate(decoder, body):
+                parts.append(out)
+                size += len(out)
+                if limit is not None and size > limit:
+                    break
+        except (zlib.error, ValueError) as exc:
+            raise DecodeError(f"Malformed {encoding} request body: {exc}")
+        except Exception as exc:
+            if ZSTD_AVAILABLE and isinstance(exc, zstandard.ZstdError):
+                raise DecodeError(f"Malformed {encoding} request body: {exc}")
+            raise
+        stage.bytes_out += size
+        return b"".join(parts)
+
+    def encode_upstream(self, headers: Dict, content):
+        """Recompress a request body for the upstream; returns (headers, content)."""
+        settings = self._settings()
+        encoding = settings.get("upstream_encoding", "identity")
+        if encoding == "identity" or content is None or "content-encoding" in headers:
+            return headers, content
+        level = settings.get("upstream_level", 3 if encoding == "zstd" else 6)
+        encoder = _encoder(encoding, level)
+        if encoder is None:
+            return headers, content
+        min_size = settings.get("min_size_kb", 16) * 1024
+        if isinstance(content, bytes):
+            if len(content) < min_size:
+                return headers, content
+            cpu = time.thread_time()
+            encoded = encoder.compress(content) + encoder.flush()
+            stage = self.upstream_encode
+            stage.cpu_seconds += time.thread_time() - cpu
+            stage.operations += 1
+            stage.bytes_in += len(content)
+            stage.bytes_out += len(encoded)
+            content = encoded
+        else:
+            declared = headers.get("content-length", "")
+            if declared.isdigit() and int(declared) < min_size:
+                return headers, content
+            content = EncodingStream(content, encoder, self.upstream_encode)
+        headers = {k: v for k, v in headers.items() if k.lower() != "content-length"}
+        headers["content-encoding"] = encoding
+        return headers, content
+
+    def upstream_accept_encoding(self) -> Optional[str]:
+        """Accept-Encoding to send upstream, so responses cross the network compressed."""
+        return self.upstream_accept
+
+    def response_encoding(self, accept_encoding: str) -> Optional[str]:
+        """Pick the configured response encoding if the client accepts it."""
+        if not self.response_encodings:
+            return None
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        for encoding in self.response_encodings:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def stats(self) -> Dict:
+        return {
+            "zstd_available": ZSTD_AVAILABLE,
+            "request_decode": self.request_decode.stats(),
+            "upstream_encode": self.upstream_encode.stats(),
+            "response_encode": self.response_encode.stats(),
+        }
+
+    def metric_families(self):
+        stages = {"request_decode": self.request_decode, "upstream_encode": self.upstream_encode,
+                  "response_encode": self.response_encode}
+        yield ("wazuh_proxy_compression_bytes_total", "counter", "Bytes entering and leaving each (de)compression stage.",
+               [({"stage": name, "side": side}, getattr(stage, f"bytes_{side}"))
+                for name, stage in stages.items() for side in ("in", "out")])
+        yield ("wazuh_proxy_compression_cpu_seconds_total", "counter", "CPU time spent (de)compressing.",
+               [({"stage": name}, round(stage.cpu_seconds, 6)) for name, stage in stages.items()])
+
+
+class CompressionMiddleware:
+    """Raw ASGI middleware compressing responses the client accepts compressed.
+
+    Responses that are already encoded, too small or not text-like pass
+    through untouched. Streamed responses are compressed as they flow.
+    """
+
+    def __init__(self, app, compression: CompressionLayer):
+        self.app = app
+        self.compression = compression
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = self.compression.response_encoding(accept) if accept else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        settings = self.compression._settings()
+        min_size = settings.get("min_size_kb", 16) * 1024
+        level = settings.get("response_level", 3 if encoding == "zstd" else 5)
+        stage = self.compression.response_encode
+        state = {"start": None, "encoder": None}
+
+        async def compressing_send(message):
+            if message["type"] == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                length = headers.get(b"content-length")
+                eligible = (b"content-encoding" not in headers
+                            and content_type.startswith(COMPRESSIBLE_TYPES)
+                            and (length is None or int(length) >= min_size))
+                if not eligible:
+                    await send(message)
+                    return
+                state["start"] = message
+                state["encoder"] = _encoder(encoding, level)
+                return
+            encoder = state["encoder"]
+            if message["type"] != "http.response.body" or encoder is None:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            start = state["start"]
+            if start is not None:
+                state["start"] = None
+                if not more and len(body) < min_size:
+                    # Small body without a declared length: not worth it
+                    state["encoder"] = None
+                    await send(start)
+                    await send(message)
+                    return
+                headers = [(k, v) for k, v in start.get("headers", [])
+                           if k.lower() not in (b"content-length", b"content-encoding")]
+                headers.append((b"content-encoding", encoding.encode()))
+                headers.append((b"vary", b"Accept-Encoding"))
+                start = dict(start, headers=headers)
+                if not more:
+                    stage.operations += 1
+                    cpu = time.thread_time()
+                    out = encoder.compress(body) + encoder.flush()
+                    stage.cpu_seconds += time.thread_time() - cpu
+                    stage.bytes_in += len(body)
+                    stage.bytes_out += len(out)
+                    start["headers"].append((b"content-length", str(len(out)).encode()))
+                    await send(start)
+                    await send({"type": "http.response.body", "body": out})
+                    return
+                stage.operations += 1
+                await send(start)
+
+            cpu = time.thread_time()
+            out = encoder.compress(body)
+            if not more:
+                out += encoder.flush()
+            stage.cpu_seconds += time.thread_time() - cpu
+            stage.bytes_in += len(body)
+            stage.bytes_out += len(out)
+            await send({"type": "http.response.body", "body": out, "more_body": more})
+
+        await self.app(scope, receive, compressing_send)
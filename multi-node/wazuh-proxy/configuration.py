@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import os
+import ssl
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import httpx
+import yaml
+from watchfiles import awatch
+
+from guardrails import SearchGuard
+from policy import PolicyIndex
+from resilience import CircuitBreaker
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Editors and ConfigMap updates touch the file several times in a row
+RELOAD_DEBOUNCE_MS = 1000
+
+
+class ConfigError(Exception):
+    """A configuration that fails validation; the running one stays in place."""
+
+
+class Target(NamedTuple):
+    url: str
+    weight: int
+    node_name: Optional[str]
+
+
+def _section(parent: Dict, name: str) -> Dict:
+    """A mapping section of the YAML; absent or emptied-out sections are {}."""
+    value = parent.get(name)
+    if value is None:
+        return {}
+    if not isinstance(value, dict):
+        raise ConfigError(f"'{name}' must be a mapping, got {type(value).__name__}")
+    return value
+
+
+def _parse_targets(upstream: Dict) -> Tuple[Target, ...]:
+    targets = []
+    seen = set()
+    for entry in upstream.get("targets") or []:
+        url = entry.get("url") if isinstance(entry, dict) else None
+        if not isinstance(url, str) or not url.startswith(("http://", "https://")):
+            raise ConfigError(f"Upstream target without a valid http(s) url: {entry}")
+        url = url.rstrip("/")
+        if url in seen:
+            raise ConfigError(f"Upstream target listed twice: {url}")
+        seen.add(url)
+        try:
+            weight = max(1, int(entry.get("weight", 1)))
+        except (TypeError, ValueError):
+            raise ConfigError(f"Upstream target {url} has an invalid weight: {entry.get('weight')}")
+        targets.append(Target(url, weight, entry.get("node_name")))
+    return tuple(targets)
+
+
+def _ssl_context(mtls: Dict) -> ssl.SSLContext:
+    ca_cert = mtls.get("ca_cert")
+    client_cert = mtls.get("client_cert")
+    client_key = mtls.get("client_key")
+
+    if not ca_cert:
+        logger.warning("No CA cert found in config, using default cert verification.")
+        context = ssl.create_default_context()
+    else:
+        context = ssl.create_default_context(cafile=ca_cert)
+        if client_cert and client_key and os.path.exists(client_cert) and os.path.exists(client_key):
+            context.load_cert_chain(certfile=client_cert, keyfile=client_key)
+            logger.info("mTLS client certificate loaded.")
+
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+class RuntimeConfig:
+    """One validated configuration generation, with everything derived from it.
+
+    Built completely before it is installed, so a bad file never replaces a
+    working one, and read-only afterwards: a reload builds a new instance
+    and `ConfigManager` swaps the reference. Subsystems take what they need
+    from the sections below in their `rebuild()` callbacks; `raw` is the
+    parsed YAML as published to workers.
+    """
+
+    __slots__ = ("version", "raw", "upstream", "targets", "pool", "timeout", "hedging", "health_check",
+                 "policies", "search_guardrails", "ssl_context", "stream_requests", "stream_responses", "compression",
+                 "bulk_fast_path", "bulk_fanout", "bulk_coalesce", "bulk_item_retry", "bulk_shard_routing", "cache",
+                 "metrics", "rate_limit", "spool", "access_log", "admission", "priority", "timing", "profiling",
+                 "mirror")
+
+    def __init__(self, raw: Dict, version: int):
+        if not isinstance(raw, dict):
+            raise ConfigError("The configuration must be a mapping")
+        set_ = super().__setattr__
+        set_("version", version)
+        set_("raw", raw)
+
+        upstream = _section(raw, "upstream")
+        set_("upstream", upstream)
+        set_("targets", _parse_targets(upstream))
+        pool = dict(_section(upstream, "pool"))
+        pool.setdefault("timeout", upstream.get("timeout", 30.0))
+        set_("pool", pool)
+        try:
+            set_("timeout", httpx.Timeout(pool["timeout"]))
+        except (TypeError, ValueError) as e:
+            raise ConfigError(f"Invalid upstream timeout: {e}")
+        try:
+            CircuitBreaker.parse_settings(_section(upstream, "circuit_breaker"))
+        except (TypeError, ValueError) as e:
+            raise ConfigError(f"Invalid circuit breaker settings: {e}")
+        set_("hedging", _section(upstream, "hedging"))
+        set_("health_check", _section(upstream, "health_check"))
+
+        security = _section(raw, "security")
+        try:
+            set_("policies", PolicyIndex(security.get("policies") or []))
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ConfigError(f"Invalid security policies: {e}")
+        try:
+            set_("search_guardrails", SearchGuard(_section(security, "search_guardrails")))
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ConfigError(f"Invalid search guardrails: {e}")
+        try:
+            set_("ssl_context", _ssl_context(_section(security, "mtls")))
+        except (OSError, ssl.SSLError) as e:
+            raise ConfigError(f"Cannot build the upstream TLS context: {e}")
+
+        streaming = _section(raw, "streaming")
+        set_("stream_requests", bool(streaming.get("requests", False)))
+        set_("stream_responses", bool(streaming.get("responses", False)))
+        bulk = _section(raw, "bulk")
+        set_("bulk_fast_path", bool(bulk.get("fast_path", True)))
+        set_("bulk_fanout", _section(bulk, "fanout"))
+        set_("bulk_coalesce", _section(bulk, "coalesce"))
+        set_("bulk_item_retry", _section(bulk, "item_retry"))
+        set_("bulk_shard_routing", _section(bulk, "shard_routing"))
+        for name in ("compression", "cache", "metrics", "rate_limit", "spool", "access_log", "admission",
+                     "priority", "timing", "profiling", "mirror"):
+            set_(name, _section(raw, name))
+        classes = _section(self.priority, "classes")
+        for name in classes:
+            _section(classes, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuntimeConfig is read-only; build a new one")
+
+
+class ConfigManager:
+    def __init__(self, config_path: str):
+        self.config_path = config_path
+        self.snapshot: Optional[RuntimeConfig] = None
+        self.digest: Optional[str] = None
+        self.rejected = 0
+        self.reload_callbacks = []
+        self.load_config()
+        if self.snapshot is None:
+            logger.error("Starting without a valid configuration, using defaults")
+            self.snapshot = RuntimeConfig({}, 0)
+
+    @property
+    def version(self) -> int:
+        return self.snapshot.version if self.snapshot is not None else 0
+
+    @property
+    def config(self) -> Dict:
+        return self.snapshot.raw
+
+    @property
+    def ssl_context(self) -> ssl.SSLContext:
+        return self.snapshot.ssl_context
+
+    def load_config(self):
+        try:
+            with open(self.config_path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            logger.error(f"Failed to load configuration: {e}")
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == self.digest:
+            return
+        try:
+            config = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            self.rejected += 1
+            logger.error(f"Failed to parse configuration, keeping version {self.version}: {e}")
+            return
+        if self.apply(config):
+            self.digest = digest
+            logger.info(f"Loaded configuration from {self.config_path} (version {self.version})")
+
+    def apply(self, config: Dict) -> bool:
+        """Validate a parsed configuration, swap it in and notify the subsystems.
+
+        Returns False, leaving the current configuration in place, if it
+        does not validate or a subsystem fails to rebuild from it; in the
+        latter case every subsystem is rebuilt from the previous snapshot.
+        """
+        try:
+            snapshot = RuntimeConfig(config, self.version + 1)
+        except ConfigError as e:
+            self.rejected += 1
+            logger.error(f"Invalid configuration, keeping version {self.version}: {e}")
+            return False
+        previous = self.snapshot
+        self.snapshot = snapshot
+        if self._notify() or previous is None:
+            return True
+        self.rejected += 1
+        logger.error(f"Rolling back to configuration version {previous.version}")
+        self.snapshot = previous
+        if not self._notify():
+            logger.error(f"Failed to restore configuration version {previous.version}, some settings may be stale")
+        return False
+
+    def _notify(self) -> bool:
+        """Run every reload callback on the current snapshot; returns whether all of them succeeded."""
+        ok = True
+        for callback in self.reload_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                ok = False
+                logger.error(f"Failed to apply configuration version {self.snapshot.version} "
+                             f"in {callback.__qualname__}: {e}")
+        return ok
+
+    async def watch_config(self):
+        # Watch the directory: editors and ConfigMap updates replace the file instead of writing to it
+        path = os.path.abspath(self.config_path)
+        names = {os.path.basename(path), "..data"}
+        async for changes in awatch(os.path.dirname(path), debounce=RELOAD_DEBOUNCE_MS, recursive=False,
+                                    watch_filter=lambda change, changed: os.path.basename(changed) in names):
+            logger.info("Configuration change detected, reloading...")
+            self.load_config()
@@ -0,0 +1,215 @@
+import asyncio
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+from metrics import merge_expositions
+
+logger = logging.getLogger("wazuh-proxy")
+
+STATE_DIR_ENV = "WAZUH_PROXY_STATE_DIR"
+WORKER_ENV = "WAZUH_PROXY_WORKER"
+SNAPSHOT_FILE = "state.snapshot"
+METRICS_PATTERN = "metrics-*.prom"
+SNAPSHOT_SIZE = 4 * 1024 * 1024
+# sequence number (odd while the supervisor is writing), payload length
+SNAPSHOT_HEADER = struct.Struct("<QQ")
+PUBLISH_INTERVAL = 0.5
+POLL_INTERVAL = 0.25
+METRICS_EXPORT_INTERVAL = 5.0
+
+
+def state_directory() -> Optional[str]:
+    """Directory shared with the supervisor; set only in multi-worker mode."""
+    return os.getenv(STATE_DIR_ENV) or None
+
+
+def worker_id() -> Optional[str]:
+    return os.getenv(WORKER_ENV) or None
+
+
+class StateSnapshot:
+    """A JSON document in a memory-mapped file, published under a seqlock.
+
+    The supervisor is the only writer. Readers copy the payload and retry if
+    the sequence number was odd or moved while they read, so they never see
+    a torn document and never make the writer wait.
+    """
+
+    def __init__(self, path: str, create: bool = False, size: int = SNAPSHOT_SIZE):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o600)
+        if create and os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.size = os.fstat(self.fd).st_size
+        self.mm = mmap.mmap(self.fd, self.size)
+
+    def sequence(self) -> int:
+        return SNAPSHOT_HEADER.unpack_from(self.mm, 0)[0]
+
+    def publish(self, state: Dict) -> bool:
+        payload = json.dumps(state, separators=(",", ":"), default=str).encode()
+        start = SNAPSHOT_HEADER.size
+        if start + len(payload) > self.size:
+            logger.error(f"State snapshot of {len(payload)} bytes does not fit in {self.path}")
+            return False
+        seq, length = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+        # An odd sequence is left behind by a writer that died mid-publish
+        seq += 1 if seq % 2 else 2
+        SNAPSHOT_HEADER.pack_into(self.mm, 0, seq - 1, length)
+        self.mm[start:start + len(payload)] = payload
+        SNAPSHOT_HEADER.pack_into(self.mm, 0, seq, len(payload))
+        return True
+
+    def read(self, attempts: int = 100) -> Optional[Tuple[int, Dict]]:
+        """Return (sequence, state), or None if nothing consistent could be read."""
+        start = SNAPSHOT_HEADER.size
+        for _ in range(attempts):
+            seq, length = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+            if seq == 0:
+                return None
+            if seq % 2 == 0 and start + length <= self.size:
+                payload = self.mm[start:start + length]
+                if self.sequence() == seq:
+                    return seq, json.loads(payload)
+            time.sleep(0)
+        return None
+
+    def close(self):
+        try:
+            self.mm.close()
+            os.close(self.fd)
+        except (ValueError, OSError):
+            pass
+
+
+class ControlPlane:
+    """Supervisor side of multi-worker mode.
+
+    Watches the config file and runs the health monitor once for the whole
+    host, and publishes the resulting view (config, health, degraded nodes,
+    cluster state) for the workers.
+    """
+
+    def __init__(self, config_manager, upstream_manager, directory: str):
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.snapshot = StateSnapshot(os.path.join(directory, SNAPSHOT_FILE), create=True)
+        self.generation = 1
+        self.published = 0
+        self.last: Optional[Dict] = None
+        config_manager.reload_callbacks.append(self._config_changed)
+
+    def _config_changed(self):
+        self.generation += 1
+
+    def state(self) -> Dict:
+        manager = self.upstream_manager
+        return {
+            "generation": self.generation,
+            "config": self.config_manager.config,
+            "health": dict(manager.health_status),
+            "degraded": sorted(manager.degraded),
+            "monitor": manager.monitor.stats(),
+        }
+
+    def publish(self):
+        state = self.state()
+        if state != self.last and self.snapshot.publish(state):
+            self.last = state
+            self.published += 1
+
+    async def run(self):
+        self.publish()
+        asyncio.create_task(self.config_manager.watch_config())
+        asyncio.create_task(self.upstream_manager.health_checker())
+        while True:
+            await asyncio.sleep(PUBLISH_INTERVAL)
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f"Failed to publish state snapshot: {e}")
+
+
+class SnapshotFollower:
+    """Worker side of multi-worker mode.
+
+    Applies the supervisor's snapshot instead of watching the config and
+    probing upstreams itself, and exports this worker's metrics so any
+    worker can answer a scrape for all of them.
+    """
+
+    def __init__(self, directory: str, worker: str, config_manager, upstream_manager, metrics):
+        self.directory = directory
+        self.worker = worker
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.metrics = metrics
+        self.snapshot = StateSnapshot(os.path.join(directory, SNAPSHOT_FILE))
+        self.sequence = 0
+        self.generation = None
+        self.monitor: Dict = {}
+        self.metrics_path = os.path.join(directory, f"metrics-{worker}.prom")
+        self.poll()
+
+    def poll(self):
+        if self.snapshot.sequence() == self.sequence:
+            return
+        result = self.snapshot.read()
+        if result is None:
+            return
+        self.sequence, state = result
+        if state["generation"] != self.generation:
+            self.generation = state["generation"]
+            if state["config"] != self.config_manager.config:
+                logger.info(f"Worker {self.worker}: applying configuration generation {self.generation}")
+                self.config_manager.apply(state["config"])
+        self.upstream_manager.sync_health(state["health"], state["degraded"])
+        self.monitor = state["monitor"]
+
+    async def run(self):
+        exported = 0.0
+        while True:
+            try:
+                self.poll()
+                if time.monotonic() - exported >= METRICS_EXPORT_INTERVAL:
+                    self.export_metrics()
+                    exported = time.monotonic()
+            except Exception as e:
+                logger.error(f"Worker {self.worker}: failed to follow state snapshot: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def export_metrics(self) -> str:
+        text = self.metrics.render()
+        tmp = f"{self.metrics_path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, self.metrics_path)
+        return text
+
+    def render_metrics(self) -> str:
+        """This worker's metrics, fresh, merged with the last export of every other worker."""
+        texts = {self.worker: self.export_metrics()}
+        for path in sorted(glob.glob(os.path.join(self.directory, METRICS_PATTERN))):
+            worker = os.path.basename(path)[len("metrics-"):-len(".prom")]
+            if worker in texts:
+                continue
+            try:
+                with open(path) as f:
+                    texts[worker] = f.read()
+            except OSError:
+                continue
+        return merge_expositions(texts)
+
+    def stats(self) -> Dict:
+        return {
+            "id": self.worker,
+            "pid": os.getpid(),
+            "snapshot_sequence": self.sequence,
+            "config_generation": self.generation,
+        }
@@ -0,0 +1,333 @@
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from starlette.requests import ClientDisconnect
+
+from admission import Overloaded, streamed_body_reservation
+from bulk import accepted_items, is_bulk_path
+from compression import DecodeError
+from forwarding import REQUEST_HEADER_DROP, RESPONSE_HEADER_DROP_RAW, PayloadTooLarge, limited_stream
+from priority import peek
+from resilience import NoHealthyUpstream
+from spool import SpoolFull
+from timing import phase
+
+logger = logging.getLogger("wazuh-proxy")
+
+BULK_METHODS = frozenset(("POST", "PUT"))
+ELASTIC_PRODUCT = (b"x-elastic-product", b"Elasticsearch")
+JSON_CONTENT_TYPE = (b"content-type", b"application/json")
+SPOOLED = (b"x-proxy-spooled", b"true")
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+async def receive_stream(receive):
+    """The request body as it arrives from the ASGI server."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnect()
+        chunk = message.get("body", b"")
+        if chunk:
+            yield chunk
+        if not message.get("more_body", False):
+            return
+
+
+async def iter_once(body: bytes):
+    yield body
+
+
+async def read_body(stream) -> bytes:
+    return b"".join([chunk async for chunk in stream])
+
+
+def retry_after(seconds: int) -> Tuple[bytes, bytes]:
+    return b"retry-after", str(seconds).encode()
+
+
+def encode_headers(headers: Dict[str, str]) -> Headers:
+    return [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+
+
+class BulkFastPath:
+    """Raw ASGI handler for `_bulk` writes, mounted ahead of FastAPI routing.
+
+    Bulk requests skip route matching, the HTTP middleware wrapper and the
+    Request/Response objects. They go through the same policy, rate-limit,
+    spool, coalescing/fan-out and upstream steps as the generic route, with
+    response headers kept as byte pairs end to end. Everything else falls
+    through to the wrapped app unchanged.
+    """
+
+    def __init__(self, app, config_manager, policy_engine, rate_limiter, priority, admission, compression, resilience,
+                 response_cache, bulk_spool, shard_router, bulk_fanout, bulk_coalescer, bulk_item_retry, mirror,
+                 metrics):
+        self.app = app
+        self.config_manager = config_manager
+        self.policy_engine = policy_engine
+        self.rate_limiter = rate_limiter
+        self.priority = priority
+        self.admission = admission
+        self.compression = compression
+        self.resilience = resilience
+        self.response_cache = response_cache
+        self.bulk_spool = bulk_spool
+        self.shard_router = shard_router
+        self.bulk_fanout = bulk_fanout
+        self.bulk_coalescer = bulk_coalescer
+        self.bulk_item_retry = bulk_item_retry
+        self.mirror = mirror
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] not in BULK_METHODS or not is_bulk_path(scope["path"])
+                or not self.config_manager.snapshot.bulk_fast_path):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.handle(scope, receive, send)
+        except ClientDisconnect:
+            pass
+
+    async def handle(self, scope, receive, send):
+        method = scope["method"]
+        path = scope["path"]
+        path_name = path[1:]
+        query = scope["query_string"].decode("latin-1")
+        headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        client = scope.get("client")
+        client_host = client[0] if client else None
+        snapshot = self.config_manager.snapshot
+        policy = self.policy_engine
+
+        encoding = self.compression.decodable(headers)
+        limit = policy.size_limit(path)
+        body: Optional[bytes] = None
+        if snapshot.stream_requests:
+            # The declared size is checked now, the limit again while the body streams through
+            declared = headers.get("content-length", "")
+            body_size = int(declared) if declared.isdigit() else 0
+            reserve = streamed_body_reservation(declared, bool(encoding), limit)
+        else:
+            with phase("read_body"):
+                body = await read_body(receive_stream(receive))
+                if encoding:
+                    try:
+                        body = self.compression.decode_body(body, encoding, limit)
+                    except DecodeError as exc:
+                        await self.send_json(send, 400, {"error": str(exc)})
+                        return
+            body_size = reserve = len(body)
+        with phase("policy"):
+            error = policy.evaluate(method, path, body_size)
+            budget = None if error else self.rate_limiter.check(scope, headers, client_host, path)
+        if error:
+            logger.warning(f"Policy Block: {error} from {client_host}")
+            await self.send_json(send, 403, {"error": error})
+            return
+
+        if budget is not None and "Retry-After" in budget:
+            self.metrics.rate_limited += 1
+            await self.send_json(send, 429, {"error": "Rate limit exceeded"}, encode_headers(budget))
+            return
+        extra = [ELASTIC_PRODUCT]
+        if budget is not None:
+            extra += encode_headers(budget)
+
+        self.response_cache.invalidate(path)
+        stream = None
+        if body is None:
+            stream = receive_stream(receive)
+            if encoding:
+                stream = self.compression.decode_stream(stream, encoding)
+            stream = limited_stream(stream, limit)
+        responded = False
+        client_send = send
+
+        async def send(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                responded = True
+            await client_send(message)
+
+        capture = None
+        if self.mirror.sample(method, path):
+            capture = self.mirror.capture(method, path, query, headers, body)
+            send = capture.wrap_send(send)
+            if stream is not None:
+                stream = capture.tee(stream)
+        priority = self.priority
+        ticket = None
+        reserved = 0
+        try:
+            with phase("queue"):
+                if priority.enabled:
+                    head = body
+                    if head is None and priority.inspects_body:
+                        # Index names in the first chunk pick the lane of a streamed bulk
+                        head, stream = await peek(stream)
+                    ticket = await priority.acquire(priority.classify(scope, headers, client_host, path, head))
+                reserved = await self.admission.admit_body(reserve)
+            await self.forward(send, method, path_name, query, headers, encoding, body, stream, extra)
+        except ClientDisconnect:
+            raise
+        except Exception as exc:
+            if responded:
+                # No error response can follow a status line; re-raising makes the server drop the connection
+                logger.error(f"Response to {method} {path} broke off after it started: {exc!r}")
+                raise
+            await self.send_error(send, exc, path, client_host, extra)
+        finally:
+            self.admission.release_body(reserved)
+            priority.release(ticket)
+            if capture is not None:
+                capture.submit()
+
+    async def send_error(self, send, exc: Exception, path: str, client_host: Optional[str], extra: Headers):
+        """Answer a bulk that failed before its response started."""
+        if isinstance(exc, PayloadTooLarge):
+            self.policy_engine.record_size_block(path)
+            logger.warning(f"Policy Block: {exc} from {client_host}")
+            await self.send_json(send, 403, {"error": str(exc)}, extra)
+        elif isinstance(exc, DecodeError):
+            await self.send_json(send, 400, {"error": str(exc)}, extra)
+        elif isinstance(exc, SpoolFull):
+            await self.send_json(send, 429, {"error": "Bulk spool is full, retry later"},
+                                 extra + [retry_after(self.bulk_spool.retry_after())])
+        elif isinstance(exc, Overloaded):
+            await self.send_json(send, 429, {"error": str(exc)}, extra + [retry_after(exc.retry_after)])
+        elif isinstance(exc, NoHealthyUpstream):
+            await self.send_json(send, 503, {"error": "All upstreams are unavailable"}, extra)
+        elif isinstance(exc, httpx.RequestError):
+            await self.send_json(send, 502, {"error": "Failed to connect to upstream indexer"}, extra)
+        else:
+            logger.error(f"Internal proxy error: {exc}")
+            await self.send_json(send, 500, {"error": "Internal Proxy Error"}, extra)
+
+    async def forward(self, send, method: str, path_name: str, query: str, headers: Dict[str, str],
+                      encoding: Optional[str], body: Optional[bytes], stream, extra: Headers):
+        spool = self.bulk_spool
+        spoolable = spool.applies(method, path_name)
+        item_retry = self.bulk_item_retry.enabled
+        if spoolable and spool.should_absorb():
+            body = body if body is not None else await read_body(stream)
+            await self.spool(send, path_name, query, headers, body, extra)
+            return
+
+        router = self.shard_router
+        if router.applies(method, path_name):
+            if body is None:
+                # A first chunk naming no _id means auto-generated ids: keep streaming
+                head, stream = await peek(stream)
+                if router.may_route(head):
+                    body = await read_body(stream)
+            if body is not None and router.may_route(body):
+                # Sub-batches carry the decoded body
+                forward = {k: v for k, v in headers.items() if k not in REQUEST_HEADER_DROP and k != "content-encoding"}
+                result = await router.handle(body, path_name, query, forward)
+                if result is not None:
+                    await self.send_json(send, 200, result, extra)
+                    return
+
+        if self.bulk_coalescer.applies(method, path_name, headers):
+            body = body if body is not None else await read_body(stream)
+            result = await self.bulk_coalescer.submit(body, path_name, query, headers)
+            if result is not None:
+                await self.send_json(send, 200, result, extra)
+                return
+        if self.bulk_fanout.applies(method, path_name, headers):
+            if body is not None:
+                stream = iter_once(body)
+            forward = {k: v for k, v in headers.items() if k not in REQUEST_HEADER_DROP}
+            # Without a declared length, the size limit is only enforced as the body is read
+            buffer_first = (body is None and not headers.get("content-length", "").isdigit()
+                            and self.policy_engine.size_limit("/" + path_name) is not None)
+            result = await self.bulk_fanout.handle(stream, path_name, query, forward, buffer_first)
+            await self.send_json(send, 200, result, extra)
+            return
+
+        forward = {k: v for k, v in headers.items() if k not in REQUEST_HEADER_DROP}
+        if encoding:
+            # The body is forwarded decoded (and possibly recompressed upstream)
+            forward.pop("content-encoding", None)
+        upstream_accept = self.compression.upstream_accept_encoding()
+        if upstream_accept:
+            forward["accept-encoding"] = upstream_accept
+        if body is not None:
+            content = body
+        elif "content-length" not in headers and "transfer-encoding" not in headers:
+            content = None
+        elif spoolable or item_retry:
+            # Kept in memory so it can be spooled if the cluster answers 429, or its rejected items resent
+            content = await read_body(stream)
+        else:
+            content = stream
+            if "content-length" in headers and not encoding:
+                forward["content-length"] = headers["content-length"]
+
+        call = await self.resilience.send(method, f"{path_name}?{query}" if query else path_name, forward, content)
+        upstream = call.response
+        if spoolable and upstream.status_code == 429:
+            await call.finish()
+            await self.spool(send, path_name, query, headers, content, extra)
+            return
+
+        response_headers = [(k.lower(), v) for k, v in upstream.headers.raw
+                            if k.lower() not in RESPONSE_HEADER_DROP_RAW]
+        response_headers += extra
+        if self.config_manager.snapshot.stream_responses and not item_retry:
+            upstream_encoding = upstream.headers.get("content-encoding")
+            if upstream_encoding and upstream_encoding in headers.get("accept-encoding", ""):
+                # Relay the raw (still encoded) bytes as they arrive from the indexer
+                response_headers.append((b"content-encoding", upstream_encoding.encode("latin-1")))
+                chunks = upstream.aiter_raw()
+            else:
+                chunks = upstream.aiter_bytes()
+            try:
+                await send({"type": "http.response.start", "status": upstream.status_code, "headers": response_headers})
+                async for chunk in chunks:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+            except httpx.RequestError:
+                await call.finish(ok=False)
+                raise
+            finally:
+                await call.finish()
+            return
+
+        try:
+            data = await upstream.aread()
+        except httpx.RequestError as exc:
+            logger.error(f"Upstream Error ({call.target_url}/{path_name}): {exc}")
+            await call.finish(ok=False)
+            raise
+        await call.finish()
+        if item_retry and isinstance(content, bytes):
+            merged = await self.bulk_item_retry.complete(path_name, query, forward, content, upstream.status_code,
+                                                         data, call.target_url)
+            if merged is not None:
+                data = merged
+        # `data` is decoded; CompressionMiddleware re-encodes it for the client
+        response_headers.append((b"content-length", str(len(data)).encode()))
+        await send({"type": "http.response.start", "status": upstream.status_code, "headers": response_headers})
+        await send({"type": "http.response.body", "body": data})
+
+    async def spool(self, send, path_name: str, query: str, headers: Dict[str, str], body: bytes, extra: Headers):
+        try:
+            await self.bulk_spool.append(path_name, query, headers, body)
+        except OSError as exc:
+            logger.error(f"Bulk spool write failed: {exc}")
+            await self.send_json(send, 503, {"error": "All upstreams are unavailable"}, extra)
+            return
+        await self.send_json(send, 200, {"took": 0, "errors": False, "items": accepted_items(body)}, extra + [SPOOLED])
+
+    @staticmethod
+    async def send_json(send, status: int, payload, headers: Headers = ()):
+        body = json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [JSON_CONTENT_TYPE, (b"content-length", str(len(body)).encode()), *headers]})
+        await send({"type": "http.response.body", "body": body})
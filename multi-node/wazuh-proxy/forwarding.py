@@ -0,0 +1,36 @@
+from typing import Optional
+
+# Hop-by-hop and framing headers are not forwarded; the proxy sets its own
+REQUEST_HEADER_DROP = frozenset(("host", "content-length", "connection", "transfer-encoding"))
+CACHED_REQUEST_HEADER_DROP = REQUEST_HEADER_DROP | {"if-none-match"}
+RESPONSE_HEADER_DROP = frozenset(("transfer-encoding", "connection", "content-length", "content-encoding"))
+RESPONSE_HEADER_DROP_RAW = frozenset(name.encode() for name in RESPONSE_HEADER_DROP)
+
+
+class PayloadTooLarge(Exception):
+    pass
+
+
+class limited_stream:
+    """Relay a request body chunk by chunk, aborting once `limit` bytes are exceeded.
+
+    `started` tells the retry logic whether any part of the body was consumed.
+    """
+
+    def __init__(self, stream, limit: Optional[int]):
+        self.stream = stream
+        self.limit = limit
+        self.received = 0
+        self.started = False
+
+    def __aiter__(self):
+        self.iterator = self.stream.__aiter__()
+        return self
+
+    async def __anext__(self) -> bytes:
+        self.started = True
+        chunk = await self.iterator.__anext__()
+        self.received += len(chunk)
+        if self.limit is not None and self.received > self.limit:
+            raise PayloadTooLarge(f"Payload size exceeds limit of {self.limit // (1024 * 1024)}MB")
+        return chunk
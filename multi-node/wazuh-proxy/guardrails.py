@@ -0,0 +1,309 @@
+import fnmatch
+import json
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+KB = 1024
+SEARCH_ENDPOINTS = frozenset(("_search", "_msearch"))
+# Aggregations whose `size` sets how many buckets are built
+BUCKET_AGGREGATIONS = frozenset(("terms", "multi_terms", "significant_terms", "rare_terms", "composite"))
+# Deeper bodies are not walked; a real query is nowhere near this
+MAX_DEPTH = 64
+# A term of a query_string that starts with a wildcard (a lone `*` matches everything and is cheap)
+LEADING_WILDCARD = re.compile(r"(?:^|[\s(:])[*?]+[^\s)*?]")
+DURATION = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*(nanos|micros|ms|s|m|h|d)?\s*$")
+DURATION_UNITS = {"nanos": 1e-9, "micros": 1e-6, "ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0, "d": 86400.0,
+                  None: 1e-3}
+CONDITIONS = ("size_over", "from_over", "leading_wildcard", "bucket_size_over", "agg_depth_over")
+REWRITES = ("max_size", "terminate_after", "timeout")
+
+
+def loads(data: bytes):
+    return orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value) if ORJSON_AVAILABLE else json.dumps(value, separators=(",", ":")).encode()
+
+
+def parse_duration(value) -> Optional[float]:
+    """Seconds in an OpenSearch time value ("30s", "500ms"); bare numbers are milliseconds."""
+    match = DURATION.match(str(value))
+    if match is None:
+        return None
+    return float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def search_endpoint(path: str) -> Optional[str]:
+    last = path.rstrip("/").rsplit("/", 1)[-1]
+    return last if last in SEARCH_ENDPOINTS else None
+
+
+def path_indices(path: str) -> List[str]:
+    first = path.lstrip("/").split("/", 1)[0]
+    return first.split(",") if first and not first.startswith("_") else []
+
+
+def header_indices(target) -> List[str]:
+    """Indices named by an `_msearch` header's `index`, a comma-separated string or a list.
+
+    >>> header_indices("wazuh-alerts-*,wazuh-archives-*")
+    ['wazuh-alerts-*', 'wazuh-archives-*']
+    >>> header_indices(["wazuh-alerts-*", "wazuh-archives-*,wazuh-states-*"])
+    ['wazuh-alerts-*', 'wazuh-archives-*', 'wazuh-states-*']
+    """
+    names = [target] if isinstance(target, str) else target
+    return [index for name in names if isinstance(name, str) for index in name.split(",") if index]
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class QueryShape:
+    """What the rules look at in one search: paging, wildcards and aggregations."""
+
+    __slots__ = ("size", "from_", "leading_wildcard", "bucket_size", "agg_depth")
+
+    def __init__(self, body: Dict, params: Dict[str, str]):
+        # URL parameters win over the body, as in OpenSearch
+        self.size = _int(params.get("size", body.get("size")))
+        self.from_ = _int(params.get("from", body.get("from")))
+        self.leading_wildcard = bool(LEADING_WILDCARD.search(params.get("q", "")))
+        self.bucket_size = 0
+        self.agg_depth = 0
+        self._walk(body.get("query"), 0)
+        for key in ("aggs", "aggregations"):
+            self._walk_aggs(body.get(key), 1)
+
+    def _walk(self, node, depth: int):
+        if depth > MAX_DEPTH or self.leading_wildcard:
+            return
+        if isinstance(node, list):
+            for item in node:
+                self._walk(item, depth + 1)
+            return
+        if not isinstance(node, dict):
+            return
+        for key, value in node.items():
+            if key in ("wildcard", "prefix_wildcard") and isinstance(value, dict):
+                for spec in value.values():
+                    pattern = spec.get("value", spec.get("wildcard")) if isinstance(spec, dict) else spec
+                    if isinstance(pattern, str) and pattern[:1] in ("*", "?"):
+                        self.leading_wildcard = True
+            elif key == "regexp" and isinstance(value, dict):
+                for spec in value.values():
+                    pattern = spec.get("value") if isinstance(spec, dict) else spec
+                    if isinstance(pattern, str) and pattern.startswith(".*"):
+                        self.leading_wildcard = True
+            elif key in ("query_string", "simple_query_string") and isinstance(value, dict):
+                query = value.get("query")
+                if isinstance(query, str) and value.get("allow_leading_wildcard", True) and \
+                        LEADING_WILDCARD.search(query):
+                    self.leading_wildcard = True
+            else:
+                self._walk(value, depth + 1)
+
+    def _walk_aggs(self, aggs, depth: int):
+        if not isinstance(aggs, dict) or depth > MAX_DEPTH:
+            return
+        self.agg_depth = max(self.agg_depth, depth)
+        for spec in aggs.values():
+            if not isinstance(spec, dict):
+                continue
+            for kind, body in spec.items():
+                if kind in BUCKET_AGGREGATIONS and isinstance(body, dict):
+                    self.bucket_size = max(self.bucket_size, _int(body.get("size")) or 0)
+            for key in ("aggs", "aggregations"):
+                self._walk_aggs(spec.get(key), depth + 1)
+
+
+class SearchRule:
+    """One guardrail: where it applies, when it triggers and whether it rejects or rewrites."""
+
+    def __init__(self, spec: Dict):
+        self.name = spec.get("name")
+        if not isinstance(self.name, str) or not self.name:
+            raise ValueError(f"Search guardrail without a name: {spec}")
+        indices = spec.get("indices") or []
+        if isinstance(indices, str):
+            indices = [indices]
+        self.indices = tuple(re.compile(fnmatch.translate(p)) for p in indices)
+        when = spec.get("when") or {}
+        unknown = set(when) - set(CONDITIONS)
+        if unknown:
+            raise ValueError(f"Search guardrail {self.name} has unknown conditions: {sorted(unknown)}")
+        for key in CONDITIONS:
+            if key != "leading_wildcard" and key in when and (
+                    isinstance(when[key], bool) or not isinstance(when[key], (int, float))):
+                raise ValueError(f"Search guardrail {self.name} needs a number for {key}, got {when[key]!r}")
+        self.when = when
+        self.action = spec.get("action", "reject")
+        if self.action not in ("reject", "rewrite"):
+            raise ValueError(f"Search guardrail {self.name} has an unknown action: {self.action}")
+        rewrite = spec.get("rewrite") or {}
+        self.max_size = _int(rewrite.get("max_size"))
+        self.terminate_after = _int(rewrite.get("terminate_after"))
+        self.timeout = rewrite.get("timeout")
+        self.timeout_s = parse_duration(self.timeout) if self.timeout is not None else None
+        if self.timeout is not None and self.timeout_s is None:
+            raise ValueError(f"Search guardrail {self.name} has an invalid timeout: {self.timeout}")
+        if self.action == "rewrite" and (self.max_size, self.terminate_after, self.timeout) == (None, None, None):
+            raise ValueError(f"Search guardrail {self.name} rewrites nothing; set one of {', '.join(REWRITES)}")
+
+    def covers(self, indices: List[str]) -> bool:
+        if not self.indices:
+            return True
+        # A search without an index goes to all of them
+        return any(p.match(index) for p in self.indices for index in (indices or ["*"]))
+
+    def triggered(self, shape: QueryShape) -> bool:
+        when = self.when
+        if "size_over" in when and not (shape.size or 0) > when["size_over"]:
+            return False
+        if "from_over" in when and not (shape.from_ or 0) > when["from_over"]:
+            return False
+        if when.get("leading_wildcard") and not shape.leading_wildcard:
+            return False
+        if "bucket_size_over" in when and not shape.bucket_size > when["bucket_size_over"]:
+            return False
+        if "agg_depth_over" in when and not shape.agg_depth > when["agg_depth_over"]:
+            return False
+        return True
+
+    def apply(self, body: Dict, params: Dict[str, str], in_query: bool) -> bool:
+        """Rewrite the search in place, into the URL parameters when `in_query`; returns whether it changed."""
+        changed = False
+
+        def current(key):
+            # A URL parameter overrides the body; it is moved to the body when that is rewritten
+            return params.pop(key) if key in params and not in_query else params.get(key, body.get(key))
+
+        def put(key, value):
+            if in_query:
+                params[key] = str(value)
+            else:
+                body[key] = value
+
+        if self.max_size is not None:
+            raw = current("size")
+            size = _int(raw)
+            if size is not None and size > self.max_size:
+                size = self.max_size
+                changed = True
+            # An absent size is left to the default; an unreadable one is left to the indexer to reject
+            if raw is not None:
+                put("size", raw if size is None else size)
+        if self.terminate_after is not None:
+            limit = _int(current("terminate_after"))
+            if limit is None or limit > self.terminate_after:
+                limit = self.terminate_after
+                changed = True
+            put("terminate_after", limit)
+        if self.timeout is not None:
+            timeout = current("timeout")
+            seconds = parse_duration(timeout) if timeout is not None else None
+            if seconds is None or seconds > self.timeout_s:
+                timeout = self.timeout
+                changed = True
+            put("timeout", timeout)
+        return changed
+
+
+class Verdict(NamedTuple):
+    error: Optional[str]
+    rule: Optional[str]
+    body: bytes
+    query: str
+    rewritten: Tuple[str, ...]
+
+
+class SearchGuard:
+    """Structural checks of `_search` / `_msearch` bodies, compiled with the configuration.
+
+    Bodies up to `max_body_kb` are parsed (with orjson when installed) and
+    each search is matched against the rules in order. A `reject` rule
+    stops the request; `rewrite` rules cap `size` and `terminate_after` or
+    set a `timeout`, and are all applied. Larger bodies are not parsed and
+    follow `oversize` (reject or allow).
+    """
+
+    def __init__(self, settings: Dict):
+        self.rules = tuple(SearchRule(spec) for spec in settings.get("rules") or [])
+        self.enabled = bool(settings.get("enabled", True)) and bool(self.rules)
+        self.max_body = int(settings.get("max_body_kb", 1024) * KB)
+        self.oversize = settings.get("oversize", "reject")
+        if self.oversize not in ("reject", "allow"):
+            raise ValueError(f"search_guardrails.oversize must be reject or allow, got {self.oversize}")
+
+    def applies(self, method: str, path: str) -> bool:
+        return self.enabled and method in ("GET", "POST") and search_endpoint(path) is not None
+
+    def check(self, path: str, query: str, body: bytes) -> Verdict:
+        if len(body) > self.max_body:
+            if self.oversize == "reject":
+                return Verdict(f"Search body exceeds the {self.max_body // KB}KB inspection limit", "oversize",
+                               body, query, ())
+            return Verdict(None, None, body, query, ())
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        indices = path_indices(path)
+        try:
+            if search_endpoint(path) == "_msearch":
+                return self._check_msearch(body, query, params, indices)
+            search = loads(body) if body.strip() else {}
+        except (ValueError, RecursionError):
+            return Verdict("Search body is not valid JSON", "malformed", body, query, ())
+        if not isinstance(search, dict):
+            return Verdict("Search body must be a JSON object", "malformed", body, query, ())
+
+        # Searches sent without a body (`?q=...`) are rewritten in their URL parameters
+        error, rule, rewritten = self._evaluate(search, params, indices, in_query=not body.strip())
+        if error or not rewritten:
+            return Verdict(error, rule, body, query, rewritten)
+        return Verdict(None, None, dumps(search) if body.strip() else body, urlencode(params), rewritten)
+
+    def _check_msearch(self, body: bytes, query: str, params: Dict[str, str], indices: List[str]) -> Verdict:
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        if len(lines) % 2:
+            return Verdict("Multi-search body must alternate header and search lines", "malformed", body, query, ())
+        out = []
+        rewritten: List[str] = []
+        for header_line, search_line in zip(lines[0::2], lines[1::2]):
+            header = loads(header_line)
+            search = loads(search_line)
+            if not isinstance(header, dict) or not isinstance(search, dict):
+                return Verdict("Multi-search lines must be JSON objects", "malformed", body, query, ())
+            target = header.get("index")
+            search_indices = header_indices(target) if isinstance(target, (str, list)) and target else indices
+            error, rule, changed = self._evaluate(search, {}, search_indices, in_query=False)
+            if error:
+                return Verdict(error, rule, body, query, ())
+            rewritten.extend(name for name in changed if name not in rewritten)
+            out.append(header_line)
+            out.append(dumps(search) if changed else search_line)
+        if not rewritten:
+            return Verdict(None, None, body, query, ())
+        return Verdict(None, None, b"\n".join(out) + b"\n", query, tuple(rewritten))
+
+    def _evaluate(self, search: Dict, params: Dict[str, str], indices: List[str],
+                  in_query: bool) -> Tuple[Optional[str], Optional[str], Tuple[str, ...]]:
+        shape = QueryShape(search, params)
+        rewritten = []
+        for rule in self.rules:
+            if not rule.covers(indices) or not rule.triggered(shape):
+                continue
+            if rule.action == "reject":
+                return f"Search rejected by guardrail '{rule.name}'", rule.name, ()
+            if rule.apply(search, params, in_query):
+                rewritten.append(rule.name)
+        return None, None, tuple(rewritten)
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger("wazuh-proxy")
+
+NODES_STATS_PATH = ("/_nodes/stats/thread_pool"
+                    "?filter_path=nodes.*.name,nodes.*.host,nodes.*.ip,nodes.*.thread_pool.write")
+
+
+class TargetHealth:
+    """Health bookkeeping for one upstream: streaks, history and write-pool view."""
+
+    def __init__(self, url: str, node_name: Optional[str], history_size: int):
+        self.url = url
+        self.host = urlparse(url).hostname
+        self.node_name = node_name
+        self.failures = 0
+        self.successes = 0
+        self.passive_failures = 0
+        self.history = deque(maxlen=history_size)
+        self.last_latency_ms: Optional[float] = None
+        self.write_pool: Optional[Dict] = None
+
+    def add_event(self, source: str, ok: bool, detail: str = ""):
+        self.history.append({"time": round(time.time(), 3), "source": source, "ok": ok, "detail": detail})
+
+    def matches(self, node: Dict) -> bool:
+        if self.node_name is not None:
+            return node.get("name") == self.node_name
+        return self.host in (node.get("name"), node.get("host"), node.get("ip"))
+
+    def stats(self) -> Dict:
+        return {
+            "consecutive_failures": self.failures,
+            "consecutive_successes": self.successes,
+            "passive_failures": self.passive_failures,
+            "last_latency_ms": self.last_latency_ms,
+            "write_pool": self.write_pool,
+            "history": list(self.history),
+        }
+
+
+class HealthMonitor:
+    """Active probes, passive outcomes and cluster-state checks for the upstreams.
+
+    Probes run concurrently, so a hung node only delays its own result. A
+    target flips to unhealthy after `unhealthy_threshold` consecutive failed
+    probes (or `passive_unhealthy_threshold` failed live requests) and back
+    after `healthy_threshold` consecutive successful probes. A node whose
+    write thread-pool queue is saturated is marked degraded.
+    """
+
+    def __init__(self, config_manager, upstream_manager, pool):
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.pool = pool
+        self.targets: Dict[str, TargetHealth] = {}
+        self.cluster: Dict = {}
+        self.update_targets()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.health_check
+
+    def update_targets(self):
+        history_size = self._settings().get("history_size", 20)
+        targets = {}
+        for target in self.config_manager.snapshot.targets:
+            url = target.url
+            health = self.targets.get(url)
+            if health is None or health.history.maxlen != history_size:
+                health = TargetHealth(url, target.node_name, history_size)
+            health.node_name = target.node_name
+            targets[url] = health
+        self.targets = targets
+
+    async def run(self):
+        while True:
+            interval = self.config_manager.snapshot.upstream.get("health_check_interval", 30)
+            await asyncio.sleep(interval)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Health check sweep failed: {e}")
+
+    async def check_all(self):
+        settings = self._settings()
+        probes = [self._probe(health) for health in list(self.targets.values())]
+        if settings.get("cluster_stats", True):
+            probes.append(self._refresh_cluster_view())
+        await asyncio.gather(*probes)
+
+    async def _probe(self, health: TargetHealth):
+        settings = self._settings()
+        started = time.monotonic()
+        try:
+            async with self.pool.lease(health.url) as client:
+                resp = await client.get(health.url, timeout=settings.get("timeout", 5.0))
+            ok = resp.status_code in (200, 401)
+            detail = f"HTTP {resp.status_code}"
+        except Exception as e:
+            ok = False
+            detail = type(e).__name__
+        health.last_latency_ms = round((time.monotonic() - started) * 1000, 2)
+        health.add_event("active", ok, detail)
+
+        if ok:
+            health.failures = 0
+            health.passive_failures = 0
+            health.successes += 1
+            healthy = self.upstream_manager.health_status.get(health.url, True)
+            if not healthy and health.successes >= settings.get("healthy_threshold", 2):
+                self.upstream_manager.mark_healthy(health.url)
+        else:
+            health.successes = 0
+            health.failures += 1
+            if health.failures >= settings.get("unhealthy_threshold", 2):
+                self._mark_unhealthy(health)
+
+    def record_passive(self, url: str, ok: bool):
+        """Feed the outcome of a real proxied request into the health state."""
+        health = self.targets.get(url)
+        if health is None:
+            return
+        if ok:
+            health.passive_failures = 0
+            return
+        health.passive_failures += 1
+        if health.passive_failures == self._settings().get("passive_unhealthy_threshold", 5):
+            health.add_event("passive", False, f"{health.passive_failures} consecutive request failures")
+            self._mark_unhealthy(health)
+
+    def _mark_unhealthy(self, health: TargetHealth):
+        health.successes = 0
+        if self.upstream_manager.health_status.get(health.url, True):
+            self.upstream_manager.mark_unhealthy(health.url)
+
+    async def _refresh_cluster_view(self):
+        """Fetch cluster health and write thread-pool stats once, from any healthy node."""
+        settings = self._settings()
+        url = self.upstream_manager.peek_target()
+        if url is None:
+            return
+        timeout = settings.get("timeout", 5.0)
+        try:
+            async with self.pool.lease(url) as client:
+                cluster_resp, nodes_resp = await asyncio.gather(
+                    client.get(f"{url}/_cluster/health", timeout=timeout),
+                    client.get(f"{url}{NODES_STATS_PATH}", timeout=timeout),
+                )
+            cluster = cluster_resp.json() if cluster_resp.status_code == 200 else {}
+            nodes = nodes_resp.json().get("nodes", {}) if nodes_resp.status_code == 200 else {}
+        except Exception as e:
+            logger.warning(f"Failed to refresh cluster view from {url}: {e}")
+            return
+
+        self.cluster = {
+            "status": cluster.get("status"),
+            "number_of_nodes": cluster.get("number_of_nodes"),
+            "unassigned_shards": cluster.get("unassigned_shards"),
+            "fetched_from": url,
+            "fetched_at": round(time.time(), 3),
+        }
+        queue_threshold = settings.get("write_queue_threshold", 200)
+        for health in self.targets.values():
+            node = next((n for n in nodes.values() if health.matches(n)), None)
+            if node is None:
+                continue
+            write = node.get("thread_pool", {}).get("write", {})
+            previous = health.write_pool or {}
+            rejected_delta = write.get("rejected", 0) - previous.get("rejected", write.get("rejected", 0))
+            health.write_pool = {
+                "queue": write.get("queue", 0),
+                "active": write.get("active", 0),
+                "rejected": write.get("rejected", 0),
+            }
+            degraded = write.get("queue", 0) >= queue_threshold or rejected_delta > 0
+            if degraded != (health.url in self.upstream_manager.degraded):
+                detail = f"write queue {write.get('queue', 0)}, +{rejected_delta} rejected"
+                health.add_event("cluster", not degraded, detail)
+                self.upstream_manager.set_degraded(health.url, degraded)
+
+    def stats(self) -> Dict:
+        return {
+            "cluster": self.cluster,
+            "targets": {url: health.stats() for url, health in self.targets.items()},
+        }
@@ -1,182 +1,308 @@
 import os
 import logging
-import ssl
-import yaml
 import asyncio
 import time
 from typing import Optional, List, Dict, Any
 from fastapi import FastAPI, Request, Response, BackgroundTasks
-from fastapi.responses import JSONResponse
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
-from slowapi.errors import RateLimitExceeded
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 import httpx
-from watchfiles import awatch
+
+from accesslog import AccessLog, AccessLogMiddleware
+from admission import AdmissionController, Overloaded, streamed_body_reservation
+from bulk import BulkCoalescer, BulkFanout, BulkItemRetry, accepted_items, is_bulk_path
+from cache import ResponseCache
+from compression import CompressionLayer, CompressionMiddleware, DecodeError
+from configuration import ConfigManager
+from control import SnapshotFollower, state_directory, worker_id
+from fastpath import BulkFastPath
+from forwarding import (CACHED_REQUEST_HEADER_DROP, REQUEST_HEADER_DROP, RESPONSE_HEADER_DROP, PayloadTooLarge,
+                        limited_stream)
+from metrics import CONTENT_TYPE, MetricsMiddleware, ProxyMetrics
+from mirror import ShadowMirror
+from policy import PolicyEngine
+from priority import PriorityScheduler
+from profiler import Profiler, ProfilerBusy
+from ratelimit import RateLimiter
+from pool import UpstreamPool
+from resilience import CircuitBreaker, NoHealthyUpstream, ResilienceLayer
+from routing import ShardRouter
+from spool import BulkSpool, SpoolFull
+from timing import PhaseTiming, TimingMiddleware, phase
+from upstream import UpstreamManager
 
 # Logging Configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("wazuh-proxy")
 
 CONFIG_PATH = os.getenv("CONFIG_PATH", "config.yaml")
-
-class ConfigManager:
-    def __init__(self, config_path: str):
-        self.config_path = config_path
-        self.config = {}
-        self.ssl_context = None
-        self.load_config()
-
-    def load_config(self):
-        try:
-            with open(self.config_path, 'r') as f:
-                self.config = yaml.safe_load(f)
-            logger.info(f"Loaded configuration from {self.config_path}")
-            self._setup_ssl()
-        except Exception as e:
-            logger.error(f"Failed to load configuration: {e}")
-
-    def _setup_ssl(self):
-        mtls = self.config.get("security", {}).get("mtls", {})
-        ca_cert = mtls.get("ca_cert")
-        client_cert = mtls.get("client_cert")
-        client_key = mtls.get("client_key")
-
-        if not ca_cert:
-            logger.warning("No CA cert found in config, using default cert verification.")
-            self.ssl_context = ssl.create_default_context()
-        else:
-            self.ssl_context = ssl.create_default_context(cafile=ca_cert)
-            if client_cert and client_key and os.path.exists(client_cert) and os.path.exists(client_key):
-                self.ssl_context.load_cert_chain(certfile=client_cert, keyfile=client_key)
-                logger.info("mTLS client certificate loaded.")
-            
-        self.ssl_context.check_hostname = False
-        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
-
-    async def watch_config(self):
-        async for changes in awatch(self.config_path):
-            logger.info("Configuration change detected, reloading...")
-            self.load_config()
-
-class UpstreamManager:
-    def __init__(self, config_manager: ConfigManager):
-        self.config_manager = config_manager
-        self.targets = []
-        self.current_index = 0
-        self.health_status = {}
-        self._update_targets()
-
-    def _update_targets(self):
-        self.targets = self.config_manager.config.get("upstream", {}).get("targets", [])
-        for target in self.targets:
-            if target['url'] not in self.health_status:
-                self.health_status[target['url']] = True
-
-    def get_next_target(self) -> Optional[str]:
-        self._update_targets() # Ensure we have latest targets
-        healthy_targets = [t for t in self.targets if self.health_status.get(t['url'], True)]
-        
-        if not healthy_targets:
-            logger.error("No healthy upstream targets available!")
-            return None
-        
-        # Simple Round Robin for now
-        target = healthy_targets[self.current_index % len(healthy_targets)]
-        self.current_index += 1
-        return target['url']
-
-    def mark_unhealthy(self, url: str):
-        self.health_status[url] = False
-        logger.warning(f"Target marked as UNHEALTHY: {url}")
-
-    async def health_checker(self):
-        while True:
-            interval = self.config_manager.config.get("upstream", {}).get("health_check_interval", 30)
-            await asyncio.sleep(interval)
-            
-            for target in self.targets:
-                url = target['url']
-                try:
-                    async with httpx.AsyncClient(verify=self.config_manager.ssl_context, timeout=5.0) as client:
-                        resp = await client.get(url)
-                        if resp.status_code in [200, 401]:
-                            if not self.health_status[url]:
-                                logger.info(f"Target recovered (HEALTHY): {url}")
-                            self.health_status[url] = True
-                        else:
-                            self.mark_unhealthy(url)
-                except Exception:
-                    self.mark_unhealthy(url)
-
-class PolicyEngine:
-    def __init__(self, config_manager: ConfigManager):
-        self.config_manager = config_manager
-
-    def evaluate(self, method: str, path: str, body_size: int = 0) -> Optional[str]:
-        policies = self.config_manager.config.get("security", {}).get("policies", [])
-        
-        # Default block for dangerous methods
-        if method == "DELETE":
-            return "DELETE method is explicitly forbidden."
-
-        for policy in policies:
-            target_path = policy.get("path")
-            if target_path == "*" or path.startswith(target_path):
-                # Check blocked methods
-                if method in policy.get("blocked_methods", []):
-                    return f"Method {method} is blocked for path {path}"
-                
-                # Check allowed methods (if defined)
-                allowed = policy.get("allowed_methods")
-                if allowed and method not in allowed:
-                    return f"Method {method} is not in allowed list for path {path}"
-                
-                # Check max size
-                max_size_mb = policy.get("max_size_mb")
-                if max_size_mb and body_size > (max_size_mb * 1024 * 1024):
-                    return f"Payload size exceeds limit of {max_size_mb}MB"
-        
-        return None
+# Set by serve.py when running as one of several worker processes
+STATE_DIR = state_directory()
+WORKER_ID = worker_id()
 
 # Initialize Core Managers
 config_manager = ConfigManager(CONFIG_PATH)
-upstream_manager = UpstreamManager(config_manager)
+access_log = AccessLog(config_manager, WORKER_ID)
+config_manager.reload_callbacks.append(access_log.rebuild)
+access_log.capture_logging()
+metrics = ProxyMetrics(config_manager)
+config_manager.reload_callbacks.append(metrics.rebuild)
+timing = PhaseTiming(config_manager, metrics)
+config_manager.reload_callbacks.append(timing.rebuild)
+profiler = Profiler(config_manager)
+config_manager.reload_callbacks.append(profiler.rebuild)
+upstream_pool = UpstreamPool(config_manager)
+config_manager.reload_callbacks.append(upstream_pool.rebuild)
+upstream_manager = UpstreamManager(config_manager, upstream_pool)
+config_manager.reload_callbacks.append(upstream_manager.update_targets)
+compression = CompressionLayer(config_manager)
+config_manager.reload_callbacks.append(compression.rebuild)
+admission = AdmissionController(config_manager)
+config_manager.reload_callbacks.append(admission.rebuild)
+resilience = ResilienceLayer(config_manager, upstream_manager, upstream_pool, metrics, compression, admission)
+config_manager.reload_callbacks.append(resilience.rebuild)
+bulk_item_retry = BulkItemRetry(config_manager, resilience)
+config_manager.reload_callbacks.append(bulk_item_retry.rebuild)
+shard_router = ShardRouter(config_manager, upstream_manager, upstream_pool, resilience, bulk_item_retry)
+config_manager.reload_callbacks.append(shard_router.rebuild)
+bulk_fanout = BulkFanout(config_manager, resilience, bulk_item_retry)
+config_manager.reload_callbacks.append(bulk_fanout.rebuild)
+bulk_coalescer = BulkCoalescer(config_manager, resilience, bulk_item_retry)
+config_manager.reload_callbacks.append(bulk_coalescer.rebuild)
 policy_engine = PolicyEngine(config_manager)
+config_manager.reload_callbacks.append(policy_engine.rebuild)
+rate_limiter = RateLimiter(config_manager)
+config_manager.reload_callbacks.append(rate_limiter.rebuild)
+priority = PriorityScheduler(config_manager, rate_limiter, metrics)
+config_manager.reload_callbacks.append(priority.rebuild)
+response_cache = ResponseCache(config_manager)
+config_manager.reload_callbacks.append(response_cache.rebuild)
+bulk_spool = BulkSpool(config_manager, upstream_manager, resilience, WORKER_ID)
+config_manager.reload_callbacks.append(bulk_spool.rebuild)
+mirror = ShadowMirror(config_manager)
+config_manager.reload_callbacks.append(mirror.rebuild)
+# Workers follow the supervisor's config and health view instead of their own
+state_follower = SnapshotFollower(STATE_DIR, WORKER_ID, config_manager, upstream_manager, metrics) if STATE_DIR else None
 
 # Setup FastAPI
-limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(title="Wazuh-Proxy Advanced", version="3.0.0")
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+
+CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+
+def runtime_metrics():
+    """Scrape-time view of the other subsystems for /metrics."""
+    states = upstream_manager.states
+    yield ("wazuh_proxy_upstream_inflight", "gauge", "Requests in flight per upstream.",
+           [({"upstream": url}, s.inflight) for url, s in states.items()])
+    yield ("wazuh_proxy_upstream_healthy", "gauge", "1 if the upstream passes health checks.",
+           [({"upstream": url}, int(upstream_manager.health_status.get(url, True))) for url in states])
+    yield ("wazuh_proxy_upstream_degraded", "gauge", "1 if the upstream's write pool is saturated.",
+           [({"upstream": url}, int(url in upstream_manager.degraded)) for url in states])
+    yield ("wazuh_proxy_upstream_circuit_state", "gauge", "Circuit breaker state (0 closed, 1 half-open, 2 open).",
+           [({"upstream": url}, CIRCUIT_STATES[b.state]) for url, b in upstream_manager.breakers.items()])
+    yield ("wazuh_proxy_upstream_ewma_seconds", "gauge", "Smoothed upstream latency used by the balancer.",
+           [({"upstream": url}, round(s.ewma_ms / 1000, 6)) for url, s in states.items()])
+    max_connections = upstream_pool.current.settings.get("max_connections", 100)
+    yield ("wazuh_proxy_pool_max_connections", "gauge", "Connection limit of each upstream client.",
+           [({}, max_connections)])
+    yield ("wazuh_proxy_pool_leases", "gauge", "Pool leases held in the current generation.",
+           [({}, upstream_pool.current.inflight)])
+    yield ("wazuh_proxy_policy_blocks_total", "counter", "Requests blocked by security policy.",
+           [({"rule": rule, "reason": reason}, n) for (rule, reason), n in list(policy_engine.blocks.items())])
+    yield ("wazuh_proxy_search_rewrites_total", "counter", "Searches rewritten by a search guardrail.",
+           [({"rule": rule}, n) for rule, n in list(policy_engine.rewrites.items())])
+    resilience_stats = resilience.stats()
+    yield ("wazuh_proxy_retries_total", "counter", "Upstream retries.", [({}, resilience_stats["retries"])])
+    yield ("wazuh_proxy_hedged_requests_total", "counter", "Hedged reads sent.",
+           [({}, resilience_stats["hedged_requests"])])
+    cache_stats = response_cache.stats()
+    yield ("wazuh_proxy_cache_lookups_total", "counter", "Response cache lookups by result.",
+           [({"result": r}, cache_stats[r]) for r in ("hits", "misses", "coalesced")])
+    yield ("wazuh_proxy_cache_bytes", "gauge", "Memory held by the response cache.", [({}, cache_stats["bytes"])])
+
+metrics.add_collector(runtime_metrics)
+metrics.add_collector(compression.metric_families)
+metrics.add_collector(bulk_spool.metric_families)
+metrics.add_collector(bulk_item_retry.metric_families)
+metrics.add_collector(access_log.metric_families)
+metrics.add_collector(admission.metric_families)
+metrics.add_collector(priority.metric_families)
+metrics.add_collector(shard_router.metric_families)
+metrics.add_collector(timing.metric_families)
+metrics.add_collector(mirror.metric_families)
 
 @app.on_event("startup")
 async def startup_event():
-    asyncio.create_task(config_manager.watch_config())
-    asyncio.create_task(upstream_manager.health_checker())
+    if state_follower is not None:
+        asyncio.create_task(state_follower.run())
+    else:
+        asyncio.create_task(config_manager.watch_config())
+        asyncio.create_task(upstream_manager.health_checker())
+    asyncio.create_task(bulk_spool.run())
+    asyncio.create_task(shard_router.run())
+    asyncio.create_task(mirror.run())
+    await upstream_pool.warmup()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    bulk_spool.close()
+    await upstream_pool.close()
+    await mirror.close()
+    access_log.close()
 
 @app.middleware("http")
 async def security_middleware(request: Request, call_next):
-    body = await request.body()
-    error = policy_engine.evaluate(request.method, request.url.path, len(body))
-    if error:
-        logger.warning(f"Policy Block: {error} from {request.client.host}")
-        return JSONResponse(status_code=403, content={"error": error})
-    
-    # Store body in request state so it can be reused in proxy_request
-    request.state.body = body
-    response = await call_next(request)
+    inspect_search = policy_engine.inspects_search(request.method, request.url.path)
+    if config_manager.snapshot.stream_requests and not inspect_search:
+        # Check the declared size up front; proxy_request enforces the limit
+        # again while the body streams through (chunked uploads).
+        declared = request.headers.get("content-length", "")
+        body_size = int(declared) if declared.isdigit() else 0
+        reserve = streamed_body_reservation(declared, bool(compression.decodable(request.headers)),
+                                            policy_engine.size_limit(request.url.path))
+        body = None
+    else:
+        with phase("read_body"):
+            body = await request.body()
+            encoding = compression.decodable(request.headers)
+            if encoding:
+                # Apply size policies to what the indexer will actually receive
+                limit = policy_engine.size_limit(request.url.path)
+                try:
+                    body = compression.decode_body(body, encoding, limit)
+                except DecodeError as exc:
+                    return JSONResponse(status_code=400, content={"error": str(exc)})
+        body_size = reserve = len(body)
+    with phase("policy"):
+        error = policy_engine.evaluate(request.method, request.url.path, body_size)
+        if error:
+            logger.warning(f"Policy Block: {error} from {request.client.host}")
+            return JSONResponse(status_code=403, content={"error": error})
+        if inspect_search:
+            error, body, query = policy_engine.inspect_search(request.url.path, request.url.query, body)
+            if error:
+                logger.warning(f"Policy Block: {error} from {request.client.host}")
+                return JSONResponse(status_code=403, content={"error": error})
+            if query != request.url.query:
+                request.state.query = query
+
+        budget = rate_limiter.check(request.scope, request.headers, request.client.host if request.client else None,
+                                    request.url.path)
+    if budget is not None and "Retry-After" in budget:
+        metrics.rate_limited += 1
+        return JSONResponse(status_code=429, content={"error": "Rate limit exceeded"}, headers=budget)
+
+    client_host = request.client.host if request.client else None
+    ticket = None
+    try:
+        # Streamed bodies are classified by path and client only
+        with phase("queue"):
+            lane = priority.classify(request.scope, request.headers, client_host, request.url.path, body)
+            ticket = await priority.acquire(lane)
+            reserved = await admission.admit_body(reserve)
+    except Overloaded as exc:
+        priority.release(ticket)
+        return overloaded_response(exc)
+
+    if body is None:
+        request.state.size_limit = policy_engine.size_limit(request.url.path)
+    else:
+        # Store body in request state so it can be reused in proxy_request
+        request.state.body = body
+    capture = None
+    if mirror.sample(request.method, request.url.path):
+        streamed = body is None and ("content-length" in request.headers or "transfer-encoding" in request.headers)
+        if body is None and not streamed:
+            body = b""
+        capture = mirror.capture(request.method, request.url.path, getattr(request.state, "query", request.url.query),
+                                 request.headers, None if streamed else body)
+        if streamed:
+            # request_body_stream copies the body as it passes through
+            request.state.capture = capture
+    try:
+        response = await call_next(request)
+    finally:
+        admission.release_body(reserved)
+        priority.release(ticket)
+    if capture is not None:
+        capture.responded(response.status_code)
+        capture.submit()
     response.headers["X-Elastic-Product"] = "Elasticsearch"
+    if budget is not None:
+        response.headers.update(budget)
     return response
 
+# Bulk writes are answered here, inside compression and metrics but ahead of routing
+app.add_middleware(BulkFastPath, config_manager=config_manager, policy_engine=policy_engine,
+                   rate_limiter=rate_limiter, priority=priority, admission=admission, compression=compression,
+                   resilience=resilience, response_cache=response_cache, bulk_spool=bulk_spool,
+                   shard_router=shard_router, bulk_fanout=bulk_fanout, bulk_coalescer=bulk_coalescer, bulk_item_retry=bulk_item_retry,
+                   mirror=mirror, metrics=metrics)
+app.add_middleware(CompressionMiddleware, compression=compression)
+# Added last so it wraps everything, including policy blocks and compression
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+# Inside the access log, so each record carries the phases of its request
+app.add_middleware(TimingMiddleware, timing=timing)
+# Outermost, so the recorded status and duration are what the client saw
+app.add_middleware(AccessLogMiddleware, access_log=access_log)
+
 @app.get("/stats")
 async def get_stats():
     return {
         "status": "online",
         "upstreams": upstream_manager.health_status,
+        "balancing": upstream_manager.stats(),
+        "health": state_follower.monitor if state_follower is not None else upstream_manager.monitor.stats(),
+        "pool": upstream_pool.stats(),
+        "resilience": resilience.stats(),
+        "bulk_coalescing": bulk_coalescer.stats(),
+        "shard_routing": shard_router.stats(),
+        "cache": response_cache.stats(),
+        "policy": policy_engine.stats(),
+        "rate_limit": rate_limiter.stats(),
+        "compression": compression.stats(),
+        "spool": bulk_spool.stats(),
+        "admission": admission.stats(),
+        "priority": priority.stats(),
+        "bulk_item_retry": bulk_item_retry.stats(),
+        "access_log": access_log.stats(),
+        "timing": timing.stats(),
+        "mirror": mirror.stats(),
+        "profiling": profiler.stats(),
+        "worker": state_follower.stats() if state_follower is not None else None,
         "config_path": CONFIG_PATH,
+        "config_version": config_manager.version,
+        "config_rejected": config_manager.rejected,
         "version": "3.0.0"
     }
 
+@app.get("/metrics")
+async def get_metrics():
+    if state_follower is not None:
+        # Any worker may take the scrape, so it answers for all of them
+        return Response(content=state_follower.render_metrics(), media_type=CONTENT_TYPE)
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
+@app.post("/debug/profile")
+async def run_profile(request: Request, seconds: float = 10.0, interval_ms: Optional[float] = None,
+                      idle: bool = False):
+    if not profiler.enabled:
+        return JSONResponse(status_code=404, content={"error": "Profiling is disabled (no profiling.token set)"})
+    if not profiler.authorized(request.headers.get("authorization")):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing bearer token"},
+                            headers={"WWW-Authenticate": "Bearer"})
+    try:
+        profile = await profiler.run(seconds, interval_ms / 1000 if interval_ms else None, idle)
+    except ProfilerBusy as exc:
+        return JSONResponse(status_code=409, content={"error": str(exc)})
+    return Response(content=profile.collapsed, media_type="text/plain; charset=utf-8", headers={
+        "X-Profile-Samples": str(profile.samples),
+        "X-Profile-Idle-Samples": str(profile.idle_samples),
+        "X-Loop-Lag-Max-Ms": str(profile.lag_max_ms),
+        "X-Loop-Lag-P99-Ms": str(profile.lag_p99_ms),
+        "X-Proxy-Worker": WORKER_ID or "main",
+    })
+
 @app.get("/_license")
 async def mock_license():
     return {
@@ -191,36 +317,252 @@ async def mock_license():
         }
     }
 
+def request_body_stream(request: Request):
+    """The client body, decoded if compressed and cut off at the policy size limit."""
+    stream = request.stream()
+    encoding = compression.decodable(request.headers)
+    if encoding:
+        stream = compression.decode_stream(stream, encoding)
+    stream = limited_stream(stream, getattr(request.state, "size_limit", None))
+    capture = getattr(request.state, "capture", None)
+    return capture.tee(stream) if capture is not None else stream
+
+async def proxy_bulk_fanout(path_name: str, request: Request):
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in REQUEST_HEADER_DROP}
+    if hasattr(request.state, "body"):
+        async def buffered():
+            yield request.state.body
+        stream = buffered()
+    else:
+        stream = request_body_stream(request)
+
+    try:
+        # Without a declared length, the size limit is only enforced as the body is read
+        buffer_first = (not hasattr(request.state, "body") and not request.headers.get("content-length", "").isdigit()
+                        and getattr(request.state, "size_limit", None) is not None)
+        result = await bulk_fanout.handle(stream, path_name, request.url.query, headers, buffer_first)
+    except PayloadTooLarge as exc:
+        policy_engine.record_size_block(request.url.path)
+        logger.warning(f"Policy Block: {exc} from {request.client.host}")
+        return JSONResponse(status_code=403, content={"error": str(exc)})
+    except Exception as exc:
+        logger.error(f"Internal proxy error: {exc}")
+        return JSONResponse(status_code=500, content={"error": "Internal Proxy Error"})
+    return JSONResponse(status_code=200, content=result)
+
+async def proxy_bulk_routed(path_name: str, request: Request) -> Optional[Response]:
+    """Send a bulk's items to their primaries; None when nothing could be routed (proxy it as usual)."""
+    headers = {k: v for k, v in request.headers.items()
+               if k.lower() not in REQUEST_HEADER_DROP and k.lower() != "content-encoding"}
+    try:
+        if not hasattr(request.state, "body"):
+            # Buffered (and decoded) for routing; the other bulk paths reuse it
+            request.state.body = b"".join([chunk async for chunk in request_body_stream(request)])
+        if not shard_router.may_route(request.state.body):
+            return None
+        result = await shard_router.handle(request.state.body, path_name, request.url.query, headers)
+    except PayloadTooLarge as exc:
+        policy_engine.record_size_block(request.url.path)
+        logger.warning(f"Policy Block: {exc} from {request.client.host}")
+        return JSONResponse(status_code=403, content={"error": str(exc)})
+    except DecodeError as exc:
+        return JSONResponse(status_code=400, content={"error": str(exc)})
+    except Exception as exc:
+        logger.error(f"Internal proxy error: {exc}")
+        return JSONResponse(status_code=500, content={"error": "Internal Proxy Error"})
+    return JSONResponse(status_code=200, content=result) if result is not None else None
+
+async def proxy_bulk_coalesced(path_name: str, request: Request) -> Optional[Response]:
+    """Merge a small bulk with others; None when its body is malformed (proxy it on its own)."""
+    headers = {k.lower(): v for k, v in request.headers.items()}
+    try:
+        if not hasattr(request.state, "body"):
+            request.state.body = b"".join([chunk async for chunk in request_body_stream(request)])
+        result = await bulk_coalescer.submit(request.state.body, path_name, request.url.query, headers)
+    except PayloadTooLarge as exc:
+        policy_engine.record_size_block(request.url.path)
+        logger.warning(f"Policy Block: {exc} from {request.client.host}")
+        return JSONResponse(status_code=403, content={"error": str(exc)})
+    except Exception as exc:
+        logger.error(f"Internal proxy error: {exc}")
+        return JSONResponse(status_code=500, content={"error": "Internal Proxy Error"})
+    return JSONResponse(status_code=200, content=result) if result is not None else None
+
+async def proxy_cached(path_name: str, request: Request, rule):
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in CACHED_REQUEST_HEADER_DROP}
+    query = getattr(request.state, "query", request.url.query)
+    upstream_path = f"{path_name}?{query}" if query else path_name
+
+    async def load():
+        call = await resilience.send(request.method, upstream_path, headers, None)
+        try:
+            body = await call.response.aread()
+        except httpx.RequestError:
+            await call.finish(ok=False)
+            raise
+        await call.finish()
+        # The body is stored decoded, so encoding and length headers are dropped
+        kept = [(k, v) for k, v in call.response.headers.items()
+                if k.lower() not in RESPONSE_HEADER_DROP]
+        return call.response.status_code, kept, body
+
+    key = response_cache.make_key(request.method, request.url.path, query, request.headers)
+    try:
+        entry = await response_cache.get_or_load(key, rule, load)
+    except Overloaded as exc:
+        return overloaded_response(exc)
+    except NoHealthyUpstream:
+        return JSONResponse(status_code=503, content={"error": "All upstreams are unavailable"})
+    except httpx.RequestError:
+        return JSONResponse(status_code=502, content={"error": "Failed to connect to upstream indexer"})
+    except Exception as exc:
+        logger.error(f"Internal proxy error: {exc}")
+        return JSONResponse(status_code=500, content={"error": "Internal Proxy Error"})
+
+    if entry.status == 200 and request.headers.get("if-none-match") == entry.etag:
+        response_cache.not_modified += 1
+        return Response(status_code=304, headers={"etag": entry.etag})
+    return Response(content=entry.body, status_code=entry.status, headers=dict(entry.headers))
+
+def spool_response(body: bytes) -> JSONResponse:
+    return JSONResponse(status_code=200, content={"took": 0, "errors": False, "items": accepted_items(body)},
+                        headers={"X-Proxy-Spooled": "true"})
+
+def overloaded_response(exc: Overloaded) -> JSONResponse:
+    return JSONResponse(status_code=429, content={"error": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+def spool_full_response() -> JSONResponse:
+    return JSONResponse(status_code=429, content={"error": "Bulk spool is full, retry later"},
+                        headers={"Retry-After": str(bulk_spool.retry_after())})
+
+async def proxy_bulk_spooled(path_name: str, request: Request):
+    try:
+        if hasattr(request.state, "body"):
+            body = request.state.body
+        else:
+            body = b"".join([chunk async for chunk in request_body_stream(request)])
+        await bulk_spool.append(path_name, request.url.query, request.headers, body)
+    except SpoolFull:
+        return spool_full_response()
+    except PayloadTooLarge as exc:
+        policy_engine.record_size_block(request.url.path)
+        logger.warning(f"Policy Block: {exc} from {request.client.host}")
+        return JSONResponse(status_code=403, content={"error": str(exc)})
+    except DecodeError as exc:
+        return JSONResponse(status_code=400, content={"error": str(exc)})
+    except OSError as exc:
+        logger.error(f"Bulk spool write failed: {exc}")
+        return JSONResponse(status_code=503, content={"error": "All upstreams are unavailable"})
+    return spool_response(body)
+
 @app.api_route("/{path_name:path}", methods=["GET", "POST", "PUT", "HEAD"])
-@limiter.limit("1000/minute")
 async def proxy_request(path_name: str, request: Request, response: Response):
-    target_url = upstream_manager.get_next_target()
-    if not target_url:
-        return JSONResponse(status_code=503, content={"error": "All upstreams are unavailable"})
+    if request.method in ("GET", "HEAD"):
+        rule = response_cache.rule_for(request.url.path)
+        if rule is not None and "content-length" not in request.headers and "transfer-encoding" not in request.headers:
+            return await proxy_cached(path_name, request, rule)
+    else:
+        response_cache.invalidate(request.url.path)
+
+    spoolable = bulk_spool.applies(request.method, path_name)
+    item_retry = bulk_item_retry.enabled and request.method in ("POST", "PUT") and is_bulk_path(path_name)
+    if spoolable and bulk_spool.should_absorb():
+        return await proxy_bulk_spooled(path_name, request)
+
+    if shard_router.applies(request.method, path_name):
+        routed = await proxy_bulk_routed(path_name, request)
+        if routed is not None:
+            return routed
+    if bulk_coalescer.applies(request.method, path_name, request.headers):
+        coalesced = await proxy_bulk_coalesced(path_name, request)
+        if coalesced is not None:
+            return coalesced
+    if bulk_fanout.applies(request.method, path_name, request.headers):
+        return await proxy_bulk_fanout(path_name, request)
+
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in REQUEST_HEADER_DROP}
+    encoding = compression.decodable(request.headers)
+    if encoding:
+        # The body is forwarded decoded (and possibly recompressed upstream)
+        headers.pop("content-encoding", None)
+    upstream_accept = compression.upstream_accept_encoding()
+    if upstream_accept:
+        headers["accept-encoding"] = upstream_accept
 
-    url = f"{target_url}/{path_name}"
-    headers = {k: v for k, v in request.headers.items() if k.lower() not in ["host", "content-length", "connection"]}
-    
     try:
-        content = getattr(request.state, "body", b"")
-        timeout_val = config_manager.config.get("upstream", {}).get("timeout", 30.0)
-        timeout = httpx.Timeout(timeout_val)
-        
-        async with httpx.AsyncClient(verify=config_manager.ssl_context, timeout=timeout) as client:
-            proxy_req = client.build_request(request.method, url, headers=headers, content=content)
-            upstream_response = await client.send(proxy_req)
-            
-            response.status_code = upstream_response.status_code
-            for k, v in upstream_response.headers.items():
-                if k.lower() not in ["transfer-encoding", "connection", "content-length"]:
-                     response.headers[k] = v
-            
-            return Response(content=upstream_response.content, status_code=upstream_response.status_code, headers=dict(response.headers))
-            
-    except httpx.RequestError as exc:
-        logger.error(f"Upstream Error ({url}): {exc}")
-        upstream_manager.mark_unhealthy(target_url)
+        if hasattr(request.state, "body"):
+            content = request.state.body
+        elif "content-length" not in request.headers and "transfer-encoding" not in request.headers:
+            content = None
+        elif spoolable or item_retry:
+            # Kept in memory so it can be spooled if the cluster answers 429, or its rejected items resent
+            content = b"".join([chunk async for chunk in request_body_stream(request)])
+        else:
+            # Pipe the client body to the upstream as it arrives
+            content = request_body_stream(request)
+            if "content-length" in request.headers and not encoding:
+                headers["content-length"] = request.headers["content-length"]
+
+        # Search guardrails may have rewritten the query string
+        query = getattr(request.state, "query", request.url.query)
+        call = await resilience.send(request.method, f"{path_name}?{query}" if query else path_name, headers, content)
+    except Overloaded as exc:
+        return overloaded_response(exc)
+    except NoHealthyUpstream:
+        return JSONResponse(status_code=503, content={"error": "All upstreams are unavailable"})
+    except PayloadTooLarge as exc:
+        policy_engine.record_size_block(request.url.path)
+        logger.warning(f"Policy Block: {exc} from {request.client.host}")
+        return JSONResponse(status_code=403, content={"error": str(exc)})
+    except DecodeError as exc:
+        return JSONResponse(status_code=400, content={"error": str(exc)})
+    except httpx.RequestError:
         return JSONResponse(status_code=502, content={"error": "Failed to connect to upstream indexer"})
     except Exception as exc:
         logger.error(f"Internal proxy error: {exc}")
         return JSONResponse(status_code=500, content={"error": "Internal Proxy Error"})
+
+    upstream_response = call.response
+    if spoolable and upstream_response.status_code == 429:
+        await call.finish()
+        try:
+            await bulk_spool.append(path_name, request.url.query, request.headers, content)
+        except SpoolFull:
+            return spool_full_response()
+        except OSError as exc:
+            logger.error(f"Bulk spool write failed: {exc}")
+            return JSONResponse(status_code=503, content={"error": "All upstreams are unavailable"})
+        return spool_response(content)
+
+    response.status_code = upstream_response.status_code
+    for k, v in upstream_response.headers.items():
+        if k.lower() not in RESPONSE_HEADER_DROP:
+             response.headers[k] = v
+
+    if config_manager.snapshot.stream_responses and not item_retry:
+        upstream_encoding = upstream_response.headers.get("content-encoding")
+        accepted = request.headers.get("accept-encoding", "")
+        if upstream_encoding and upstream_encoding in accepted:
+            # Relay the raw (still encoded) bytes as they arrive from the indexer
+            response.headers["content-encoding"] = upstream_encoding
+            body = upstream_response.aiter_raw()
+        else:
+            body = upstream_response.aiter_bytes()
+        return StreamingResponse(body, status_code=upstream_response.status_code,
+                                 headers=dict(response.headers), background=BackgroundTask(call.finish))
+
+    try:
+        await upstream_response.aread()
+    except httpx.RequestError as exc:
+        logger.error(f"Upstream Error ({call.target_url}/{path_name}): {exc}")
+        await call.finish(ok=False)
+        return JSONResponse(status_code=502, content={"error": "Failed to connect to upstream indexer"})
+    await call.finish()
+    data = upstream_response.content
+    if item_retry and isinstance(content, bytes):
+        merged = await bulk_item_retry.complete(path_name, request.url.query, headers, content,
+                                                upstream_response.status_code, data, call.target_url)
+        if merged is not None:
+            data = merged
+    # `data` is decoded; CompressionMiddleware re-encodes it for the client
+    return Response(content=data, status_code=upstream_response.status_code, headers=dict(response.headers))
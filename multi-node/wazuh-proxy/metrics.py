@@ -0,0 +1,298 @@
+import logging
+import time
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Tuple
+
+logger = logging.getLogger("wazuh-proxy")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INF_LABEL = 'le="+Inf"'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# API segments that get their own path class; anything else is "other", so
+# index names or document ids never become label values.
+API_SEGMENTS = frozenset((
+    "_bulk", "_search", "_msearch", "_count", "_mget", "_doc", "_create", "_update",
+    "_cluster", "_nodes", "_cat", "_index_template", "_template", "_component_template",
+    "_ilm", "_ingest", "_plugins", "_license", "_xpack", "_security", "_alias", "_aliases",
+    "_mapping", "_settings", "_refresh", "_stats", "_data_stream",
+))
+ADMIN_PATHS = frozenset(("/stats", "/metrics", "/debug/profile"))
+
+# A collector returns (name, type, help, [(labels, value), ...]) families
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+@lru_cache(maxsize=4096)
+def classify_path(path: str) -> str:
+    """Map a request path to a small, fixed set of label values."""
+    if path in ADMIN_PATHS:
+        return "admin"
+    segments = [s for s in path.split("/") if s]
+    if not segments:
+        return "root"
+    for segment in segments:
+        if segment.startswith("_"):
+            return segment if segment in API_SEGMENTS else "other"
+    return "index"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _with_label(sample: str, label: str) -> str:
+    space = sample.index(" ")
+    brace = sample.find("{", 0, space)
+    if brace == -1:
+        return f"{sample[:space]}{{{label}}}{sample[space:]}"
+    return f"{sample[:brace + 1]}{label},{sample[brace + 1:]}"
+
+
+def merge_expositions(texts: Dict[str, str]) -> str:
+    """Combine the expositions of several workers into one valid document.
+
+    Every sample gets a `worker` label and the samples of a family are kept
+    together under a single HELP/TYPE header, as the text format requires.
+    """
+    headers: Dict[str, List[str]] = {}
+    samples: Dict[str, List[str]] = {}
+    for worker, text in texts.items():
+        label = f'worker="{_escape(worker)}"'
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                if len(parts) < 3:
+                    continue
+                family = parts[2]
+                if family not in headers:
+                    headers[family] = []
+                    samples[family] = []
+                if len(headers[family]) < 2 and line not in headers[family]:
+                    headers[family].append(line)
+            elif family is not None:
+                samples[family].append(_with_label(line, label))
+    out: List[str] = []
+    for family, lines in headers.items():
+        out.extend(lines)
+        out.extend(samples[family])
+    out.append("")
+    return "\n".join(out)
+
+
+class Histogram:
+    """Fixed-bucket histogram; buckets are stored non-cumulative and summed on render."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class ProxyMetrics:
+    """Prometheus metrics for proxied traffic.
+
+    Recording is a few dict lookups and integer additions per request; the
+    text exposition is only built when `/metrics` is scraped. Gauges that
+    mirror other subsystems (pool, breakers, cache...) are read at scrape
+    time through registered collectors.
+    """
+
+    REQUEST_LABELS = ("path_class", "method", "status")
+    DURATION_LABELS = ("path_class", "method")
+    UPSTREAM_LABELS = ("upstream", "status")
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.enabled = True
+        self.buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+        self.inflight = 0
+        self.requests: Dict[Tuple, int] = {}
+        self.durations: Dict[Tuple, Histogram] = {}
+        self.bytes_in: Dict[str, int] = {}
+        self.bytes_out: Dict[str, int] = {}
+        self.upstream_requests: Dict[Tuple, int] = {}
+        self.upstream_durations: Dict[str, Histogram] = {}
+        self.lane_waits: Dict[str, Histogram] = {}
+        self.lane_durations: Dict[str, Histogram] = {}
+        self.phase_durations: Dict[str, Histogram] = {}
+        self.rate_limited = 0
+        self.collectors: List[Callable[[], Iterable[Family]]] = []
+        self.rebuild()
+
+    def rebuild(self):
+        settings = self.config_manager.snapshot.metrics
+        self.enabled = bool(settings.get("enabled", True))
+        buckets = tuple(sorted(float(b) for b in settings.get("buckets", DEFAULT_BUCKETS)))
+        if buckets != self.buckets:
+            # Old observations cannot be re-bucketed
+            self.buckets = buckets
+            self.durations.clear()
+            self.upstream_durations.clear()
+            self.lane_waits.clear()
+            self.lane_durations.clear()
+            self.phase_durations.clear()
+
+    def add_collector(self, collector: Callable[[], Iterable[Family]]):
+        self.collectors.append(collector)
+
+    def observe_request(self, path_class: str, method: str, status: int, seconds: float,
+                        bytes_in: int, bytes_out: int):
+        key = (path_class, method, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        key = (path_class, method)
+        histogram = self.durations.get(key)
+        if histogram is None:
+            histogram = self.durations[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        if bytes_in:
+            self.bytes_in[path_class] = self.bytes_in.get(path_class, 0) + bytes_in
+        if bytes_out:
+            self.bytes_out[path_class] = self.bytes_out.get(path_class, 0) + bytes_out
+
+    def observe_upstream(self, upstream: str, status, seconds: float):
+        key = (upstream, status)
+        self.upstream_requests[key] = self.upstream_requests.get(key, 0) + 1
+        histogram = self.upstream_durations.get(upstream)
+        if histogram is None:
+            histogram = self.upstream_durations[upstream] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def _observe(self, histograms: Dict[str, Histogram], key: str, seconds: float):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        histogram.observe(seconds)
+
+    def observe_lane_wait(self, lane: str, seconds: float):
+        self._observe(self.lane_waits, lane, seconds)
+
+    def observe_lane_duration(self, lane: str, seconds: float):
+        self._observe(self.lane_durations, lane, seconds)
+
+    def observe_phase(self, phase: str, seconds: float):
+        self._observe(self.phase_durations, phase, seconds)
+
+    def _render_histograms(self, out: List[str], name: str, help_text: str,
+                           label_names: Tuple[str, ...], histograms: Dict):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} histogram")
+        for key, histogram in list(histograms.items()):
+            values = key if isinstance(key, tuple) else (key,)
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                le = 'le="%g"' % bound
+                out.append(f"{name}_bucket{_labels(label_names, values, le)} {cumulative}")
+            out.append(f"{name}_bucket{_labels(label_names, values, INF_LABEL)} {histogram.count}")
+            out.append(f"{name}_sum{_labels(label_names, values)} {histogram.sum:.6f}")
+            out.append(f"{name}_count{_labels(label_names, values)} {histogram.count}")
+
+    @staticmethod
+    def _render_family(out: List[str], name: str, kind: str, help_text: str, samples):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            names = tuple(labels.keys())
+            out.append(f"{name}{_labels(names, tuple(labels.values()))} {value}")
+
+    def render(self) -> str:
+        out: List[str] = []
+        self._render_family(out, "wazuh_proxy_requests_total", "counter", "Requests handled by the proxy.",
+                            [(dict(zip(self.REQUEST_LABELS, k)), v) for k, v in list(self.requests.items())])
+        self._render_histograms(out, "wazuh_proxy_request_duration_seconds",
+                                "Time from request start to the last response byte.",
+                                self.DURATION_LABELS, self.durations)
+        self._render_family(out, "wazuh_proxy_request_bytes_total", "counter", "Request body bytes received.",
+                            [({"path_class": k}, v) for k, v in list(self.bytes_in.items())])
+        self._render_family(out, "wazuh_proxy_response_bytes_total", "counter", "Response body bytes sent.",
+                            [({"path_class": k}, v) for k, v in list(self.bytes_out.items())])
+        self._render_family(out, "wazuh_proxy_inflight_requests", "gauge", "Requests currently being handled.",
+                            [({}, self.inflight)])
+        self._render_family(out, "wazuh_proxy_rate_limited_total", "counter", "Requests rejected by the rate limiter.",
+                            [({}, self.rate_limited)])
+        self._render_family(out, "wazuh_proxy_upstream_requests_total", "counter", "Requests sent to each upstream.",
+                            [(dict(zip(self.UPSTREAM_LABELS, k)), v) for k, v in list(self.upstream_requests.items())])
+        self._render_histograms(out, "wazuh_proxy_upstream_duration_seconds",
+                                "Upstream time from sending the request to releasing the response.",
+                                ("upstream",), self.upstream_durations)
+        if self.lane_durations:
+            self._render_histograms(out, "wazuh_proxy_priority_wait_seconds",
+                                    "Time a request waited for its priority class's turn.",
+                                    ("class",), self.lane_waits)
+            self._render_histograms(out, "wazuh_proxy_priority_duration_seconds",
+                                    "Time from arrival to the upstream response, per priority class.",
+                                    ("class",), self.lane_durations)
+        if self.phase_durations:
+            self._render_histograms(out, "wazuh_proxy_phase_duration_seconds",
+                                    "Time requests spent in each phase (body read, policy, queue, upstream...).",
+                                    ("phase",), self.phase_durations)
+        for collector in self.collectors:
+            try:
+                for family in collector():
+                    self._render_family(out, *family)
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        out.append("")
+        return "\n".join(out)
+
+
+class MetricsMiddleware:
+    """Raw ASGI middleware: counts bytes in both directions and times the full response."""
+
+    def __init__(self, app, metrics: ProxyMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        metrics = self.metrics
+        if scope["type"] != "http" or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        bytes_in = 0
+        bytes_out = 0
+
+        async def counting_receive():
+            nonlocal bytes_in
+            message = await receive()
+            if message["type"] == "http.request":
+                bytes_in += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, bytes_out
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                bytes_out += len(message.get("body", b""))
+            await send(message)
+
+        metrics.inflight += 1
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            metrics.inflight -= 1
+            metrics.observe_request(classify_path(scope["path"]), scope["method"], status,
+                                    time.perf_counter() - started, bytes_in, bytes_out)
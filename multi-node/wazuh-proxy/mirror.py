@@ -0,0 +1,329 @@
+import asyncio
+import fnmatch
+import logging
+import random
+import re
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import httpx
+
+from forwarding import REQUEST_HEADER_DROP
+from metrics import classify_path
+from resilience import LatencyWindow
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+# Hop-by-hop headers plus those describing the client's encoding; mirrored bodies are decoded
+MIRROR_HEADER_DROP = REQUEST_HEADER_DROP | {"content-encoding", "accept-encoding"}
+SKIP_REASONS = ("queue_full", "too_large", "incomplete")
+QUANTILES = (50, 95, 99)
+
+
+def status_class(status: Optional[int]) -> str:
+    return "error" if status is None else f"{status // 100}xx"
+
+
+class MirrorRule(NamedTuple):
+    paths: Tuple[re.Pattern, ...]
+    methods: Optional[frozenset]
+    fraction: float
+
+
+class Job(NamedTuple):
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+    primary_status: int
+    primary_latency: float
+
+
+class TargetStats:
+    """Outcomes and latency of the mirrored requests on one side of the comparison."""
+
+    def __init__(self):
+        self.statuses: Dict[str, int] = {}
+        self.latency = LatencyWindow()
+        self.mismatches = 0
+
+    def record(self, status: Optional[int], latency: Optional[float]):
+        key = status_class(status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if latency is not None:
+            self.latency.record(latency)
+
+    def stats(self) -> Dict:
+        requests = sum(self.statuses.values())
+        failed = self.statuses.get("5xx", 0) + self.statuses.get("error", 0)
+        result = {
+            "requests": requests,
+            "statuses": dict(self.statuses),
+            "error_rate": round(failed / requests, 4) if requests else None,
+        }
+        for q in QUANTILES:
+            value = self.latency.percentile(q)
+            result[f"p{q}_ms"] = round(value * 1000, 2) if value is not None else None
+        return result
+
+
+class Capture:
+    """Collects what is needed to mirror one request while the primary path serves it."""
+
+    def __init__(self, mirror: "ShadowMirror", method: str, path: str, query: str, headers: Dict[str, str],
+                 body: Optional[bytes]):
+        self.mirror = mirror
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.complete = body is not None
+        self.status: Optional[int] = None
+        self.latency = 0.0
+        self.started = time.perf_counter()
+
+    async def tee(self, stream):
+        """Pass a streamed body through, keeping a copy up to the mirror's size limit."""
+        limit = self.mirror.max_body
+        async for chunk in stream:
+            if self.chunks is not None:
+                self.size += len(chunk)
+                if self.size > limit:
+                    self.chunks = None
+                else:
+                    self.chunks.append(chunk)
+            yield chunk
+        self.complete = True
+
+    def wrap_send(self, send):
+        async def capturing_send(message):
+            if message["type"] == "http.response.start":
+                self.responded(message["status"])
+            await send(message)
+        return capturing_send
+
+    def responded(self, status: int):
+        self.status = status
+        self.latency = time.perf_counter() - self.started
+
+    def submit(self):
+        mirror = self.mirror
+        if self.status is None or not self.complete:
+            mirror.skip("incomplete")
+            return
+        if self.body is None and self.chunks is None:
+            mirror.skip("too_large")
+            return
+        body = self.body if self.body is not None else b"".join(self.chunks)
+        mirror.offer(self.method, self.path, self.query, self.headers, body, self.status, self.latency)
+
+
+class ShadowMirror:
+    """Copies a sample of live requests to shadow upstreams, off the request path.
+
+    Requests are picked by the first rule whose path patterns (and methods)
+    match, with that rule's `percent` probability. Once the primary has
+    answered, the request body and the primary's status and latency go
+    into a bounded queue (`queue_size` requests, `max_queued_mb` bytes);
+    when it is full the copy is dropped, never waited for. Workers send each
+    copy to every shadow target through their own connection pool, at most
+    `concurrency` at a time, read and discard the answer, and record the
+    status and time to response headers next to the primary's.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.queue: deque = deque()
+        self.queued_bytes = 0
+        self.wakeup = asyncio.Event()
+        self.slot_freed = asyncio.Event()
+        self.inflight = 0
+        self.tasks: Set[asyncio.Task] = set()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.client_key = None
+        self.primary = TargetStats()
+        self.shadows: Dict[str, TargetStats] = {}
+        self.mirrored = 0
+        self.skipped = dict.fromkeys(SKIP_REASONS, 0)
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.mirror
+
+    def rebuild(self):
+        settings = self._settings()
+        targets = []
+        for entry in settings.get("targets") or []:
+            url = entry.get("url") if isinstance(entry, dict) else entry
+            if isinstance(url, str) and url.startswith(("http://", "https://")):
+                targets.append(url.rstrip("/"))
+            else:
+                logger.error(f"Ignoring mirror target without a valid http(s) url: {entry}")
+        self.targets = tuple(targets)
+        self.enabled = bool(settings.get("enabled", False)) and bool(self.targets)
+        rules = []
+        for rule in settings.get("rules") or [{"paths": ["*"], "percent": settings.get("percent", 100)}]:
+            paths = rule.get("paths") or ["*"]
+            methods = rule.get("methods")
+            rules.append(MirrorRule(
+                tuple(re.compile(fnmatch.translate(p)) for p in ([paths] if isinstance(paths, str) else paths)),
+                frozenset(m.upper() for m in methods) if methods else None,
+                min(max(float(rule.get("percent", 100)), 0.0), 100.0) / 100,
+            ))
+        self.rules = tuple(rules)
+        self.queue_size = int(settings.get("queue_size", 1000))
+        self.max_queued = int(settings.get("max_queued_mb", 256) * MB)
+        self.max_body = int(settings.get("max_body_mb", 32) * MB)
+        self.concurrency = max(1, int(settings.get("concurrency", 8)))
+        self.slot_freed.set()
+        for url in self.targets:
+            self.shadows.setdefault(url, TargetStats())
+
+        snapshot = self.config_manager.snapshot
+        timeout = settings.get("timeout", 30.0)
+        key = (id(snapshot.ssl_context), self.concurrency, len(self.targets), timeout)
+        if self.enabled and key != self.client_key:
+            old = self.client
+            self.client = httpx.AsyncClient(
+                verify=snapshot.ssl_context,
+                timeout=timeout,
+                limits=httpx.Limits(max_connections=self.concurrency * len(self.targets),
+                                    max_keepalive_connections=self.concurrency * len(self.targets)),
+            )
+            self.client_key = key
+            if old is not None:
+                self._close_later(old, timeout)
+
+    def _close_later(self, client: httpx.AsyncClient, delay: float):
+        async def close():
+            # Copies already being sent on the old client get their timeout to finish
+            await asyncio.sleep(delay)
+            await client.aclose()
+        try:
+            task = asyncio.get_running_loop().create_task(close())
+        except RuntimeError:
+            return
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def sample(self, method: str, path: str) -> bool:
+        """Whether to mirror this request; decided before it is served."""
+        if not self.enabled or classify_path(path) == "admin":
+            return False
+        for rule in self.rules:
+            if any(p.match(path) for p in rule.paths) and (rule.methods is None or method in rule.methods):
+                return rule.fraction >= 1.0 or random.random() < rule.fraction
+        return False
+
+    def capture(self, method: str, path: str, query: str, headers, body: Optional[bytes]) -> Capture:
+        headers = {k: v for k, v in headers.items() if k.lower() not in MIRROR_HEADER_DROP}
+        return Capture(self, method, path, query, headers, body)
+
+    def skip(self, reason: str):
+        self.skipped[reason] += 1
+
+    def offer(self, method: str, path: str, query: str, headers: Dict[str, str], body: bytes,
+              primary_status: int, primary_latency: float):
+        """Queue a copy of a served request; never blocks."""
+        if len(body) > self.max_body:
+            self.skip("too_large")
+            return
+        if len(self.queue) >= self.queue_size or self.queued_bytes + len(body) > self.max_queued:
+            self.skip("queue_full")
+            return
+        self.mirrored += 1
+        target_path = path.lstrip("/")
+        self.queue.append(Job(method, f"{target_path}?{query}" if query else target_path, headers, body,
+                              primary_status, primary_latency))
+        self.queued_bytes += len(body)
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            while self.inflight >= self.concurrency:
+                self.slot_freed.clear()
+                await self.slot_freed.wait()
+            job = self.queue.popleft()
+            self.queued_bytes -= len(job.body)
+            self.inflight += 1
+            task = asyncio.create_task(self._mirror(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _mirror(self, job: Job):
+        try:
+            targets = self.targets
+            results = await asyncio.gather(*(self._send(url, job) for url in targets))
+            self.primary.record(job.primary_status, job.primary_latency)
+            for url, (status, latency) in zip(targets, results):
+                stats = self.shadows.setdefault(url, TargetStats())
+                stats.record(status, latency)
+                if status_class(status) != status_class(job.primary_status):
+                    stats.mismatches += 1
+        finally:
+            self.inflight -= 1
+            self.slot_freed.set()
+
+    async def _send(self, url: str, job: Job) -> Tuple[Optional[int], Optional[float]]:
+        started = time.perf_counter()
+        try:
+            request = self.client.build_request(job.method, f"{url}/{job.path}", headers=job.headers,
+                                                content=job.body)
+            response = await self.client.send(request, stream=True)
+            latency = time.perf_counter() - started
+            try:
+                async for _ in response.aiter_raw():
+                    pass
+            finally:
+                await response.aclose()
+        except httpx.HTTPError as e:
+            logger.debug(f"Mirror request to {url} failed: {e}")
+            return None, None
+        return response.status_code, latency
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    def metric_families(self):
+        sides = [("primary", "primary", self.primary)] + [(url, "shadow", s) for url, s in self.shadows.items()]
+        yield ("wazuh_proxy_mirror_requests_total", "counter",
+               "Mirrored requests by side and status class; primary counts the same requests' original answers.",
+               [({"target": target, "role": role, "status_class": key}, count)
+                for target, role, side in sides for key, count in list(side.statuses.items())])
+        yield ("wazuh_proxy_mirror_latency_seconds", "gauge",
+               "Recent time to response headers of mirrored requests, primary and shadow side by side.",
+               [({"target": target, "role": role, "quantile": f"{q / 100:g}"}, round(value, 6))
+                for target, role, side in sides for q in QUANTILES
+                for value in [side.latency.percentile(q)] if value is not None])
+        yield ("wazuh_proxy_mirror_status_mismatches_total", "counter",
+               "Mirrored requests whose shadow status class differed from the primary's.",
+               [({"target": url}, s.mismatches) for url, s in self.shadows.items()])
+        yield ("wazuh_proxy_mirror_skipped_total", "counter", "Sampled requests that were not mirrored.",
+               [({"reason": reason}, count) for reason, count in self.skipped.items()])
+        yield ("wazuh_proxy_mirror_queue_depth", "gauge", "Copies waiting to be sent to the shadow targets.",
+               [({}, len(self.queue))])
+
+    def stats(self) -> Dict:
+        shadows = {}
+        for url, side in self.shadows.items():
+            shadows[url] = dict(side.stats(), status_mismatches=side.mismatches)
+        return {
+            "enabled": self.enabled,
+            "mirrored": self.mirrored,
+            "skipped": self.skipped,
+            "queued": len(self.queue),
+            "queued_bytes": self.queued_bytes,
+            "inflight": self.inflight,
+            "primary": self.primary.stats(),
+            "shadows": shadows,
+        }
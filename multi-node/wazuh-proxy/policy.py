@@ -0,0 +1,173 @@
+import logging
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+
+# Fields a more specific policy can override; anything it leaves out is
+# inherited from the closest less specific policy ("*" being the root).
+POLICY_FIELDS = ("allowed_methods", "blocked_methods", "max_size_mb")
+
+
+class CompiledPolicy:
+    """Effective rule for a path prefix, with method sets and byte limits precomputed."""
+
+    __slots__ = ("path", "allowed", "blocked", "max_size_mb", "max_bytes")
+
+    def __init__(self, path: str, fields: Dict):
+        self.path = path
+        allowed = fields.get("allowed_methods")
+        self.allowed: Optional[FrozenSet[str]] = frozenset(allowed) if allowed else None
+        self.blocked: FrozenSet[str] = frozenset(fields.get("blocked_methods") or ())
+        self.max_size_mb = fields.get("max_size_mb")
+        self.max_bytes: Optional[int] = int(self.max_size_mb * MB) if self.max_size_mb else None
+
+
+class _Node:
+    __slots__ = ("label", "children", "rule")
+
+    def __init__(self, label: str = ""):
+        self.label = label
+        self.children: Dict[str, "_Node"] = {}
+        self.rule: Optional[CompiledPolicy] = None
+
+
+class PolicyIndex:
+    """Radix tree of path-prefix policies with most-specific-match lookup.
+
+    Lookup cost depends on the depth of the matching prefix, not on the
+    number of policies.
+    """
+
+    def __init__(self, policies: List[Dict]):
+        self.size = len(policies)
+        merged: Dict[str, Dict] = {}
+        for policy in policies:
+            path = policy.get("path")
+            if not isinstance(path, str) or not path:
+                raise ValueError(f"Policy without a valid path: {policy}")
+            key = "" if path == "*" else path
+            fields = merged.setdefault(key, {})
+            fields.update({f: policy[f] for f in POLICY_FIELDS if f in policy})
+
+        root_fields = merged.pop("", {})
+        self.root = _Node()
+        self.root.rule = CompiledPolicy("*", root_fields)
+        inherited = {"*": root_fields}
+        # Shorter prefixes first so each rule can inherit from its closest ancestor
+        for path in sorted(merged, key=len):
+            node = self._insert(path)
+            fields = dict(inherited[self.lookup(path[:-1]).path])
+            fields.update(merged[path])
+            inherited[path] = fields
+            node.rule = CompiledPolicy(path, fields)
+
+    def _insert(self, path: str) -> _Node:
+        node = self.root
+        i = 0
+        while i < len(path):
+            child = node.children.get(path[i])
+            if child is None:
+                child = _Node(path[i:])
+                node.children[path[i]] = child
+                return child
+            label = child.label
+            common = 0
+            limit = min(len(label), len(path) - i)
+            while common < limit and label[common] == path[i + common]:
+                common += 1
+            if common < len(label):
+                # Split the edge at the first differing character
+                split = _Node(label[:common])
+                child.label = label[common:]
+                split.children[child.label[0]] = child
+                node.children[path[i]] = split
+                child = split
+            node = child
+            i += common
+        return node
+
+    def lookup(self, path: str) -> CompiledPolicy:
+        node = self.root
+        best = node.rule
+        i = 0
+        n = len(path)
+        while i < n:
+            child = node.children.get(path[i])
+            if child is None or not path.startswith(child.label, i):
+                break
+            node = child
+            i += len(child.label)
+            if node.rule is not None:
+                best = node.rule
+        return best
+
+
+class PolicyEngine:
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.index = PolicyIndex([])
+        # Block counts keyed by (governing policy path, reason)
+        self.blocks: Dict[Tuple[str, str], int] = {}
+        # Searches changed by each rewriting guardrail
+        self.rewrites: Dict[str, int] = {}
+        self.rebuild()
+
+    def rebuild(self):
+        """Adopt the policy index and search guardrails compiled (and validated) with the configuration."""
+        self.index = self.config_manager.snapshot.policies
+        self.guard = self.config_manager.snapshot.search_guardrails
+        logger.info(f"Compiled {self.index.size} security policies and {len(self.guard.rules)} search guardrails")
+
+    def evaluate(self, method: str, path: str, body_size: int = 0) -> Optional[str]:
+        # Default block for dangerous methods
+        if method == "DELETE":
+            self.record_block("*", "delete")
+            return "DELETE method is explicitly forbidden."
+
+        rule = self.index.lookup(path)
+        if method in rule.blocked:
+            self.record_block(rule.path, "method_blocked")
+            return f"Method {method} is blocked for path {path}"
+        if rule.allowed is not None and method not in rule.allowed:
+            self.record_block(rule.path, "method_not_allowed")
+            return f"Method {method} is not in allowed list for path {path}"
+        if rule.max_bytes is not None and body_size > rule.max_bytes:
+            self.record_block(rule.path, "size")
+            return f"Payload size exceeds limit of {rule.max_size_mb}MB"
+        return None
+
+    def inspects_search(self, method: str, path: str) -> bool:
+        """Whether the request is a search whose body must be read for `inspect_search`."""
+        return self.guard.applies(method, path)
+
+    def inspect_search(self, path: str, query: str, body: bytes) -> Tuple[Optional[str], bytes, str]:
+        """Run the search guardrails; returns an error, or the body and query to send upstream."""
+        verdict = self.guard.check(path, query, body)
+        if verdict.error:
+            self.record_block(f"search:{verdict.rule}", "search_guardrail")
+            return verdict.error, body, query
+        for name in verdict.rewritten:
+            self.rewrites[name] = self.rewrites.get(name, 0) + 1
+        return None, verdict.body, verdict.query
+
+    def record_block(self, rule_path: str, reason: str):
+        key = (rule_path, reason)
+        self.blocks[key] = self.blocks.get(key, 0) + 1
+
+    def size_limit(self, path: str) -> Optional[int]:
+        """Body size limit in bytes of the policy governing the path."""
+        return self.index.lookup(path).max_bytes
+
+    def record_size_block(self, path: str):
+        """Count a body that went over the limit while it was being streamed."""
+        self.record_block(self.index.lookup(path).path, "size")
+
+    def stats(self) -> Dict:
+        return {
+            "policies": self.index.size,
+            "search_guardrails": len(self.guard.rules) if self.guard.enabled else 0,
+            "blocks": {f"{rule} {reason}": n for (rule, reason), n in list(self.blocks.items())},
+            "search_rewrites": dict(self.rewrites),
+        }
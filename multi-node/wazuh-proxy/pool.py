@@ -0,0 +1,157 @@
+import asyncio
+import importlib.util
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+import httpx
+
+logger = logging.getLogger("wazuh-proxy")
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class PoolGeneration:
+    """A set of clients built from one SSL context.
+
+    A generation is retired when the configuration is reloaded. Requests that
+    already hold a lease keep using it and the clients are closed once the
+    last lease is released (or the drain timeout expires).
+    """
+
+    def __init__(self, number: int, ssl_context, settings: Dict, timeout: httpx.Timeout):
+        self.number = number
+        self.ssl_context = ssl_context
+        self.settings = settings
+        self.timeout = timeout
+        self.clients: Dict[str, httpx.AsyncClient] = {}
+        self.inflight = 0
+        self.retired = False
+        self.drained = asyncio.Event()
+
+    def client_for(self, url: str) -> httpx.AsyncClient:
+        client = self.clients.get(url)
+        if client is None:
+            client = self._build_client(url)
+            self.clients[url] = client
+        return client
+
+    def _build_client(self, url: str) -> httpx.AsyncClient:
+        s = self.settings
+        http2 = bool(s.get("http2", False))
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("HTTP/2 requested for upstream pool but 'h2' is not installed, using HTTP/1.1")
+            http2 = False
+        limits = httpx.Limits(
+            max_connections=s.get("max_connections", 100),
+            max_keepalive_connections=s.get("max_keepalive_connections", 20),
+            keepalive_expiry=s.get("keepalive_expiry", 30.0),
+        )
+        return httpx.AsyncClient(
+            verify=self.ssl_context,
+            http2=http2,
+            limits=limits,
+            timeout=self.timeout,
+        )
+
+    async def aclose(self):
+        for client in self.clients.values():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.debug(f"Error closing upstream client: {e}")
+        self.clients.clear()
+
+
+class UpstreamPool:
+    """Long-lived keep-alive clients, one per upstream target."""
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self._counter = 0
+        self.current = self._new_generation()
+        self._retired: List[PoolGeneration] = []
+
+    def _new_generation(self) -> PoolGeneration:
+        self._counter += 1
+        snapshot = self.config_manager.snapshot
+        return PoolGeneration(self._counter, snapshot.ssl_context, snapshot.pool, snapshot.timeout)
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        """Return the current client for `url` without taking a lease."""
+        return self.current.client_for(url)
+
+    def acquire(self, url: str):
+        gen = self.current
+        gen.inflight += 1
+        return gen, gen.client_for(url)
+
+    def release(self, gen: PoolGeneration):
+        gen.inflight -= 1
+        if gen.retired and gen.inflight <= 0:
+            gen.drained.set()
+
+    @asynccontextmanager
+    async def lease(self, url: str):
+        """Borrow the client for `url`, pinning its generation until released."""
+        gen, client = self.acquire(url)
+        try:
+            yield client
+        finally:
+            self.release(gen)
+
+    def rebuild(self):
+        """Swap in a fresh generation after the SSL context changed.
+
+        In-flight requests finish on the old generation, which is closed in
+        the background once drained.
+        """
+        old = self.current
+        self.current = self._new_generation()
+        old.retired = True
+        if old.inflight <= 0:
+            old.drained.set()
+        logger.info(f"Upstream pool rebuilt (generation {old.number} -> {self.current.number})")
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._retired.append(old)
+        loop.create_task(self._drain(old))
+        loop.create_task(self.warmup())
+
+    async def _drain(self, gen: PoolGeneration):
+        timeout = self.current.settings.get("drain_timeout", 60)
+        try:
+            await asyncio.wait_for(gen.drained.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Pool generation {gen.number} still had {gen.inflight} requests after {timeout}s, closing")
+        await gen.aclose()
+        if gen in self._retired:
+            self._retired.remove(gen)
+
+    async def warmup(self):
+        """Open one connection to each target so the first request skips the handshake."""
+        targets = self.config_manager.snapshot.targets
+
+        async def _touch(url: str):
+            try:
+                await self.get_client(url).head(url, timeout=5.0)
+            except Exception as e:
+                logger.warning(f"Pool warm-up failed for {url}: {e}")
+
+        await asyncio.gather(*(_touch(t.url) for t in targets))
+
+    async def close(self):
+        await self.current.aclose()
+        for gen in list(self._retired):
+            await gen.aclose()
+        self._retired.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "generation": self.current.number,
+            "inflight": self.current.inflight,
+            "retired_generations": len(self._retired),
+            "clients": list(self.current.clients.keys()),
+        }
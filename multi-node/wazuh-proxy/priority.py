@@ -0,0 +1,261 @@
+import asyncio
+import fnmatch
+import logging
+import re
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from admission import Overloaded
+from metrics import classify_path
+
+logger = logging.getLogger("wazuh-proxy")
+
+# `"_index":"name"` in a bulk action line
+INDEX_FIELD = re.compile(rb'"_index"\s*:\s*"([^"\\]+)"')
+
+
+def _patterns(values) -> Tuple[re.Pattern, ...]:
+    if isinstance(values, str):
+        values = [values]
+    return tuple(re.compile(fnmatch.translate(v)) for v in values or ())
+
+
+def request_indices(path: str, body_head: Optional[bytes], scan_bytes: int) -> List[str]:
+    """Indices a request writes to: the path's index segment plus those named in the first bulk lines."""
+    indices = []
+    first = path.lstrip("/").split("/", 1)[0]
+    if first and not first.startswith("_"):
+        indices.extend(first.split(","))
+    if body_head:
+        for match in INDEX_FIELD.finditer(body_head, 0, scan_bytes):
+            name = match.group(1).decode("utf-8", "replace")
+            if name not in indices:
+                indices.append(name)
+    return indices
+
+
+async def peek(stream) -> Tuple[bytes, AsyncIterator[bytes]]:
+    """Read the first chunk of `stream`; returns it and a stream that still yields everything."""
+    iterator = stream.__aiter__()
+    try:
+        first = await iterator.__anext__()
+    except StopAsyncIteration:
+        first = b""
+
+    async def replay():
+        if first:
+            yield first
+        async for chunk in iterator:
+            yield chunk
+
+    return first, replay()
+
+
+class Lane:
+    """One priority class: what it matches, its share and its waiting requests."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.waiters: deque = deque()
+        self.inflight = 0
+        self.vtime = 0.0
+        self.admitted = 0
+        self.shed = 0
+        self.timeouts = 0
+
+    def configure(self, settings: Dict, defaults: Dict):
+        match = settings.get("match") or {}
+        self.paths = _patterns(match.get("paths"))
+        self.indices = _patterns(match.get("indices"))
+        self.clients = _patterns(match.get("clients"))
+        self.weight = max(float(settings.get("weight", 1)), 0.001)
+        self.max_concurrency = int(settings.get("max_concurrency", defaults["max_concurrency"]))
+        self.max_queue = int(settings.get("max_queue", defaults["max_queue"]))
+        self.queue_timeout = settings.get("queue_timeout_ms", defaults["queue_timeout_ms"]) / 1000
+        self.retry_after = int(settings.get("retry_after_s", defaults["retry_after_s"]))
+
+    def matches(self, path: str, identity: Optional[str], indices: List[str]) -> bool:
+        if any(p.match(path) for p in self.paths):
+            return True
+        if identity is not None and any(p.match(identity) for p in self.clients):
+            return True
+        return any(p.match(index) for p in self.indices for index in indices)
+
+    def stats(self) -> Dict:
+        return {
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "inflight": self.inflight,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "timeouts": self.timeouts,
+        }
+
+
+class Ticket:
+    __slots__ = ("lane", "arrived")
+
+    def __init__(self, lane: Lane, arrived: float):
+        self.lane = lane
+        self.arrived = arrived
+
+
+class PriorityScheduler:
+    """Weighted-fair admission of proxied requests across priority lanes.
+
+    Each request is put in the first lane (in config order) whose path,
+    client identity or target index patterns match, the default lane
+    otherwise. At most `max_concurrency` requests are in flight overall
+    and each lane is capped by its own `max_concurrency`. When a slot frees
+    up the waiting lane with the smallest virtual time goes next, and every
+    admission advances that lane's clock by 1/weight, so backlogged lanes
+    share the slots in proportion to their weights.
+    """
+
+    def __init__(self, config_manager, rate_limiter, metrics=None):
+        self.config_manager = config_manager
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.lanes: List[Lane] = []
+        self.default: Optional[Lane] = None
+        self.inflight = 0
+        self.vclock = 0.0
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.priority
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.max_concurrency = int(settings.get("max_concurrency", 64))
+        self.scan_bytes = int(settings.get("scan_kb", 64) * 1024)
+        defaults = {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": settings.get("max_queue", 1000),
+            "queue_timeout_ms": settings.get("queue_timeout_ms", 30000),
+            "retry_after_s": settings.get("retry_after_s", 1),
+        }
+        classes = dict(settings.get("classes") or {})
+        default_name = settings.get("default_class", "default")
+        classes.setdefault(default_name, {})
+
+        # Lanes are kept across reloads, so in-flight tickets and waiters stay valid
+        old = {lane.name: lane for lane in self.lanes}
+        lanes = []
+        for name, spec in classes.items():
+            lane = old.pop(name, None) or Lane(name)
+            lane.configure(spec or {}, defaults)
+            lanes.append(lane)
+        default = next(lane for lane in lanes if lane.name == default_name)
+        for removed in old.values():
+            # Requests waiting in a removed lane are admitted through the default one
+            default.waiters.extend(removed.waiters)
+            removed.waiters.clear()
+        self.lanes = lanes
+        self.default = default
+        self.inspects_body = any(lane.indices for lane in lanes)
+        self.checks_identity = any(lane.clients for lane in lanes)
+        self.dispatch()
+
+    def classify(self, scope, headers, client_host: Optional[str], path: str,
+                 body_head: Optional[bytes]) -> Optional[Lane]:
+        """The lane of a request, or None for requests that are not scheduled (admin endpoints)."""
+        if not self.enabled or classify_path(path) == "admin":
+            return None
+        identity = self.rate_limiter.identity(scope, headers, client_host) if self.checks_identity else None
+        indices = request_indices(path, body_head, self.scan_bytes) if self.inspects_body else []
+        for lane in self.lanes:
+            if lane.matches(path, identity, indices):
+                return lane
+        return self.default
+
+    def _take(self, lane: Lane):
+        start = max(lane.vtime, self.vclock)
+        lane.vtime = start + 1 / lane.weight
+        self.vclock = start
+        lane.inflight += 1
+        lane.admitted += 1
+        self.inflight += 1
+
+    async def acquire(self, lane: Optional[Lane]) -> Optional[Ticket]:
+        """Wait for the lane's turn; the ticket must be passed to `release`."""
+        if lane is None:
+            return None
+        arrived = time.perf_counter()
+        # dispatch() runs on every release, so anyone still waiting is held by a lane cap
+        if self.inflight < self.max_concurrency and lane.inflight < lane.max_concurrency and not lane.waiters:
+            self._take(lane)
+        else:
+            lane = await self._wait(lane)
+        if self.metrics is not None:
+            self.metrics.observe_lane_wait(lane.name, time.perf_counter() - arrived)
+        return Ticket(lane, arrived)
+
+    async def _wait(self, lane: Lane) -> Lane:
+        """Queue in `lane`; returns the lane the request was admitted through."""
+        if len(lane.waiters) >= lane.max_queue:
+            lane.shed += 1
+            raise Overloaded(f"Priority class {lane.name} queue is full", lane.retry_after)
+        future = asyncio.get_running_loop().create_future()
+        lane.waiters.append(future)
+        try:
+            return await asyncio.wait_for(future, lane.queue_timeout)
+        except asyncio.TimeoutError:
+            try:
+                lane.waiters.remove(future)
+            except ValueError:
+                pass
+            lane.timeouts += 1
+            raise Overloaded(f"Priority class {lane.name} waited too long", lane.retry_after) from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller went away
+                self._give(future.result())
+            raise
+
+    def release(self, ticket: Optional[Ticket]):
+        if ticket is None:
+            return
+        self._give(ticket.lane)
+        if self.metrics is not None:
+            self.metrics.observe_lane_duration(ticket.lane.name, time.perf_counter() - ticket.arrived)
+
+    def _give(self, lane: Lane):
+        lane.inflight -= 1
+        self.inflight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.inflight < self.max_concurrency:
+            best = None
+            for lane in self.lanes:
+                while lane.waiters and lane.waiters[0].done():
+                    # Timed out or cancelled
+                    lane.waiters.popleft()
+                if lane.waiters and lane.inflight < lane.max_concurrency:
+                    if best is None or max(lane.vtime, self.vclock) < max(best.vtime, self.vclock):
+                        best = lane
+            if best is None:
+                return
+            self._take(best)
+            best.waiters.popleft().set_result(best)
+
+    def metric_families(self):
+        lanes = list(self.lanes)
+        yield ("wazuh_proxy_priority_inflight", "gauge", "Requests in flight per priority class.",
+               [({"class": lane.name}, lane.inflight) for lane in lanes])
+        yield ("wazuh_proxy_priority_queued", "gauge", "Requests waiting per priority class.",
+               [({"class": lane.name}, len(lane.waiters)) for lane in lanes])
+        yield ("wazuh_proxy_priority_shed_total", "counter", "Requests answered 429 per priority class.",
+               [({"class": lane.name}, lane.shed + lane.timeouts) for lane in lanes])
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "max_concurrency": self.max_concurrency,
+            "inflight": self.inflight,
+            "classes": {lane.name: lane.stats() for lane in self.lanes},
+        }
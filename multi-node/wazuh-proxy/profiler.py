@@ -0,0 +1,134 @@
+import asyncio
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Frames of an event loop waiting for I/O; samples ending there are idle time
+IDLE_FRAMES = frozenset((("selectors.py", "select"), ("base_events.py", "run_forever"),
+                         ("base_events.py", "run_until_complete"), ("runners.py", "run")))
+MAX_STACK_DEPTH = 128
+
+
+class ProfilerBusy(Exception):
+    """A profile is already being taken in this process."""
+
+
+class Profile(NamedTuple):
+    collapsed: str
+    samples: int
+    idle_samples: int
+    lag_max_ms: float
+    lag_p99_ms: float
+
+
+def _frame_key(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(thread_id: int, interval: float, stop: threading.Event, keep_idle: bool,
+                  counts: Dict[str, int], totals: List[int]):
+    """Sampler thread: collapse the stack of `thread_id` every `interval` seconds until `stop`."""
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return
+        totals[0] += 1
+        top = frame.f_code
+        if (os.path.basename(top.co_filename), top.co_name) in IDLE_FRAMES:
+            totals[1] += 1
+            if not keep_idle:
+                continue
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            stack.append(_frame_key(frame))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        counts[key] = counts.get(key, 0) + 1
+
+
+class Profiler:
+    """On-demand sampling profiler and event-loop lag monitor for one worker.
+
+    For the requested number of seconds, a thread samples the Python stack
+    of the event loop thread every `interval_ms` and counts the stacks in
+    collapsed form (`frame;frame;frame count`, root first, as read by
+    flamegraph.pl and speedscope). Meanwhile a task on the loop measures how
+    late its `interval_ms` sleeps wake up, which is the time the loop was
+    blocked. Only one profile runs at a time, and nothing is sampled
+    outside a run.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.running = False
+        self.runs = 0
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.profiling
+
+    def rebuild(self):
+        settings = self._settings()
+        self.token: Optional[str] = settings.get("token") or None
+        self.max_seconds = float(settings.get("max_seconds", 60))
+        self.default_interval = settings.get("interval_ms", 10) / 1000
+
+    @property
+    def enabled(self) -> bool:
+        return self.token is not None
+
+    def authorized(self, authorization: Optional[str]) -> bool:
+        if self.token is None or not authorization:
+            return False
+        scheme, _, credentials = authorization.partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), self.token.encode())
+
+    async def run(self, seconds: float, interval: Optional[float] = None, keep_idle: bool = False) -> Profile:
+        if self.running:
+            raise ProfilerBusy("A profile is already running")
+        seconds = min(max(seconds, 0.1), self.max_seconds)
+        interval = max(interval or self.default_interval, 0.001)
+        self.running = True
+        self.runs += 1
+        counts: Dict[str, int] = {}
+        totals = [0, 0]
+        stop = threading.Event()
+        sampler = threading.Thread(target=sample_stacks, name="wazuh-proxy-profiler", daemon=True,
+                                   args=(threading.get_ident(), interval, stop, keep_idle, counts, totals))
+        lags: List[float] = []
+        logger.info(f"Profiling the event loop for {seconds}s every {interval * 1000:g}ms")
+        try:
+            sampler.start()
+            deadline = time.monotonic() + seconds
+            while True:
+                expected = time.monotonic() + interval
+                if expected > deadline:
+                    break
+                await asyncio.sleep(interval)
+                lags.append(max(0.0, time.monotonic() - expected))
+        finally:
+            stop.set()
+            # The sampler only ever waits on `stop`, so this returns within one sample
+            await asyncio.get_running_loop().run_in_executor(None, sampler.join)
+            self.running = False
+
+        lags.sort()
+        collapsed = "".join(f"{stack} {count}\n" for stack, count in
+                            sorted(counts.items(), key=lambda item: item[1], reverse=True))
+        return Profile(
+            collapsed=collapsed,
+            samples=totals[0],
+            idle_samples=totals[1],
+            lag_max_ms=round(lags[-1] * 1000, 3) if lags else 0.0,
+            lag_p99_ms=round(lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000, 3) if lags else 0.0,
+        )
+
+    def stats(self) -> Dict:
+        return {"enabled": self.enabled, "running": self.running, "runs": self.runs}
@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import ipaddress
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from metrics import classify_path
+
+logger = logging.getLogger("wazuh-proxy")
+
+# key hash, tokens, last refill (CLOCK_MONOTONIC is system-wide, so
+# timestamps written by one worker are valid in the others)
+SLOT = struct.Struct("<Qdd8x")
+SLOT_SIZE = SLOT.size
+BUCKET_SLOTS = 8
+BUCKET = struct.Struct("<" + "Qdd8x" * BUCKET_SLOTS)
+BUCKET_SIZE = BUCKET.size
+EXEMPT_CLASSES = frozenset(("admin",))
+
+
+@lru_cache(maxsize=16384)
+def key_hash(identity: str, path_class: str) -> int:
+    # Stable across processes, unlike hash(); 0 marks an empty slot
+    digest = hashlib.blake2b(f"{identity}\x00{path_class}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+class Limit:
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, settings: Dict):
+        self.rate = float(settings.get("rate", 100))
+        self.burst = float(settings.get("burst", max(1.0, self.rate)))
+
+
+class LocalStore:
+    """Per-process token buckets; the stand-in when shared memory is unavailable."""
+
+    def __init__(self):
+        self.buckets: Dict[int, list] = {}
+
+    def take(self, key: int, limit: Limit, now: float) -> Tuple[bool, float]:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [limit.burst, now]
+        tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        allowed = tokens >= 1.0
+        if allowed:
+            tokens -= 1.0
+        bucket[0] = tokens
+        bucket[1] = now
+        return allowed, tokens
+
+    def close(self):
+        self.buckets.clear()
+
+
+class SharedStore:
+    """Token buckets in a memory-mapped file shared by all worker processes.
+
+    The table is set-associative: a key lives in one of the
+    `BUCKET_SLOTS` slots of its bucket, and only that bucket's bytes are
+    locked (fcntl record lock) while it is updated, so every take is O(1).
+    When a bucket is full the slot refilled longest ago is reused.
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.buckets = max(1, slots // BUCKET_SLOTS)
+        size = self.buckets * BUCKET_SIZE
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+
+    def take(self, key: int, limit: Limit, now: float) -> Tuple[bool, float]:
+        base = (key % self.buckets) * BUCKET_SIZE
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, BUCKET_SIZE, base)
+        try:
+            fields = BUCKET.unpack_from(self.mm, base)
+            keys = fields[0::3]
+            if key in keys:
+                i = keys.index(key)
+                tokens, last = fields[3 * i + 1], fields[3 * i + 2]
+            else:
+                # Claim an empty slot, or the one refilled longest ago
+                i = keys.index(0) if 0 in keys else min(range(BUCKET_SLOTS), key=lambda j: fields[3 * j + 2])
+                tokens, last = limit.burst, now
+            tokens = min(limit.burst, tokens + max(0.0, now - last) * limit.rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            SLOT.pack_into(self.mm, base + i * SLOT_SIZE, key, tokens, now)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, BUCKET_SIZE, base)
+        return allowed, tokens
+
+    def close(self):
+        try:
+            self.mm.close()
+            os.close(self.fd)
+        except (ValueError, OSError):
+            pass
+
+
+class RateLimiter:
+    """Token-bucket limits per client identity and path class.
+
+    The identity is the subject of the client certificate (ASGI TLS
+    extension), a header set by a trusted TLS terminator, or the peer
+    address as a last resort.
+    """
+
+    def __init__(self, config_manager):
+        self.config_manager = config_manager
+        self.store = None
+        self.store_key = None
+        self.enabled = False
+        self.default = Limit({})
+        self.classes: Dict[str, Limit] = {}
+        self.clients: Dict[str, Dict[str, Limit]] = {}
+        self.identity_header: Optional[str] = None
+        self.trusted = ()
+        self.allowed = 0
+        self.limited = 0
+        self.rebuild()
+
+    def rebuild(self):
+        settings = self.config_manager.snapshot.rate_limit
+        self.enabled = bool(settings.get("enabled", False))
+        limits = settings.get("limits", {})
+        self.default = Limit(limits.get("default", {}))
+        self.classes = {name: Limit(s) for name, s in limits.items() if name != "default"}
+        self.clients = {subject: {name: Limit(s) for name, s in per_client.items()}
+                        for subject, per_client in (settings.get("clients") or {}).items()}
+        identity = settings.get("identity", {})
+        header = identity.get("header")
+        self.identity_header = header.lower() if header else None
+        self.trusted = tuple(ipaddress.ip_network(n, strict=False) for n in identity.get("trusted_proxies", []))
+        self._trusted_peer.cache_clear()
+        key_hash.cache_clear()
+
+        backend = settings.get("backend", "shared")
+        store_key = (backend, settings.get("shared_path", "/dev/shm/wazuh-proxy-ratelimit"), settings.get("slots", 65536))
+        if self.enabled and store_key != self.store_key:
+            if self.store is not None:
+                self.store.close()
+            self.store = self._open_store(*store_key)
+            self.store_key = store_key
+
+    @staticmethod
+    def _open_store(backend: str, path: str, slots: int):
+        if backend == "shared":
+            try:
+                return SharedStore(path, slots)
+            except OSError as e:
+                logger.error(f"Shared rate-limit store unavailable at {path} ({e}), limits are per process")
+        return LocalStore()
+
+    @lru_cache(maxsize=1024)
+    def _trusted_peer(self, host: str) -> bool:
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted)
+
+    def identity(self, scope, headers, client_host: Optional[str]) -> str:
+        tls = scope.get("extensions", {}).get("tls")
+        if tls and tls.get("client_cert_name"):
+            return tls["client_cert_name"]
+        if self.identity_header and client_host and self._trusted_peer(client_host):
+            value = headers.get(self.identity_header)
+            if value:
+                return value
+        return client_host or "unknown"
+
+    def limit_for(self, identity: str, path_class: str) -> Limit:
+        per_client = self.clients.get(identity)
+        if per_client is not None:
+            limit = per_client.get(path_class) or per_client.get("default")
+            if limit is not None:
+                return limit
+        return self.classes.get(path_class) or self.default
+
+    def check(self, scope, headers, client_host: Optional[str], path: str) -> Optional[Dict[str, str]]:
+        """Take a token; returns the rate-limit headers, or None when limiting is off.
+
+        A `Retry-After` entry in the result means the request was refused.
+        """
+        if not self.enabled or self.store is None:
+            return None
+        path_class = classify_path(path)
+        if path_class in EXEMPT_CLASSES:
+            return None
+        identity = self.identity(scope, headers, client_host)
+        limit = self.limit_for(identity, path_class)
+        allowed, tokens = self.store.take(key_hash(identity, path_class), limit, time.monotonic())
+        result = {
+            "X-RateLimit-Limit": str(int(limit.burst)),
+            "X-RateLimit-Remaining": str(max(0, int(tokens))),
+        }
+        if allowed:
+            self.allowed += 1
+        else:
+            self.limited += 1
+            result["Retry-After"] = str(max(1, math.ceil((1.0 - tokens) / limit.rate))) if limit.rate > 0 else "60"
+        return result
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.store).__name__ if self.store is not None else None,
+            "allowed": self.allowed,
+            "limited": self.limited,
+        }
@@ -0,0 +1,404 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Callable, Dict, Optional, Set
+
+import httpx
+
+from accesslog import annotate
+from timing import phase, trace_extensions
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Upstream statuses that mean the request was not processed and may be retried
+RETRY_STATUSES = frozenset((502, 503, 504))
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "PUT"))
+# Errors raised before any byte of the request reached the upstream
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class NoHealthyUpstream(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Per-upstream breaker driven by the error rate of live traffic.
+
+    closed -> open when the failure rate over the last `window` calls reaches
+    `failure_rate`; open -> half_open after `open_seconds`; half_open lets
+    `half_open_probes` requests through and closes again if they all succeed.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, url: str, settings: Dict, on_change: Callable[[], None]):
+        self.url = url
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.outcomes: Optional[deque] = None
+        self.configure(settings)
+        self.outcomes = deque(maxlen=self.window)
+        self.failures = 0
+        self.probes = 0
+        self.probe_successes = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @staticmethod
+    def parse_settings(settings: Dict) -> Dict:
+        """Normalise `upstream.circuit_breaker`; raises ValueError or TypeError when it is unusable."""
+        parsed = {
+            "window": int(settings.get("window", 20)),
+            "min_requests": int(settings.get("min_requests", 10)),
+            "failure_rate": float(settings.get("failure_rate", 0.5)),
+            "open_seconds": float(settings.get("open_seconds", 10)),
+            "half_open_probes": int(settings.get("half_open_probes", 3)),
+        }
+        if parsed["window"] < 1:
+            raise ValueError(f"window must be at least 1, got {parsed['window']}")
+        # The breaker could never trip if it waited for more calls than the window holds
+        if parsed["min_requests"] > parsed["window"]:
+            raise ValueError(f"min_requests ({parsed['min_requests']}) exceeds window ({parsed['window']})")
+        return parsed
+
+    def configure(self, settings: Dict):
+        parsed = self.parse_settings(settings)
+        self.window = parsed["window"]
+        self.min_requests = parsed["min_requests"]
+        self.failure_rate = parsed["failure_rate"]
+        self.open_seconds = parsed["open_seconds"]
+        self.half_open_probes = parsed["half_open_probes"]
+        if self.outcomes is not None and self.outcomes.maxlen != self.window:
+            # Keep the newest outcomes that still fit
+            self.outcomes = deque(self.outcomes, maxlen=self.window)
+            self.failures = sum(1 for ok in self.outcomes if not ok)
+
+    @property
+    def available(self) -> bool:
+        return self.state != self.OPEN
+
+    def try_probe(self) -> bool:
+        """In half-open state only a limited number of requests may go through."""
+        if self.state != self.HALF_OPEN:
+            return True
+        if self.probes >= self.half_open_probes:
+            return False
+        self.probes += 1
+        return True
+
+    def release_probe(self):
+        """Give back a half-open probe slot whose request was abandoned."""
+        if self.state == self.HALF_OPEN and self.probes > 0:
+            self.probes -= 1
+
+    def record(self, ok: bool):
+        if self.state == self.HALF_OPEN:
+            if not ok:
+                self._open()
+                return
+            self.probe_successes += 1
+            if self.probe_successes >= self.half_open_probes:
+                self._close()
+            return
+        if self.state == self.OPEN:
+            return
+
+        if len(self.outcomes) == self.outcomes.maxlen and not self.outcomes[0]:
+            self.failures -= 1
+        self.outcomes.append(ok)
+        if not ok:
+            self.failures += 1
+            if len(self.outcomes) >= self.min_requests and self.failures / len(self.outcomes) >= self.failure_rate:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        logger.warning(f"Circuit OPEN for {self.url} ({self.failures}/{len(self.outcomes)} failures)")
+        if self._timer is not None:
+            self._timer.cancel()
+        try:
+            self._timer = asyncio.get_running_loop().call_later(self.open_seconds, self._half_open)
+        except RuntimeError:
+            self._timer = None
+        self.on_change()
+
+    def _half_open(self):
+        self.state = self.HALF_OPEN
+        self.probes = 0
+        self.probe_successes = 0
+        logger.info(f"Circuit HALF-OPEN for {self.url}")
+        self.on_change()
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.outcomes.clear()
+        self.failures = 0
+        logger.info(f"Circuit CLOSED for {self.url}")
+        self.on_change()
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "window": len(self.outcomes),
+            "trips": self.trips,
+        }
+
+
+class LatencyWindow:
+    """Rolling sample of recent latencies with a lazily refreshed percentile."""
+
+    def __init__(self, size: int = 512, refresh_every: int = 64):
+        self.samples = deque(maxlen=size)
+        self.refresh_every = refresh_every
+        self._since_refresh = 0
+        self._cached: Dict[float, float] = {}
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+        self._since_refresh += 1
+        if self._since_refresh >= self.refresh_every:
+            self._cached.clear()
+            self._since_refresh = 0
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        value = self._cached.get(p)
+        if value is None:
+            ordered = sorted(self.samples)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+            self._cached[p] = value
+        return value
+
+
+class UpstreamCall:
+    """An upstream response whose lease and in-flight slot are held until `finish`."""
+
+    def __init__(self, manager, pool, target_url: str, gen, started: float, response: httpx.Response,
+                 metrics=None, slot=None):
+        self.manager = manager
+        self.pool = pool
+        self.target_url = target_url
+        self.gen = gen
+        self.started = started
+        self.response = response
+        self.metrics = metrics
+        self.slot = slot
+        # Time to response headers, the latency signal for adaptive concurrency
+        self.latency = time.monotonic() - started
+        self._finished = False
+
+    async def finish(self, ok: Optional[bool] = None):
+        if self._finished:
+            return
+        self._finished = True
+        try:
+            await self.response.aclose()
+        finally:
+            if ok is None:
+                ok = self.response.status_code < 500
+            self.manager.end(self.target_url, self.started, ok)
+            self.pool.release(self.gen)
+            if self.slot is not None:
+                self.slot.complete(self.started, self.latency, self.response.status_code if ok else None)
+            if self.metrics is not None:
+                self.metrics.observe_upstream(self.target_url, self.response.status_code,
+                                              time.monotonic() - self.started)
+
+
+class ResilienceLayer:
+    """Send requests upstream with retries on other targets and optional hedging."""
+
+    def __init__(self, config_manager, upstream_manager, pool, metrics=None, compression=None, admission=None):
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.pool = pool
+        self.metrics = metrics
+        self.compression = compression
+        self.admission = admission
+        self.read_latency = LatencyWindow()
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.rebuild()
+
+    def rebuild(self):
+        """Precompute the retry and hedging settings read on every request."""
+        snapshot = self.config_manager.snapshot
+        settings = snapshot.upstream
+        self.max_retries = int(settings.get("retry_count", 0))
+        self.retry_budget = settings.get("retry_budget_s", 10.0)
+        self.backoff = settings.get("retry_backoff_ms", 50) / 1000
+        self.retry_bulk = bool(settings.get("retry_bulk", True))
+        self.hedging = snapshot.hedging
+        self.hedge_reads = bool(self.hedging.get("enabled", False))
+
+    async def _attempt(self, target_url: str, method: str, path: str, headers: Dict, content) -> UpstreamCall:
+        try:
+            with phase("queue"):
+                slot = await self.admission.acquire_target(target_url) if self.admission is not None else None
+        except BaseException:
+            # Overloaded or cancelled while queued: the request never reached the target
+            self.upstream_manager.breakers[target_url].release_probe()
+            raise
+        gen, client = self.pool.acquire(target_url)
+        started = self.upstream_manager.begin(target_url)
+        try:
+            req = client.build_request(method, f"{target_url}/{path}", headers=headers, content=content,
+                                       extensions=trace_extensions())
+            response = await client.send(req, stream=True)
+        except httpx.RequestError as exc:
+            self.upstream_manager.end(target_url, started, False)
+            self.pool.release(gen)
+            if slot is not None:
+                slot.complete(started, None, None)
+            if self.metrics is not None:
+                self.metrics.observe_upstream(target_url, "error", time.monotonic() - started)
+            logger.error(f"Upstream Error ({target_url}/{path}): {exc}")
+            raise
+        except BaseException:
+            # Cancelled hedge or aborted client body: not the upstream's fault
+            self.upstream_manager.end(target_url, started, None)
+            self.pool.release(gen)
+            if slot is not None:
+                slot.abandon()
+            raise
+        if method in ("GET", "HEAD"):
+            self.read_latency.record(time.monotonic() - started)
+        return UpstreamCall(self.upstream_manager, self.pool, target_url, gen, started, response, self.metrics,
+                            slot)
+
+    async def _hedged(self, target_url: str, method: str, path: str, headers: Dict, content,
+                      tried: Set[str]) -> UpstreamCall:
+        """Send a second copy of a slow read to another node and keep the first answer."""
+        settings = self.hedging
+        primary = asyncio.ensure_future(self._attempt(target_url, method, path, headers, content))
+        delay = self.read_latency.percentile(settings.get("percentile", 95))
+        delay = max(settings.get("min_delay_ms", 50) / 1000, delay or 0.0)
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        backup_url = self.upstream_manager.get_next_target(exclude=tried)
+        if backup_url is None:
+            return await primary
+        if backup_url in tried:
+            # Only targets already tried are left; give back the probe slot the pick took
+            self.upstream_manager.breakers[backup_url].release_probe()
+            return await primary
+        tried.add(backup_url)
+        self.hedges += 1
+        backup = asyncio.ensure_future(self._attempt(backup_url, method, path, headers, content))
+
+        pending = {primary, backup}
+        winner = None
+        error = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        await task.result().finish()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # A loser that completed anyway still holds a lease
+                for result in await asyncio.gather(*pending, return_exceptions=True):
+                    if isinstance(result, UpstreamCall):
+                        await result.finish()
+        if winner is None:
+            raise error
+        if winner is backup:
+            self.hedge_wins += 1
+        return winner.result()
+
+    def _can_retry(self, method: str, path: str, replayable: bool, exc: Optional[Exception]) -> bool:
+        if not replayable:
+            return False
+        if isinstance(exc, CONNECT_ERRORS):
+            return True
+        if method in IDEMPOTENT_METHODS:
+            return True
+        # A 502/503/504 from the coordinating node means the bulk was not applied
+        bulk = path.split("?", 1)[0].rstrip("/").endswith("_bulk")
+        return exc is None and bulk and self.retry_bulk
+
+    async def send(self, method: str, path: str, headers: Dict, content,
+                   avoid: Optional[Set[str]] = None, prefer: Optional[str] = None) -> UpstreamCall:
+        """Send a request upstream, retrying and hedging as configured.
+
+        Targets in `avoid` are only used when no other healthy target is left.
+        The first attempt goes to `prefer` if it is available; retries are
+        balanced as usual.
+        """
+        max_retries = self.max_retries
+        deadline = time.monotonic() + self.retry_budget
+        backoff = self.backoff
+        hedge = (self.hedge_reads and method in ("GET", "HEAD")
+                 and (content is None or isinstance(content, bytes)))
+        if self.compression is not None:
+            headers, content = self.compression.encode_upstream(headers, content)
+
+        tried: Set[str] = set(avoid) if avoid else set()
+        attempt = 0
+        while True:
+            if prefer is not None and attempt == 0 and prefer not in tried and self.upstream_manager.claim(prefer):
+                target_url = prefer
+            else:
+                exclude = tried
+                if self.admission is not None:
+                    # Prefer a target with a free slot over queueing behind a busy one
+                    exclude = tried | self.admission.saturated()
+                target_url = self.upstream_manager.get_next_target(exclude=exclude)
+            if target_url is None:
+                raise NoHealthyUpstream("All upstreams are unavailable")
+            tried.add(target_url)
+
+            error = None
+            try:
+                if hedge and attempt == 0:
+                    call = await self._hedged(target_url, method, path, headers, content, tried)
+                else:
+                    call = await self._attempt(target_url, method, path, headers, content)
+            except httpx.RequestError as exc:
+                error = exc
+                call = None
+
+            # A streamed body can only be replayed if it was never started
+            replayable = content is None or isinstance(content, bytes) or not getattr(content, "started", True)
+            attempt += 1
+            out_of_budget = attempt > max_retries or time.monotonic() >= deadline
+            if call is not None:
+                if (call.response.status_code not in RETRY_STATUSES or out_of_budget
+                        or not self._can_retry(method, path, replayable, None)):
+                    annotate(upstream=call.target_url, attempts=attempt)
+                    return call
+                await call.finish()
+            elif out_of_budget or not self._can_retry(method, path, replayable, error):
+                raise error
+
+            self.retries += 1
+            pause = min(backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5), max(0.0, deadline - time.monotonic()))
+            await asyncio.sleep(pause)
+
+    def stats(self) -> Dict:
+        p95 = self.read_latency.percentile(95)
+        return {
+            "retries": self.retries,
+            "hedged_requests": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "read_p95_ms": round(p95 * 1000, 2) if p95 is not None else None,
+        }
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+from bulk import failed_items, is_bulk_path, post_bulk, split_bulk_items
+
+logger = logging.getLogger("wazuh-proxy")
+
+STATE_FILTER = ",".join((
+    "routing_table.indices.*.shards.*.primary",
+    "routing_table.indices.*.shards.*.state",
+    "routing_table.indices.*.shards.*.node",
+    "metadata.indices.*.routing_num_shards",
+    "metadata.indices.*.settings.index.number_of_shards",
+    "metadata.indices.*.settings.index.routing_partition_size",
+))
+NODES_PATH = "/_nodes/http?filter_path=nodes.*.name,nodes.*.host,nodes.*.ip,nodes.*.http.publish_address"
+# Reasons an item falls back to normal routing, as reported in /stats
+MISS_REASONS = ("no_id", "unknown_index", "no_target", "stale")
+
+
+def _rotl32(x: int, r: int) -> int:
+    return ((x << r) | (x >> (32 - r))) & 0xFFFFFFFF
+
+
+def murmur3_32(data: bytes, seed: int = 0) -> int:
+    """MurmurHash3 x86_32, as a signed 32-bit integer like Java's."""
+    c1, c2 = 0xCC9E2D51, 0x1B873593
+    h = seed
+    length = len(data)
+    end = length & ~3
+    for i in range(0, end, 4):
+        k = int.from_bytes(data[i:i + 4], "little")
+        k = (k * c1) & 0xFFFFFFFF
+        k = _rotl32(k, 15)
+        k = (k * c2) & 0xFFFFFFFF
+        h ^= k
+        h = _rotl32(h, 13)
+        h = (h * 5 + 0xE6546B64) & 0xFFFFFFFF
+    tail = length & 3
+    if tail:
+        k = int.from_bytes(data[end:], "little")
+        k = (k * c1) & 0xFFFFFFFF
+        k = _rotl32(k, 15)
+        k = (k * c2) & 0xFFFFFFFF
+        h ^= k
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85EBCA6B) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xC2B2AE35) & 0xFFFFFFFF
+    h ^= h >> 16
+    return h - 0x100000000 if h & 0x80000000 else h
+
+
+def routing_hash(routing: str) -> int:
+    # OpenSearch hashes the UTF-16 code units of the routing value, low byte first
+    return murmur3_32(routing.encode("utf-16-le"))
+
+
+def default_routing_shards(number_of_shards: int) -> int:
+    """`index.number_of_routing_shards` of an index created without one (OpenSearch and ES >= 7)."""
+    log2_shards = (number_of_shards - 1).bit_length()
+    return number_of_shards << max(1, 10 - log2_shards)
+
+
+class IndexRouting(NamedTuple):
+    routing_num_shards: int
+    routing_factor: int
+    # Target URL holding each shard's started primary, None when it is not one of ours
+    primaries: Tuple[Optional[str], ...]
+
+    def owner(self, routing: str) -> Optional[str]:
+        return self.primaries[routing_hash(routing) % self.routing_num_shards // self.routing_factor]
+
+
+def build_table(state: Dict, node_targets: Dict[str, str]) -> Dict[str, IndexRouting]:
+    """Per-index primary owners from a `_cluster/state/routing_table,metadata` response."""
+    table = {}
+    metadata = (state.get("metadata") or {}).get("indices") or {}
+    routing = (state.get("routing_table") or {}).get("indices") or {}
+    for index, meta in metadata.items():
+        settings = (meta.get("settings") or {}).get("index") or {}
+        try:
+            shards = int(settings.get("number_of_shards", 0))
+            partition = int(settings.get("routing_partition_size", 1))
+        except (TypeError, ValueError):
+            continue
+        if shards <= 0 or partition != 1 or index not in routing:
+            # Partitioned routing spreads one routing value over several shards
+            continue
+        routing_shards = int(meta.get("routing_num_shards") or default_routing_shards(shards))
+        primaries: List[Optional[str]] = [None] * shards
+        for shard_id, copies in (routing[index].get("shards") or {}).items():
+            for copy in copies:
+                if copy.get("primary") and copy.get("state") in ("STARTED", "RELOCATING"):
+                    primaries[int(shard_id)] = node_targets.get(copy.get("node"))
+        table[index] = IndexRouting(routing_shards, routing_shards // shards, tuple(primaries))
+    return table
+
+
+def match_nodes(nodes: Dict, targets) -> Dict[str, str]:
+    """Map node ids from `_nodes/http` to our target URLs by node name, then address."""
+    mapping = {}
+    for node_id, node in nodes.items():
+        publish = ((node.get("http") or {}).get("publish_address") or "").rsplit("/", 1)[-1]
+        by_host = []
+        for target in targets:
+            if target.node_name is not None:
+                if node.get("name") == target.node_name:
+                    by_host = [target.url]
+                    break
+                continue
+            parsed = urlparse(target.url)
+            if parsed.hostname in (node.get("name"), node.get("host"), node.get("ip")) or \
+                    publish.rsplit(":", 1)[0] == parsed.hostname:
+                if publish.endswith(f":{parsed.port}"):
+                    by_host = [target.url]
+                    break
+                by_host.append(target.url)
+        if len(by_host) == 1:
+            mapping[node_id] = by_host[0]
+    return mapping
+
+
+class ShardRouter:
+    """Send `_bulk` items straight to the node holding their primary shard.
+
+    A routing table (started primaries per index, plus each index's routing
+    shard count) is fetched from the cluster state every
+    `refresh_interval_s`. Items with an explicit `_id` (or `routing`) are
+    hashed the way OpenSearch does (murmur3 over the routing value, modulo
+    the routing shards) and grouped by the owning target; each group is
+    posted to that target first. Items with auto-generated ids, unknown
+    indices or primaries on nodes we do not proxy to, and every item while
+    the table is older than `max_age_s`, are sent with normal balancing.
+    """
+
+    def __init__(self, config_manager, upstream_manager, pool, resilience, item_retry=None):
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.pool = pool
+        self.resilience = resilience
+        self.item_retry = item_retry
+        self.table: Dict[str, IndexRouting] = {}
+        self.refreshed_at: Optional[float] = None
+        self.refresh_errors = 0
+        self.routed_requests = 0
+        self.hits = 0
+        self.misses = dict.fromkeys(MISS_REASONS, 0)
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.bulk_shard_routing
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.refresh_interval = settings.get("refresh_interval_s", 30)
+        self.max_age = settings.get("max_age_s", 120)
+        self.timeout = settings.get("timeout", 10.0)
+        indices = settings.get("indices") or ["*"]
+        self.indices = ",".join([indices] if isinstance(indices, str) else indices)
+
+    @property
+    def fresh(self) -> bool:
+        return self.refreshed_at is not None and time.monotonic() - self.refreshed_at <= self.max_age
+
+    def applies(self, method: str, path: str) -> bool:
+        return self.enabled and method in ("POST", "PUT") and is_bulk_path(path)
+
+    @staticmethod
+    def may_route(head: bytes) -> bool:
+        """Cheap pre-check on the start of a body: auto-generated ids never name an `_id`."""
+        return b'"_id"' in head or b'routing"' in head
+
+    async def run(self):
+        while True:
+            if self.enabled:
+                await self.refresh()
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        url = self.upstream_manager.peek_target()
+        if url is None:
+            return
+        try:
+            async with self.pool.lease(url) as client:
+                state_resp, nodes_resp = await asyncio.gather(
+                    client.get(f"{url}/_cluster/state/routing_table,metadata/{self.indices}",
+                               params={"filter_path": STATE_FILTER}, timeout=self.timeout),
+                    client.get(f"{url}{NODES_PATH}", timeout=self.timeout),
+                )
+            if state_resp.status_code != 200 or nodes_resp.status_code != 200:
+                raise ValueError(f"HTTP {state_resp.status_code}/{nodes_resp.status_code}")
+            nodes = match_nodes(nodes_resp.json().get("nodes") or {}, self.config_manager.snapshot.targets)
+            self.table = build_table(state_resp.json(), nodes)
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.warning(f"Failed to refresh the shard routing table from {url}: {e}")
+            return
+        self.refreshed_at = time.monotonic()
+
+    def plan(self, blocks: List[bytes], default_index: Optional[str]) -> Dict[Optional[str], List[int]]:
+        """Item positions grouped by owning target; None collects the items routed normally."""
+        groups: Dict[Optional[str], List[int]] = {}
+        table = self.table
+        fresh = self.fresh
+        for position, block in enumerate(blocks):
+            owner = None
+            try:
+                action = json.loads(block[:block.index(b"\n")])
+                meta = next(iter(action.values()))
+            except (ValueError, StopIteration, AttributeError):
+                meta = None
+            routing = None
+            if isinstance(meta, dict):
+                routing = meta.get("routing") or meta.get("_routing") or meta.get("_id")
+            if routing is None:
+                self.misses["no_id"] += 1
+            elif not fresh:
+                self.misses["stale"] += 1
+            else:
+                index = table.get(meta.get("_index") or default_index)
+                if index is None:
+                    self.misses["unknown_index"] += 1
+                else:
+                    owner = index.owner(str(routing))
+                    if owner is None:
+                        self.misses["no_target"] += 1
+                    else:
+                        self.hits += 1
+            groups.setdefault(owner, []).append(position)
+        return groups
+
+    async def handle(self, body: bytes, path: str, query: str, headers: Dict) -> Optional[Dict]:
+        """The merged bulk response, or None when no item has a known owner (send the body as is)."""
+        default_index = path.split("/", 1)[0] if not path.startswith("_") else None
+        blocks = split_bulk_items(body)
+        groups = self.plan(blocks, default_index)
+        if list(groups) == [None]:
+            return None
+        self.routed_requests += 1
+        started = time.monotonic()
+        order = list(groups.items())
+        results = await asyncio.gather(*(
+            post_bulk(self.resilience, path, query, headers, b"".join(blocks[i] for i in positions),
+                      len(positions), self.item_retry, prefer=owner)
+            for owner, positions in order))
+
+        items: List[Optional[Dict]] = [None] * len(blocks)
+        errors = False
+        for (owner, positions), (_, data) in zip(order, results):
+            errors = errors or bool(data.get("errors"))
+            for position, item in zip(positions, data.get("items") or []):
+                items[position] = item
+        if None in items:
+            errors = True
+            missing = failed_items(1, 502, "Upstream bulk response is missing this item")[0]
+            items = [missing if item is None else item for item in items]
+        return {"took": int((time.monotonic() - started) * 1000), "errors": errors, "items": items}
+
+    def metric_families(self):
+        yield ("wazuh_proxy_shard_routing_lookups_total", "counter",
+               "Bulk items looked up in the shard routing table, by outcome.",
+               [({"outcome": "hit"}, self.hits)]
+               + [({"outcome": reason}, count) for reason, count in self.misses.items()])
+        yield ("wazuh_proxy_shard_routing_table_age_seconds", "gauge", "Age of the shard routing table.",
+               [({}, round(time.monotonic() - self.refreshed_at, 3) if self.refreshed_at is not None else -1)])
+
+    def stats(self) -> Dict:
+        lookups = self.hits + sum(self.misses.values())
+        return {
+            "enabled": self.enabled,
+            "indices": len(self.table),
+            "table_age_s": round(time.monotonic() - self.refreshed_at, 3) if self.refreshed_at is not None else None,
+            "fresh": self.fresh,
+            "refresh_errors": self.refresh_errors,
+            "routed_requests": self.routed_requests,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+        }
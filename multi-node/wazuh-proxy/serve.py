@@ -0,0 +1,180 @@
+"""Run the proxy under uvicorn with the mTLS peer identity exposed to the app.
+
+Takes the same TLS flags as the uvicorn command line it replaces:
+
+    python serve.py --host 0.0.0.0 --port 9201 \
+        --ssl-keyfile key.pem --ssl-certfile cert.pem --ssl-ca-certs ca.pem --ssl-cert-reqs 2
+
+With --workers N (0 = one per CPU) a supervisor process runs the config
+watcher and health checks and publishes them in shared memory, while N
+workers accept connections on the same port through SO_REUSEPORT:
+
+    python serve.py --workers 0 --profile performance ...
+"""
+import argparse
+import asyncio
+import glob
+import importlib.util
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import uvicorn
+
+from control import METRICS_PATTERN, STATE_DIR_ENV, WORKER_ENV
+from tls import HTTPTOOLS_AVAILABLE, TLSHttpToolsProtocol
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Server profiles; "performance" pins uvloop + httptools, skips the access
+# log, deepens the accept backlog and outlasts Filebeat's idle timeout so
+# clients, not the proxy, close idle keep-alive connections.
+PROFILES = {
+    "default": {},
+    "performance": {"loop": "uvloop", "backlog": 4096, "timeout_keep_alive": 15, "access_log": False},
+}
+RESPAWN_DELAY = 1.0
+STOP_TIMEOUT = 30.0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9201)
+    parser.add_argument("--ssl-keyfile")
+    parser.add_argument("--ssl-certfile")
+    parser.add_argument("--ssl-ca-certs")
+    parser.add_argument("--ssl-cert-reqs", type=int, default=0)
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("PROXY_WORKERS", "1")),
+                        help="worker processes (0 = one per CPU, 1 = single process)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default=os.getenv("PROXY_PROFILE", "default"))
+    parser.add_argument("--state-dir", default="/dev/shm/wazuh-proxy",
+                        help="shared-memory directory for the supervisor snapshot (multi-worker mode)")
+    return parser.parse_args(argv)
+
+
+def server_config(args) -> uvicorn.Config:
+    http = TLSHttpToolsProtocol if HTTPTOOLS_AVAILABLE else "auto"
+    if not HTTPTOOLS_AVAILABLE:
+        logger.warning("httptools is not installed; client certificate subjects are not available to the app")
+    return uvicorn.Config(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        http=http,
+        ssl_keyfile=args.ssl_keyfile,
+        ssl_certfile=args.ssl_certfile,
+        ssl_ca_certs=args.ssl_ca_certs,
+        ssl_cert_reqs=args.ssl_cert_reqs,
+        log_level=args.log_level,
+        **profile_options(args.profile),
+    )
+
+
+def profile_options(name: str) -> dict:
+    options = dict(PROFILES[name])
+    if options.get("loop") == "uvloop":
+        if importlib.util.find_spec("uvloop") is None:
+            logger.warning("uvloop is not installed, the performance profile falls back to asyncio")
+            options["loop"] = "asyncio"
+    return options
+
+
+def reuseport_socket(host: str, port: int) -> socket.socket:
+    """A listening socket of its own for each worker; the kernel spreads connections across them."""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(args, index: int):
+    # Read by main.py at import time
+    os.environ[STATE_DIR_ENV] = args.state_dir
+    os.environ[WORKER_ENV] = str(index)
+    sock = reuseport_socket(args.host, args.port)
+    uvicorn.Server(server_config(args)).run(sockets=[sock])
+
+
+class Supervisor:
+    """Owns the control plane and keeps `count` workers running."""
+
+    def __init__(self, args, count: int):
+        self.args = args
+        self.count = count
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, index: int):
+        process = self.context.Process(target=run_worker, args=(self.args, index), name=f"wazuh-proxy-worker-{index}")
+        process.start()
+        self.workers[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def stop(self):
+        self.stopping = True
+        for process in self.workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    async def run(self):
+        # Imported here, the workers only need them through main.py
+        from configuration import ConfigManager
+        from control import ControlPlane
+        from pool import UpstreamPool
+        from upstream import UpstreamManager
+
+        os.makedirs(self.args.state_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(self.args.state_dir, METRICS_PATTERN)):
+            os.remove(path)
+        config_manager = ConfigManager(os.getenv("CONFIG_PATH", "config.yaml"))
+        pool = UpstreamPool(config_manager)
+        config_manager.reload_callbacks.append(pool.rebuild)
+        upstream_manager = UpstreamManager(config_manager, pool)
+        config_manager.reload_callbacks.append(upstream_manager.update_targets)
+        control = ControlPlane(config_manager, upstream_manager, self.args.state_dir)
+        control_task = asyncio.create_task(control.run())
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+        # Publish before the workers import main.py, so they start from the snapshot
+        await asyncio.sleep(0)
+        for index in range(self.count):
+            self.spawn(index)
+
+        while not self.stopping:
+            await asyncio.sleep(RESPAWN_DELAY)
+            for index, process in list(self.workers.items()):
+                if not process.is_alive() and not self.stopping:
+                    logger.error(f"Worker {index} (pid {process.pid}) exited with {process.exitcode}, restarting")
+                    self.spawn(index)
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for index, process in self.workers.items():
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in time, killing it")
+                process.kill()
+        control_task.cancel()
+        await pool.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    count = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    if count == 1:
+        uvicorn.Server(server_config(args)).run()
+        return
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(Supervisor(args, count).run())
+
+
+if __name__ == "__main__":
+    main()
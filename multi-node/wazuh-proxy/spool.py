@@ -0,0 +1,471 @@
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from admission import Overloaded
+from bulk import BulkItemRetry, is_bulk_path, split_bulk_items
+from resilience import NoHealthyUpstream
+
+logger = logging.getLogger("wazuh-proxy")
+
+MB = 1024 * 1024
+MAGIC = b"WPS1"
+# magic, metadata length, body length, crc32 of metadata + body
+RECORD_HEADER = struct.Struct("<4sIII")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor.json"
+# Only these request headers are written to disk; replays authenticate with
+# the proxy's own client certificate.
+SPOOLED_HEADERS = ("content-type",)
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Segment:
+    """A preallocated, memory-mapped, append-only file of checksummed records.
+
+    A record's header is written after its payload, so a write torn by a
+    crash leaves either no magic or a checksum mismatch and the scan on
+    restart stops right before it. The blocks are reserved when the file
+    is created, so a full disk fails there with an OSError instead of
+    raising SIGBUS on a later write into the mapping.
+    """
+
+    def __init__(self, path: str, seq: int, capacity: int = 0):
+        self.path = path
+        self.seq = seq
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = os.fstat(fd).st_size
+            if size < capacity:
+                try:
+                    os.posix_fallocate(fd, 0, capacity)
+                except OSError:
+                    if size == 0:
+                        os.remove(path)
+                    raise
+            self.capacity = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, self.capacity)
+        finally:
+            os.close(fd)
+        self.end = 0
+        self.sealed = False
+        self.closed = False
+
+    def read(self, offset: int) -> Optional[Tuple[Dict, bytes, int]]:
+        """Return (metadata, body, next offset) of the record at `offset`, or None."""
+        if offset + RECORD_HEADER.size > self.capacity:
+            return None
+        magic, meta_len, body_len, crc = RECORD_HEADER.unpack_from(self.mm, offset)
+        start = offset + RECORD_HEADER.size
+        stop = start + meta_len + body_len
+        if magic != MAGIC or stop > self.capacity:
+            return None
+        payload = self.mm[start:stop]
+        if zlib.crc32(payload) != crc:
+            return None
+        try:
+            meta = json.loads(payload[:meta_len])
+        except ValueError:
+            return None
+        return meta, payload[meta_len:], stop
+
+    def next_valid(self, offset: int) -> int:
+        """Offset of the first readable record after `offset`, or the end of the segment."""
+        position = offset + 1
+        while True:
+            position = self.mm.find(MAGIC, position, self.end)
+            if position < 0:
+                return self.end
+            if self.read(position) is not None:
+                return position
+            position += 1
+
+    def scan(self) -> List[int]:
+        """Find the valid records after a restart; returns their offsets."""
+        offsets = []
+        offset = 0
+        while True:
+            record = self.read(offset)
+            if record is None:
+                break
+            offsets.append(offset)
+            offset = record[2]
+        self.end = offset
+        return offsets
+
+    def append(self, meta: bytes, body: bytes) -> bool:
+        """Write a record into the mapping; it is durable once `sync` has run."""
+        size = RECORD_HEADER.size + len(meta) + len(body)
+        if self.end + size > self.capacity:
+            return False
+        start = self.end + RECORD_HEADER.size
+        self.mm[start:start + len(meta)] = meta
+        self.mm[start + len(meta):start + len(meta) + len(body)] = body
+        crc = zlib.crc32(body, zlib.crc32(meta))
+        RECORD_HEADER.pack_into(self.mm, self.end, MAGIC, len(meta), len(body), crc)
+        self.end += size
+        return True
+
+    def sync(self):
+        """msync the mapping; blocking, so run in an executor thread."""
+        try:
+            self.mm.flush()
+        except (ValueError, OSError):
+            # Closed meanwhile because it was fully replayed: nothing left to persist
+            if not self.closed:
+                raise
+
+    def close(self):
+        self.closed = True
+        try:
+            self.mm.flush()
+            self.mm.close()
+        except (ValueError, OSError):
+            pass
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class BulkSpool:
+    """Durable buffer for `_bulk` writes while no indexer can take them.
+
+    Writes are appended to segment files when no upstream is healthy or the
+    cluster answers 429, and replayed in order at `replay_rate_mb_s` once
+    targets are back. When the backlog reaches `max_size_mb` new writes get
+    429 + Retry-After so Filebeat backs off instead of losing data.
+    """
+
+    def __init__(self, config_manager, upstream_manager, resilience, worker: Optional[str] = None):
+        self.config_manager = config_manager
+        self.upstream_manager = upstream_manager
+        self.resilience = resilience
+        # Each worker process appends to and replays its own sub-directory
+        self.worker = worker
+        self.directory: Optional[str] = None
+        self.segments: List[Segment] = []
+        self.cursor: Tuple[int, int] = (0, 0)
+        self.backlog_bytes = 0
+        self.backlog_records = 0
+        self.spooled = 0
+        self.spooled_bytes = 0
+        self.replayed = 0
+        self.replayed_bytes = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.replay_errors = 0
+        self.corrupt = 0
+        self.items_respooled = 0
+        self.items_rejected = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.spool
+
+    def rebuild(self):
+        self.enabled = bool(self._settings().get("enabled", False))
+        directory = self._settings().get("path", "/var/spool/wazuh-proxy")
+        if self.worker is not None:
+            directory = os.path.join(directory, f"worker-{self.worker}")
+        if not self.enabled or directory == self.directory:
+            return
+        self.close()
+        try:
+            self._open(directory)
+        except OSError as e:
+            logger.error(f"Failed to open bulk spool at {directory}: {e}")
+            self.directory = None
+
+    def _open(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        seq, offset = 0, 0
+        try:
+            with open(os.path.join(directory, CURSOR_FILE)) as f:
+                cursor = json.load(f)
+            seq, offset = int(cursor["segment"]), int(cursor["offset"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.segments = []
+        self.backlog_bytes = 0
+        self.backlog_records = 0
+        names = sorted(n for n in os.listdir(directory) if n.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            if os.path.getsize(os.path.join(directory, name)) == 0:
+                os.remove(os.path.join(directory, name))
+                continue
+            segment = Segment(os.path.join(directory, name), int(name[:-len(SEGMENT_SUFFIX)]))
+            offsets = segment.scan()
+            if segment.seq < seq:
+                # Replayed before the restart
+                segment.remove()
+                continue
+            live = [o for o in offsets if segment.seq > seq or o >= offset]
+            self.backlog_records += len(live)
+            self.backlog_bytes += (segment.end - live[0]) if live else 0
+            segment.sealed = True
+            self.segments.append(segment)
+        if self.segments:
+            # Keep appending to the newest segment
+            self.segments[-1].sealed = False
+            first = self.segments[0]
+            self.cursor = (first.seq, offset if first.seq == seq else 0)
+        else:
+            self.cursor = (seq, 0)
+        self.directory = directory
+        if self.backlog_records:
+            logger.warning(f"Bulk spool recovered {self.backlog_records} pending bulks "
+                           f"({self.backlog_bytes / MB:.1f}MB) from {directory}")
+
+    def applies(self, method: str, path: str) -> bool:
+        return self.directory is not None and self.enabled and method in ("POST", "PUT") and is_bulk_path(path)
+
+    def should_absorb(self) -> bool:
+        """True while no upstream can take writes."""
+        return not self.upstream_manager.healthy
+
+    def retry_after(self) -> int:
+        return int(self._settings().get("retry_after_s", 30))
+
+    async def append(self, path: str, query: str, headers, body: bytes):
+        """Persist one bulk request; raises SpoolFull when the byte cap is reached."""
+        if self.backlog_bytes + len(body) > self._settings().get("max_size_mb", 1024) * MB:
+            self.rejected += 1
+            raise SpoolFull("Bulk spool is full")
+        await self._write({
+            "path": path,
+            "query": query,
+            "headers": {k: headers[k] for k in SPOOLED_HEADERS if k in headers},
+            "time": round(time.time(), 3),
+        }, body)
+        self.spooled += 1
+        self.spooled_bytes += len(body)
+
+    async def _write(self, record: Dict, body: bytes):
+        settings = self._settings()
+        meta = json.dumps(record).encode()
+        segment = self.segments[-1] if self.segments and not self.segments[-1].sealed else None
+        if segment is None or not segment.append(meta, body):
+            if segment is not None:
+                segment.sealed = True
+            seq = segment.seq + 1 if segment is not None else self.cursor[0] + 1
+            if not self.segments:
+                self.cursor = (seq, 0)
+            needed = RECORD_HEADER.size + len(meta) + len(body)
+            capacity = max(int(settings.get("segment_size_mb", 64) * MB), needed)
+            segment = Segment(os.path.join(self.directory, f"{seq:012d}{SEGMENT_SUFFIX}"), seq, capacity)
+            self.segments.append(segment)
+            segment.append(meta, body)
+        self.backlog_bytes += RECORD_HEADER.size + len(meta) + len(body)
+        self.backlog_records += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if settings.get("fsync", True):
+            await asyncio.get_running_loop().run_in_executor(None, segment.sync)
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segment": self.cursor[0], "offset": self.cursor[1]}, f)
+        os.replace(tmp, path)
+
+    def _next_record(self) -> Optional[Tuple[Dict, bytes, int]]:
+        while self.segments:
+            segment = self.segments[0]
+            seq, offset = self.cursor
+            if seq != segment.seq:
+                offset = 0
+                self.cursor = (segment.seq, 0)
+            if offset < segment.end:
+                record = segment.read(offset)
+                if record is not None:
+                    return record
+                # Damaged after it was written; skip to the next record that still reads
+                next_offset = segment.next_valid(offset)
+                logger.error(f"Skipping {next_offset - offset} unreadable bytes in spool segment "
+                             f"{segment.path} at offset {offset}")
+                self.corrupt += 1
+                self._ack(next_offset, next_offset - offset)
+                continue
+            if not segment.sealed:
+                return None
+            # Fully replayed
+            self.segments.pop(0)
+            segment.remove()
+            if self.segments:
+                self.cursor = (self.segments[0].seq, 0)
+                self._save_cursor()
+        return None
+
+    def _ack(self, next_offset: int, size: int):
+        self.cursor = (self.cursor[0], next_offset)
+        self.backlog_bytes -= size
+        self.backlog_records -= 1
+        self._save_cursor()
+
+    async def run(self):
+        """Replay spooled bulks in order once upstreams are healthy again."""
+        self._wakeup = asyncio.Event()
+        backoff = 1.0
+        while True:
+            settings = self._settings()
+            try:
+                record = self._next_record() if self.directory is not None else None
+                if record is None or not self.upstream_manager.healthy:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                meta, body, next_offset = record
+                size = next_offset - self.cursor[1]
+                outcome = await self._replay(meta, body)
+                if outcome == "retry":
+                    self.replay_errors += 1
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, settings.get("max_backoff_s", 30))
+                    continue
+                if outcome == "drop":
+                    self.dropped += 1
+                else:
+                    self.replayed += 1
+                    self.replayed_bytes += len(body)
+                self._ack(next_offset, size)
+                if outcome == "partial":
+                    # Some items were pushed back and spooled again; give the cluster time to catch up
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, settings.get("max_backoff_s", 30))
+                    continue
+                backoff = 1.0
+                # Pace the replay so a recovering cluster is not flooded
+                rate = settings.get("replay_rate_mb_s", 5) * MB
+                if rate > 0:
+                    await asyncio.sleep(len(body) / rate)
+            except Exception:
+                # A full disk or a broken segment must not end the replay for good
+                logger.exception("Bulk spool replay failed; retrying")
+                self.replay_errors += 1
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, settings.get("max_backoff_s", 30))
+
+    async def _replay(self, meta: Dict, body: bytes) -> str:
+        path = meta["path"]
+        if meta.get("query"):
+            path = f"{path}?{meta['query']}"
+        try:
+            call = await self.resilience.send("POST", path, dict(meta.get("headers", {})), body)
+        except (NoHealthyUpstream, Overloaded, httpx.RequestError):
+            return "retry"
+        status = call.response.status_code
+        try:
+            content = await call.response.aread()
+        except httpx.RequestError:
+            await call.finish(ok=False)
+            return "retry"
+        await call.finish()
+        if status == 429 or status >= 500:
+            return "retry"
+        if status >= 400:
+            logger.error(f"Dropping spooled bulk for /{meta['path']}: upstream returned HTTP {status}")
+            return "drop"
+        if b'"errors":true' not in content and b'"errors": true' not in content:
+            return "ok"
+        return await self._settle_items(meta, body, content)
+
+    async def _settle_items(self, meta: Dict, body: bytes, content: bytes) -> str:
+        """Spool again the items the cluster pushed back and account for the ones it refused.
+
+        The client was told every item was accepted when the bulk was
+        spooled, so nothing may be lost silently here.
+        """
+        try:
+            items = json.loads(content).get("items")
+        except (ValueError, AttributeError):
+            items = None
+        blocks = split_bulk_items(body)
+        if not isinstance(items, list) or len(items) != len(blocks):
+            logger.error(f"Spooled bulk for /{meta['path']} had item errors that could not be matched to its "
+                         f"{len(blocks)} items; they are not retried")
+            return "ok"
+
+        retry = []
+        refused = 0
+        first_error = None
+        for block, entry in zip(blocks, items):
+            result = next(iter(entry.values()), None) if isinstance(entry, dict) else None
+            if not isinstance(result, dict) or "error" not in result:
+                continue
+            if BulkItemRetry.rejected(entry) or result.get("status", 500) >= 500:
+                retry.append(block)
+                continue
+            refused += 1
+            if first_error is None:
+                error = result["error"]
+                first_error = f"{error.get('type')}: {error.get('reason')}" if isinstance(error, dict) else error
+        if refused:
+            self.items_rejected += refused
+            logger.error(f"Indexer refused {refused} spooled bulk items for /{meta['path']}, dropping them "
+                         f"(first error: {first_error})")
+        if not retry:
+            return "ok"
+        # Already counted in the backlog as part of the original record, so not held to the byte cap
+        await self._write(dict(meta, respooled=meta.get("respooled", 0) + 1), b"".join(retry))
+        self.items_respooled += len(retry)
+        return "partial"
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled and self.directory is not None,
+            "backlog_records": self.backlog_records,
+            "backlog_bytes": self.backlog_bytes,
+            "segments": len(self.segments),
+            "spooled": self.spooled,
+            "spooled_bytes": self.spooled_bytes,
+            "replayed": self.replayed,
+            "replayed_bytes": self.replayed_bytes,
+            "dropped": self.dropped,
+            "rejected_full": self.rejected,
+            "replay_errors": self.replay_errors,
+            "corrupt": self.corrupt,
+            "items_respooled": self.items_respooled,
+            "items_rejected": self.items_rejected,
+        }
+
+    def metric_families(self):
+        yield ("wazuh_proxy_spool_backlog_bytes", "gauge", "Bytes waiting in the bulk spool.",
+               [({}, self.backlog_bytes)])
+        yield ("wazuh_proxy_spool_backlog_requests", "gauge", "Bulk requests waiting in the spool.",
+               [({}, self.backlog_records)])
+        yield ("wazuh_proxy_spool_requests_total", "counter", "Bulk requests through the spool by outcome.",
+               [({"outcome": "spooled"}, self.spooled), ({"outcome": "replayed"}, self.replayed),
+                ({"outcome": "dropped"}, self.dropped), ({"outcome": "rejected_full"}, self.rejected),
+                ({"outcome": "corrupt"}, self.corrupt)])
+        yield ("wazuh_proxy_spool_bytes_total", "counter", "Bulk body bytes spooled and replayed.",
+               [({"direction": "spooled"}, self.spooled_bytes), ({"direction": "replayed"}, self.replayed_bytes)])
+        yield ("wazuh_proxy_spool_items_total", "counter",
+               "Items of replayed bulks the cluster pushed back (respooled) or refused (rejected).",
+               [({"outcome": "respooled"}, self.items_respooled), ({"outcome": "rejected"}, self.items_rejected)])
@@ -0,0 +1,172 @@
+import logging
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from accesslog import Sampler, annotate
+
+logger = logging.getLogger("wazuh-proxy")
+
+# Phases in the order a request goes through them
+PHASES = ("read_body", "policy", "queue", "connect", "tls", "upstream_send", "upstream_ttfb", "respond")
+# httpcore trace events that open and close each upstream phase
+TRACE_STARTS = {
+    "connection.connect_tcp.started": "connect",
+    "connection.connect_unix_socket.started": "connect",
+    "connection.start_tls.started": "tls",
+    "http11.send_request_headers.started": "upstream_send",
+    "http2.send_request_headers.started": "upstream_send",
+    "http11.receive_response_headers.started": "upstream_ttfb",
+    "http2.receive_response_headers.started": "upstream_ttfb",
+}
+TRACE_ENDS = {
+    "connection.connect_tcp.complete": "connect",
+    "connection.connect_unix_socket.complete": "connect",
+    "connection.start_tls.complete": "tls",
+    "http11.receive_response_headers.started": "upstream_send",
+    "http2.receive_response_headers.started": "upstream_send",
+    "http11.receive_response_headers.complete": "upstream_ttfb",
+    "http2.receive_response_headers.complete": "upstream_ttfb",
+}
+
+# Seconds spent per phase by the request being served; None when timing is off
+current_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_phases", default=None)
+
+
+class phase:
+    """`with phase("policy"):` adds the time spent in the block to the current request."""
+
+    __slots__ = ("name", "phases", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.phases = current_phases.get()
+        if self.phases is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.phases is not None:
+            self.phases[self.name] = self.phases.get(self.name, 0.0) + time.perf_counter() - self.started
+
+
+def trace_extensions() -> Dict:
+    """httpx request extensions that time connect, TLS and time-to-first-byte of an upstream attempt."""
+    phases = current_phases.get()
+    if phases is None:
+        return {}
+    opened: Dict[str, float] = {}
+
+    async def trace(event: str, info: Dict):
+        now = time.perf_counter()
+        name = TRACE_ENDS.get(event)
+        if name is not None and name in opened:
+            phases[name] = phases.get(name, 0.0) + now - opened.pop(name)
+        name = TRACE_STARTS.get(event)
+        if name is not None:
+            opened[name] = now
+
+    return {"trace": trace}
+
+
+def server_timing(phases: Dict[str, float], total: float) -> bytes:
+    parts = [f"{name};dur={phases[name] * 1000:.2f}" for name in PHASES if name in phases]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts).encode("latin-1")
+
+
+class PhaseTiming:
+    """Per-request phase timing: Server-Timing header, histograms and slow-request logs.
+
+    Phases are accumulated in a context variable by the code that runs them
+    (body reading, policy checks, queueing) and by an httpcore trace hook
+    on upstream attempts (connect, TLS handshake, sending, time to first
+    byte). A request slower than `slow_ms` is logged with its phases, at
+    most `slow_sample_per_s` records per second.
+    """
+
+    def __init__(self, config_manager, metrics=None):
+        self.config_manager = config_manager
+        self.metrics = metrics
+        self.slow = 0
+        self.slow_sampled_out = 0
+        self.rebuild()
+
+    def _settings(self) -> Dict:
+        return self.config_manager.snapshot.timing
+
+    def rebuild(self):
+        settings = self._settings()
+        self.enabled = bool(settings.get("enabled", False))
+        self.header = bool(settings.get("server_timing_header", True))
+        self.slow_threshold = settings.get("slow_ms", 2000) / 1000
+        self.sampler = Sampler(settings.get("slow_sample_per_s", 5))
+
+    def complete(self, scope, status: int, phases: Dict[str, float], total: float):
+        if self.metrics is not None:
+            for name, seconds in phases.items():
+                self.metrics.observe_phase(name, seconds)
+        timings = {name: round(phases[name] * 1000, 3) for name in PHASES if name in phases}
+        annotate(phases_ms=timings)
+        if total < self.slow_threshold:
+            return
+        self.slow += 1
+        if not self.sampler.allow():
+            self.slow_sampled_out += 1
+            return
+        breakdown = " ".join(f"{name}={ms}ms" for name, ms in timings.items())
+        logger.warning(f"Slow request: {scope['method']} {scope['path']} -> {status} "
+                       f"in {total * 1000:.1f}ms ({breakdown or 'no phases recorded'})")
+
+    def metric_families(self):
+        yield ("wazuh_proxy_slow_requests_total", "counter", "Requests slower than timing.slow_ms.",
+               [({}, self.slow)])
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "server_timing_header": self.header,
+            "slow_ms": round(self.slow_threshold * 1000, 3),
+            "slow_requests": self.slow,
+            "slow_sampled_out": self.slow_sampled_out,
+        }
+
+
+class TimingMiddleware:
+    """Raw ASGI middleware: collects the phases of each request and times writing the response."""
+
+    def __init__(self, app, timing: PhaseTiming):
+        self.app = app
+        self.timing = timing
+
+    async def __call__(self, scope, receive, send):
+        timing = self.timing
+        if scope["type"] != "http" or not timing.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        phases: Dict[str, float] = {}
+        status = 500
+        responding = None
+
+        async def timed_send(message):
+            nonlocal status, responding
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if timing.header:
+                    header = (b"server-timing", server_timing(phases, time.perf_counter() - started))
+                    message = {**message, "headers": [*message.get("headers", ()), header]}
+                responding = time.perf_counter()
+            await send(message)
+
+        token = current_phases.set(phases)
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            current_phases.reset(token)
+            now = time.perf_counter()
+            if responding is not None:
+                phases["respond"] = now - responding
+            timing.complete(scope, status, phases, now - started)
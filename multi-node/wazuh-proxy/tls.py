@@ -0,0 +1,73 @@
+import logging
+import ssl
+from typing import Dict, Optional
+
+logger = logging.getLogger("wazuh-proxy")
+
+try:
+    from uvicorn.protocols.http.httptools_impl import HttpToolsProtocol
+    HTTPTOOLS_AVAILABLE = True
+except ImportError:
+    HttpToolsProtocol = object
+    HTTPTOOLS_AVAILABLE = False
+
+# RFC 4514 short names for the attributes found in certificate subjects
+ATTRIBUTE_NAMES = {
+    "commonName": "CN",
+    "organizationName": "O",
+    "organizationalUnitName": "OU",
+    "countryName": "C",
+    "stateOrProvinceName": "ST",
+    "localityName": "L",
+    "domainComponent": "DC",
+    "emailAddress": "emailAddress",
+}
+
+
+def subject_name(cert: Dict) -> Optional[str]:
+    """Format the subject of a certificate returned by `SSLObject.getpeercert()`."""
+    rdns = cert.get("subject")
+    if not rdns:
+        return None
+    parts = []
+    # RFC 4514 lists the most specific RDN first
+    for rdn in reversed(rdns):
+        parts.append("+".join(f"{ATTRIBUTE_NAMES.get(k, k)}={v}" for k, v in rdn))
+    return ",".join(parts)
+
+
+def tls_extension(transport) -> Optional[Dict]:
+    """ASGI TLS extension for a connection, or None for plain HTTP."""
+    ssl_object = transport.get_extra_info("ssl_object")
+    if ssl_object is None:
+        return None
+    try:
+        cert = ssl_object.getpeercert() or {}
+    except (ValueError, ssl.SSLError):
+        cert = {}
+    return {
+        "server_cert": None,
+        "client_cert_chain": [],
+        "client_cert_name": subject_name(cert),
+        "client_cert_error": None,
+        "tls_version": None,
+        "cipher_suite": None,
+    }
+
+
+class TLSHttpToolsProtocol(HttpToolsProtocol):
+    """uvicorn's httptools protocol, plus the `tls` ASGI extension in every scope.
+
+    Plain uvicorn does not tell the application who the mTLS peer is; this
+    fills `scope["extensions"]["tls"]["client_cert_name"]` once per
+    connection so the rate limiter can key on the certificate subject.
+    """
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.tls = tls_extension(transport)
+
+    def on_message_begin(self):
+        super().on_message_begin()
+        if self.tls is not None:
+            self.scope["extensions"] = {"tls": self.tls}
@@ -0,0 +1,156 @@
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+from balancer import STRATEGIES, TargetState
+from health import HealthMonitor
+from resilience import CircuitBreaker
+
+logger = logging.getLogger("wazuh-proxy")
+
+
+class UpstreamManager:
+    def __init__(self, config_manager, pool):
+        self.config_manager = config_manager
+        self.pool = pool
+        self.targets = []
+        self.states: Dict[str, TargetState] = {}
+        self.healthy: List[TargetState] = []
+        self.health_status = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.degraded: Set[str] = set()
+        self.strategy = None
+        self.monitor = HealthMonitor(config_manager, self, pool)
+        self.update_targets()
+
+    def update_targets(self):
+        """Rebuild target state from the config; called at startup and on reload."""
+        snapshot = self.config_manager.snapshot
+        upstream = snapshot.upstream
+        self.targets = snapshot.targets
+        breaker_settings = upstream.get("circuit_breaker", {})
+        states = {}
+        breakers = {}
+        health_status = {}
+        for target in self.targets:
+            url = target.url
+            state = self.states.get(url) or TargetState(url)
+            state.weight = target.weight
+            states[url] = state
+            breaker = self.breakers.get(url) or CircuitBreaker(url, breaker_settings, self._refresh_healthy)
+            breaker.configure(breaker_settings)
+            breakers[url] = breaker
+            health_status[url] = self.health_status.get(url, True)
+        self.states = states
+        self.breakers = breakers
+        # Removed targets are forgotten, so one added back later starts healthy
+        self.health_status = health_status
+        self.degraded &= set(states)
+
+        balancing = upstream.get("balancing", {})
+        name = balancing.get("strategy", "round_robin")
+        if name not in STRATEGIES:
+            logger.error(f"Unknown balancing strategy '{name}', using round_robin")
+            name = "round_robin"
+        self.strategy = STRATEGIES[name](balancing)
+        self.ewma_alpha = balancing.get("ewma_alpha", 0.3)
+        self.monitor.update_targets()
+        self._refresh_healthy()
+
+    def _refresh_healthy(self):
+        ready = [s for url, s in self.states.items()
+                 if self.health_status.get(url, True) and self.breakers[url].available]
+        # Degraded nodes (saturated write pool) only get traffic if nothing else is left
+        self.healthy = [s for s in ready if s.url not in self.degraded] or ready
+
+    def get_next_target(self, exclude: Optional[Set[str]] = None) -> Optional[str]:
+        candidates = self.healthy
+        if exclude:
+            # Prefer targets not tried yet, but fall back to any healthy one
+            candidates = [s for s in self.healthy if s.url not in exclude] or self.healthy
+        while candidates:
+            target = self.strategy.pick(candidates)
+            if self.breakers[target.url].try_probe():
+                return target.url
+            candidates = [s for s in candidates if s is not target]
+        logger.error("No healthy upstream targets available!")
+        return None
+
+    def peek_target(self) -> Optional[str]:
+        """A healthy target for the proxy's own background reads; takes no half-open probe slot."""
+        candidates = [s for s in self.healthy if self.breakers[s.url].state == CircuitBreaker.CLOSED] or self.healthy
+        if not candidates:
+            return None
+        return self.strategy.pick(candidates).url
+
+    def claim(self, url: str) -> bool:
+        """Whether `url` may take a request now (healthy, breaker allowing); counts a half-open probe."""
+        if not any(s.url == url for s in self.healthy):
+            return False
+        return self.breakers[url].try_probe()
+
+    def begin(self, url: str) -> float:
+        """Count a request as in flight on `url`; returns its start time."""
+        state = self.states.get(url)
+        if state is not None:
+            state.inflight += 1
+        return time.monotonic()
+
+    def end(self, url: str, started: float, ok: Optional[bool] = True):
+        """Close the in-flight slot opened by `begin`.
+
+        `ok` feeds latency tracking and the circuit breaker; None means the
+        request was abandoned (e.g. a cancelled hedge) and is not counted.
+        """
+        state = self.states.get(url)
+        if state is None:
+            return
+        state.inflight -= 1
+        if ok is None:
+            self.breakers[url].release_probe()
+            return
+        if ok:
+            state.observe((time.monotonic() - started) * 1000, self.ewma_alpha)
+        self.breakers[url].record(ok)
+        self.monitor.record_passive(url, ok)
+
+    def mark_unhealthy(self, url: str):
+        self.health_status[url] = False
+        self._refresh_healthy()
+        logger.warning(f"Target marked as UNHEALTHY: {url}")
+
+    def set_degraded(self, url: str, degraded: bool):
+        if degraded:
+            self.degraded.add(url)
+            logger.warning(f"Target marked as DEGRADED: {url}")
+        else:
+            self.degraded.discard(url)
+            logger.info(f"Target no longer degraded: {url}")
+        self._refresh_healthy()
+
+    def mark_healthy(self, url: str):
+        if not self.health_status.get(url, True):
+            logger.info(f"Target recovered (HEALTHY): {url}")
+        self.health_status[url] = True
+        self._refresh_healthy()
+
+    def sync_health(self, health_status: Dict[str, bool], degraded: List[str]):
+        """Adopt the health view published by the supervisor (multi-worker mode).
+
+        Replaces any local passive-failure marks, so a worker that tripped
+        on a node follows the supervisor again after its next sweep.
+        """
+        for url in self.states:
+            healthy = health_status.get(url, True)
+            if healthy != self.health_status.get(url, True):
+                logger.info(f"Target {'recovered (HEALTHY)' if healthy else 'marked as UNHEALTHY'}: {url}")
+            self.health_status[url] = healthy
+        self.degraded = set(degraded) & set(self.states)
+        self._refresh_healthy()
+
+    def stats(self) -> Dict:
+        return {url: dict(state.stats(), healthy=self.health_status.get(url, True), degraded=url in self.degraded,
+                          circuit=self.breakers[url].stats()) for url, state in self.states.items()}
+
+    async def health_checker(self):
+        await self.monitor.run()